@@ -0,0 +1,18 @@
+import argparse
+from ml_prediction import MODEL_DIR, MODELS, write_feature_table
+
+# Builds the feature tables (column order, dtypes and impute values) stored next to the models,
+# so predictions do not need to read the training features. Models without training features get
+# the table of their preprocessor.
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the feature tables of the metadata prediction models from their training features or preprocessors.")
+    parser.add_argument('--model_dir', type=str, default=MODEL_DIR, help="Directory with the models and their {model}_train_features.csv or {model}_preprocessor.pkl files.")
+    parser.add_argument('--models', type=str, nargs='+', default=MODELS, help="Models to build feature tables for.")
+    args = parser.parse_args()
+
+    for model in args.models:
+        write_feature_table(model, args.model_dir)
+
+if __name__ == '__main__':
+    main()
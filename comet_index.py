@@ -0,0 +1,130 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+import subprocess
+
+# Comet peptide index cache: instead of digesting the FASTA database in every search, Comet builds a
+# peptide index (comet -j) once per database and digestion/modification settings, and the searches use
+# the index as their database. A search against an index takes enzyme, missed cleavages, modifications
+# and mass range from the index, so the index settings are derived from the digestion settings the
+# search passes to CometAdapter, and every distinct set of settings gets an index of its own. The
+# tolerances, instrument and activation method of the _comet_params.txt files are applied at search
+# time and do not change the index, so all files with the same digestion settings share it.
+
+# Comet parameters of the CometAdapter digestion settings, settings without entry are not indexed
+COMET_ENZYMES = {"Trypsin": "1", "Trypsin/P": "2", "Lys-C": "3", "Lys-N": "4", "Arg-C": "5"}
+COMET_ENZYME_TERMINI = {"fully": "2", "semi": "1", "C-term unspecific": "8", "N-term unspecific": "9"}
+COMET_FIXED_MODIFICATIONS = {"Carbamidomethyl (C)": ("add_C_cysteine", "57.021464")}
+COMET_VARIABLE_MODIFICATIONS = {"Oxidation (M)": "15.9949 M 0 3 -1 0 0 0.0", "Phospho (STY)": "79.966331 STY 0 3 -1 0 0 0.0"}
+MAX_VARIABLE_MODIFICATIONS = 9
+
+def index_settings(digestion):
+    """Comet parameters of the peptide index for searches with the given CometAdapter digestion settings,
+    None if a setting has no known Comet parameter."""
+    try:
+        settings = {
+            "search_enzyme_number": COMET_ENZYMES[digestion["enzyme"]],
+            "num_enzyme_termini": COMET_ENZYME_TERMINI[digestion["num_enzyme_termini"]],
+            "allowed_missed_cleavage": str(digestion["missed_cleavages"]),
+            "digest_mass_range": digestion["digest_mass_range"].replace(":", " "),
+            "peptide_length_range": "5 63",  # CometAdapter default
+            "decoy_search": "0",  # decoys are part of the database
+            "add_C_cysteine": "0.0",
+        }
+        for modification in digestion["fixed_modifications"]:
+            name, value = COMET_FIXED_MODIFICATIONS[modification]
+            settings[name] = value
+        variable = [COMET_VARIABLE_MODIFICATIONS[modification] for modification in digestion["variable_modifications"]]
+    except KeyError:
+        return None
+    if len(variable) > MAX_VARIABLE_MODIFICATIONS:
+        return None
+    for i in range(MAX_VARIABLE_MODIFICATIONS):
+        settings[f"variable_mod{i + 1:02d}"] = variable[i] if i < len(variable) else "0.0 X 0 3 -1 0 0 0.0"
+    return settings
+
+class CometIndex:
+    """Peptide indices of FASTA databases built with the Comet executable, cached in cache_dir.
+    If the index is not required, databases whose index cannot be built are searched as FASTA files."""
+
+    def __init__(self, cometexe, cache_dir, required=True):
+        self.cometexe = os.path.abspath(cometexe)
+        self.cache_dir = cache_dir
+        self.required = required
+        self.unavailable = set()
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def index_dir(self, db, settings):
+        """The cache is specific to the database file and the index settings."""
+        stat = os.stat(db)
+        key = json.dumps([os.path.abspath(db), stat.st_size, stat.st_mtime_ns, settings], sort_keys=True)
+        name = os.path.splitext(os.path.basename(db))[0]
+        return os.path.join(self.cache_dir, f"{name}_{hashlib.sha1(key.encode()).hexdigest()[:12]}")
+
+    def index(self, db, digestion):
+        """Returns the path of the peptide index of db for searches with the given digestion settings, building
+        it if it is not cached yet. Returns db if the settings cannot be indexed."""
+        settings = index_settings(digestion)
+        if settings is None:
+            print(f"Warning: The digestion settings {digestion} have no Comet index parameters. Searching the FASTA file.")
+            return db
+        index_dir = self.index_dir(db, settings)
+        if index_dir in self.unavailable:
+            return db
+        info_path = os.path.join(index_dir, "index.json")
+        with self.lock:
+            lock = self.locks.setdefault(index_dir, threading.Lock())
+        # The thread lock serializes the threads of this process, the file lock other processes sharing the cache
+        with lock:
+            if not os.path.exists(info_path):
+                os.makedirs(index_dir, exist_ok=True)
+                with open(os.path.join(index_dir, ".lock"), "w") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    if not os.path.exists(info_path):
+                        try:
+                            self.build(db, index_dir, info_path, settings)
+                        except (OSError, subprocess.CalledProcessError, RuntimeError) as e:
+                            if self.required:
+                                raise
+                            print(f"Warning: Could not build the Comet peptide index of {db} ({e}). Searching the FASTA file.")
+                            self.unavailable.add(index_dir)
+                            return db
+            with open(info_path, "r") as f:
+                return os.path.join(index_dir, json.load(f)["index"])
+
+    def write_params(self, db_link, index_dir, settings):
+        """Writes the Comet parameters of the index from the default parameters of the Comet executable."""
+        subprocess.run([self.cometexe, "-p"], cwd=index_dir, check=True, stdout=subprocess.DEVNULL)
+        lines, missing = [], dict(settings)
+        with open(os.path.join(index_dir, "comet.params.new"), "r") as f:
+            for line in f:
+                name = line.split("=")[0].strip()
+                if name == "database_name":
+                    line = f"database_name = {db_link}\n"
+                elif name in missing:
+                    line = f"{name} = {missing.pop(name)}\n"
+                lines.append(line)
+        lines += [f"{name} = {value}\n" for name, value in missing.items()]
+        params_path = os.path.join(index_dir, "index.params")
+        with open(params_path, "w") as f:
+            f.writelines(lines)
+        return params_path
+
+    def build(self, db, index_dir, info_path, settings):
+        print(f"Building Comet peptide index of {db} in {index_dir}...")
+        # Comet writes the index next to the database, so the database is linked into the cache
+        db_link = os.path.join(index_dir, os.path.basename(db))
+        if not os.path.lexists(db_link):
+            os.symlink(os.path.abspath(db), db_link)
+        params_path = self.write_params(db_link, index_dir, settings)
+        subprocess.run([self.cometexe, "-j", f"-P{params_path}"], cwd=index_dir, check=True)
+        index_path = f"{db_link}.idx"
+        if not os.path.exists(index_path):
+            raise RuntimeError(f"Comet did not create the peptide index {index_path}")
+        with open(f"{info_path}.tmp", "w") as f:
+            json.dump({"database": os.path.abspath(db), "index": os.path.basename(index_path), "settings": settings}, f)
+        os.replace(f"{info_path}.tmp", info_path)
+        print(f"Comet peptide index saved to {index_path}")
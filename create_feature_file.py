@@ -1,15 +1,21 @@
 import os
 import re
+import sys
 import pandas as pd
 from pathlib import Path
 import xml.etree.ElementTree as ET
 from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
 import os
 import pandas as pd
 import numpy as np
 import pyopenms as oms
 from pyopenms import *
 import pickle
+from result_cache import open_cache
+from subsample_spectra import read_sample_info, write_organism_proportions
+from feature_store import FeatureStore
+from peptide_mass_index import read_prescreen, prescreen_record
 
 # === 1. EXTRACT FEATURES FROM OpenMS FILEINFO TXT FILES ===
 def extract_features_from_txt(file_path):
@@ -123,102 +129,217 @@ def extract_features_from_txt(file_path):
     return features
 
 
+def organism_suffix(prot_acc):
+    """Organism suffix of a protein accession, e.g. HUMAN for sp|P12345|ALBU_HUMAN."""
+    return str(prot_acc).split("|")[-1].split("_")[-1].split("'")[0]
+
 def get_pephit_stats(idxml_path):
-    """Reads a idXML file and returns statistics of its peptide identifications."""
-    
-    protein_ids = []
-    peptide_ids = []
-    oms.IdXMLFile().load(idxml_path, protein_ids, peptide_ids)
-
-    protein_bypep = []
-    protein_by_eval = []
-
-    # Go through peptide identifications
-    for peptide in peptide_ids:
-        for hit in peptide.getHits():
-            if hit.getScore() <= 0.00001:  # E-Value Cutoff: 1e-5
-                for prot_acc in hit.extractProteinAccessionsSet():
-                    organism_suffix = str(prot_acc).split("|")[-1].split("_")[-1].split("'")[0]
-                    protein_bypep.append(organism_suffix)
-                    protein_by_eval.append((organism_suffix, hit.getScore()))
-
-    # Count hits below threshold per organism
-    suffix_counts = Counter(protein_bypep)
-    
-    # Calculate average e-value per organism
+    """Streams through a idXML file and returns statistics of its peptide identifications.
+    Only the protein accessions and the per-organism counters are kept in memory, every
+    identification is dropped as soon as it has been counted."""
+
+    # Organism suffix per ProteinHit id, interned so every hit of an organism shares one string
+    protein_suffixes = {}
+    accessions = {}
+
+    # Count hits below threshold and sum up their e-values per organism
+    suffix_counts = Counter()
     eval_sums = defaultdict(float)
-    eval_counts = defaultdict(int)
 
-    for suffix, e_value in protein_by_eval:
-        eval_sums[suffix] += e_value
-        eval_counts[suffix] += 1
+    run = None
+    context = ET.iterparse(idxml_path, events=("start", "end"))
+    for event, elem in context:
+        if event == "start":
+            if elem.tag == "IdentificationRun":
+                run = elem
+            continue
+
+        if elem.tag == "ProteinHit":
+            accession = elem.get("accession", "")
+            accessions[elem.get("id")] = accession
+            protein_suffixes[accession] = sys.intern(organism_suffix(accession))
+            elem.clear()
+        elif elem.tag == "PeptideHit":
+            score = float(elem.get("score"))
+            if score <= 0.00001:  # E-Value Cutoff: 1e-5
+                # Every protein counts once per hit, in the order of OpenMS' accession set
+                for accession in sorted({accessions[ref] for ref in elem.get("protein_refs", "").split()}):
+                    suffix = protein_suffixes[accession]
+                    suffix_counts[suffix] += 1
+                    eval_sums[suffix] += score
+            elem.clear()
+        elif elem.tag in ("PeptideIdentification", "ProteinIdentification") and run is not None:
+            run.remove(elem)
 
-    avg_evals = {suffix: eval_sums[suffix] / eval_counts[suffix] for suffix in eval_sums}
+    # Calculate average e-value per organism
+    avg_evals = {suffix: eval_sums[suffix] / suffix_counts[suffix] for suffix in eval_sums}
 
     return suffix_counts, avg_evals
 
-def extract_features_from_idxml(idxml_dir):
-    # Dictionary for storage of results
-    results = {}
+def extract_idxml_record(idxml_path, mzML_filename):
+    """Returns the peptide hit features of a single idXML file or None if there are no results."""
+    if not os.path.exists(idxml_path) or os.path.getsize(idxml_path) == 0:
+        return None
+    suffix_counts, avg_evals = get_pephit_stats(idxml_path)
+
+    # Hits of a search on a spectrum sample are extrapolated to all spectra of the file,
+    # so the counts stay on the scale the models were trained on
+    sample_info = read_sample_info(idxml_path)
+    scale = sample_info["eligible_spectra"] / sample_info["sample_size"] if sample_info and sample_info["sample_size"] else 1
+
+    # Create dictionary for file
+    file_data = {"Filename": mzML_filename}
+
+    for suffix, count in suffix_counts.items():
+        file_data[f"{suffix}_counthits"] = count * scale
+        file_data[f"{suffix}_avgevalhits"] = avg_evals.get(suffix, np.nan)
+
+    return file_data
+
+def cached_record(cache, path, extract):
+    """Returns the cached record of a file, extracting and caching it if the file is new or changed."""
+    if cache is None:
+        return extract(path)
+    record = cache.get(path)
+    if record is None:
+        record = extract(path)
+        cache.put(path, record)
+    return record
+
+def open_feature_caches(output_dir, use_hash=False):
+    """Opens the per-file caches of FileInfo and idXML features."""
+    return open_cache(output_dir, "fileinfo_features", use_hash), open_cache(output_dir, "idxml_features", use_hash)
+
+def extract_fileinfo_record(txt_path):
+    """Returns the features of a single OpenMS FileInfo text file including its mzML file name."""
+    features = extract_features_from_txt(txt_path)
+    features["Filename"] = str(os.path.basename(txt_path)).split(".txt")[0]+".mzML"
+    return features
 
-    # Go through all idXML files
-    for file in os.listdir(idxml_dir):
+def extract_records(extract, tasks, cache=None, max_workers=1):
+    """Runs extract(path, *args) for every (path, *args) task whose record is not cached, spread over
+    max_workers processes. Records are returned in the order of the tasks, independent of the order
+    in which the workers finish."""
+    records = [cache.get(task[0]) if cache is not None else None for task in tasks]
+    missing = [i for i, record in enumerate(records) if record is None]
+    if not missing:
+        return records
+
+    arguments = list(zip(*[tasks[i] for i in missing]))
+    if max_workers > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(extract, *arguments))
+    else:
+        results = list(map(extract, *arguments))
+
+    for i, record in zip(missing, results):
+        records[i] = record
+        if cache is not None:
+            cache.put(tasks[i][0], record)
+    return records
+
+def extract_features_from_idxml(idxml_dir, cache=None, max_workers=1, prescreen_hit_scale=None):
+    """Extracts the peptide hit features of all idXML files in a directory, sorted by file name.
+    Files that were only pre-screened get their pre-screen features, see prescreen_record."""
+    tasks = []
+    for file in sorted(os.listdir(idxml_dir)):
         if file.endswith(".idXML"):
             mzML_filename = file.split("_CometAdapter.idXML")[0] + ".mzML"
-            idxml_path = os.path.join(idxml_dir, file)
-
-            if os.path.exists(idxml_path) and os.path.getsize(idxml_path) == 0:
-                continue
-            suffix_counts, avg_evals = get_pephit_stats(idxml_path)
-            
+            tasks.append((os.path.join(idxml_dir, file), mzML_filename))
 
-            # Create dictionary for file
-            file_data = {"Filename": mzML_filename}
+    # Merge the per-file records once, files without results are left out
+    records = extract_records(extract_idxml_record, tasks, cache, max_workers)
 
-            for suffix, count in suffix_counts.items():
-                file_data[f"{suffix}_counthits"] = count
-                file_data[f"{suffix}_avgevalhits"] = avg_evals.get(suffix, np.nan)
-
-            results[mzML_filename] = file_data
-
-
-    # Create df
-    df_results = pd.DataFrame.from_dict(results, orient="index").reset_index(drop=True)
+    # Files that were not searched get the hits of their pre-screen
+    for file in sorted(os.listdir(idxml_dir)):
+        idxml_path = os.path.join(idxml_dir, file.split("_prescreen.json")[0] + "_CometAdapter.idXML")
+        if file.endswith("_prescreen.json") and not os.path.exists(idxml_path):
+            records.append(prescreen_record(read_prescreen(idxml_path), file.split("_prescreen.json")[0] + ".mzML", prescreen_hit_scale))
+    records = sorted((record for record in records if record is not None), key=lambda record: record["Filename"])
+    df_results = pd.DataFrame(records)
 
     # Fehlende Werte mit Mittelwerten der Spalten füllen
     #df_results.fillna(df_results.mean(numeric_only=True), inplace=True)
 
     return(df_results)
 
-
-def create_feature_file(idxml_dir, output_dir):
+def extract_features_from_fileinfo(fileinfo_dir, cache=None, max_workers=1):
+    """Extracts the features of all OpenMS FileInfo text files in a directory, sorted by file name."""
+    tasks = [(os.path.join(fileinfo_dir, txt_file),) for txt_file in sorted(os.listdir(fileinfo_dir)) if txt_file.endswith(".txt")]
+    return extract_records(extract_fileinfo_record, tasks, cache, max_workers)
+
+def extract_file_features(mzml_file, fileinfo_dir, idxml_dir, fileinfo_cache=None, idxml_cache=None, prescreen_hit_scale=None):
+    """Extracts the FileInfo and peptide hit features of a single mzML file, or its pre-screen features if it was not searched.
+    Returns a (fileinfo_record, idxml_record) tuple, entries are None if the inputs are missing."""
+    file_name = mzml_file.split('.mzML')[0]
+
+    fileinfo_record = None
+    txt_path = os.path.join(fileinfo_dir, f"{file_name}.txt")
+    if os.path.exists(txt_path):
+        fileinfo_record = cached_record(fileinfo_cache, txt_path, extract_fileinfo_record)
+
+    idxml_path = os.path.join(idxml_dir, f"{file_name}_CometAdapter.idXML")
+    idxml_record = None
+    if os.path.exists(idxml_path):
+        idxml_record = cached_record(idxml_cache, idxml_path, lambda path: extract_idxml_record(path, mzml_file))
+    else:
+        # Without a search, the hits of the pre-screen are used
+        prescreen = read_prescreen(idxml_path)
+        if prescreen is not None:
+            idxml_record = prescreen_record(prescreen, mzml_file, prescreen_hit_scale)
+
+    return fileinfo_record, idxml_record
+
+def create_feature_file(idxml_dir, output_dir, fileinfo_records=None, idxml_records=None, use_hash=False, max_workers=1,
+                        feature_store=None, export_csv=False, write_files=True, prescreen_hit_scale=None):
+    """Creates the feature file used for ML predictions. Per-file records that were already extracted
+    (e.g. by the per-file pipeline scheduler) can be passed in, otherwise they are read from the
+    fileinfo and idXML directories with up to max_workers processes. Features are cached per file,
+    so only new or changed FileInfo and idXML files are parsed and the CSV files are rebuilt from
+    the cached records. With a feature_store format (arrow or parquet), the features are stored in
+    output_dir/feature_store instead of extracted_features.csv, unless export_csv is set.
+    Without write_files, no CSV files are written. Files that were only pre-screened get their
+    pre-screen features, with the counthits scaled by prescreen_hit_scale if it is set.
+    Returns the features as a DataFrame."""
     fileinfo_df_file = os.path.join(output_dir,"fileinfo/fileinfo_extracted_features.csv")
     features_df_file = os.path.join(output_dir,"extracted_features.csv")
-    if not os.path.exists(features_df_file):
-        # === 2. PROCESS ALL FILEINFO TXT FILES ===
-        txt_files = os.path.join(output_dir, "fileinfo")
-        data = []
-        for txt_file in os.listdir(txt_files):
-            if txt_file.endswith(".txt"):
-                features = extract_features_from_txt(os.path.join(txt_files,txt_file))
-                features["Filename"] = str(txt_file).split(".txt")[0]+".mzML"
-                data.append(features)
-
-        # Convert to DataFrame
-        features_df = pd.DataFrame(data)
+    fileinfo_cache, idxml_cache = open_feature_caches(output_dir, use_hash)
+
+    # === 2. PROCESS ALL FILEINFO TXT FILES ===
+    if fileinfo_records is None:
+        fileinfo_records = extract_features_from_fileinfo(os.path.join(output_dir, "fileinfo"), fileinfo_cache, max_workers)
+        fileinfo_cache.save()
+
+    # Convert to DataFrame
+    features_df = pd.DataFrame(fileinfo_records)
+    if write_files:
+        os.makedirs(os.path.dirname(fileinfo_df_file), exist_ok=True)
         features_df.to_csv(fileinfo_df_file, index=False)
 
-        peptide_stats_df = extract_features_from_idxml(idxml_dir)
+    if idxml_records is None:
+        peptide_stats_df = extract_features_from_idxml(idxml_dir, idxml_cache, max_workers, prescreen_hit_scale)
+        idxml_cache.save()
+    else:
+        peptide_stats_df = pd.DataFrame(idxml_records)
+    if "Filename" not in peptide_stats_df.columns:
+        peptide_stats_df = pd.DataFrame(columns=["Filename"])
 
-        # Merge peptide stats and features over Filename
-        merged_df = features_df.merge(peptide_stats_df, on="Filename", how="left")
+    # Report the share of every organism among the hits with the number of spectra searched
+    if write_files:
+        write_organism_proportions(idxml_dir, peptide_stats_df.to_dict("records"), output_dir)
 
-        # Fill missing values after merge with nans
-        #merged_df.fillna(merged_df.mean(numeric_only=True), inplace=True)
+    # Merge peptide stats and features over Filename
+    merged_df = features_df.merge(peptide_stats_df, on="Filename", how="left")
 
-        # Move "Filename" column to beginning
-        merged_df.insert(0, "Filename", merged_df.pop("Filename"))
+    # Fill missing values after merge with nans
+    #merged_df.fillna(merged_df.mean(numeric_only=True), inplace=True)
 
-        merged_df.to_csv(features_df_file, index=False)
+    # Move "Filename" column to beginning
+    merged_df.insert(0, "Filename", merged_df.pop("Filename"))
 
+    if feature_store:
+        FeatureStore(os.path.join(output_dir, "feature_store"), feature_store).update(merged_df)
+    if write_files and (not feature_store or export_csv):
+        merged_df.to_csv(features_df_file, index=False)
 
+    return merged_df
@@ -111,28 +111,42 @@ def create_param_file(pred_vals, output_path, instrument, activation_method):
 
 
 
-def process_files_in_directory(directory_path, output_dir, fileinfo_dir):
-    # Durchlaufe alle .txt-Dateien im Ordner
+def create_parameter_file(file_path, output_dir, fileinfo_dir, fileinfo_features=None):
+    """Creates the Comet parameter file for a single param-medic tolerance file. Falls back to
+    default tolerances if the tolerance file does not exist (yet). Instrument and activation method
+    are taken from fileinfo_features if given (e.g. by scan_mzml), otherwise from the FileInfo file."""
+    file_name = os.path.basename(file_path)
+    data_cols, data_pred_vals = None, None
+    if os.path.exists(file_path):
+        data_cols, data_pred_vals = parse_txt_file(file_path)
+    # Get corresponding fileinfo
+    fileinfo_path = os.path.join(fileinfo_dir, os.path.splitext(file_name)[0].replace('_params', ''))
+    instrument, activation_method = None, None
+    if fileinfo_features is not None:
+        instrument, activation_method = fileinfo_features["instrument_model"], fileinfo_features["activation_method"]
+    elif os.path.exists(fileinfo_path):
+        instrument, activation_method = parse_fileinfo_file(fileinfo_path)
+
+    # Generate the output file path based on the directory and filename
+    output_file_path = os.path.join(output_dir, f"{os.path.splitext(file_name)[0]}_comet_params.txt")
+    create_param_file(data_pred_vals, output_file_path, instrument, activation_method)
+    return instrument, activation_method
+
+def process_files_in_directory(data_dir, directory_path, output_dir, fileinfo_dir, fileinfo_records=None):
+    # Durchlaufe alle mzML-Dateien, Dateien ohne Toleranzdatei erhalten die Standardtoleranzen
     instruments = []
     act_methods = []
-    for file_name in os.listdir(directory_path):
-        if file_name.endswith('.txt'):
-            file_path = os.path.join(directory_path, file_name)
-            data_cols, data_pred_vals = parse_txt_file(file_path)
-            # Get corresponding fileinfo
-            fileinfo_path = os.path.join(fileinfo_dir, os.path.splitext(file_name)[0].replace('_params', ''))
-            instrument, activation_method = None, None
-            if os.path.exists(fileinfo_path):
-                instrument, activation_method = parse_fileinfo_file(fileinfo_path)
+    features_by_file = {r["Filename"]: r for r in fileinfo_records or []}
+    for mzml_file in os.listdir(data_dir):
+        if mzml_file.endswith('.mzML'):
+            file_path = os.path.join(directory_path, f"{mzml_file.split('.mzML')[0]}_params.txt")
+            instrument, activation_method = create_parameter_file(file_path, output_dir, fileinfo_dir, features_by_file.get(mzml_file))
+            if instrument is not None or activation_method is not None:
                 instruments.append(instrument)
                 act_methods.append(activation_method)
-            
-            # Generate the output file path based on the directory and filename
-            output_file_path = os.path.join(output_dir, f"{os.path.splitext(file_name)[0]}_comet_params.txt")
-            create_param_file(data_pred_vals, output_file_path, instrument, activation_method)
     return np.array(instruments), np.array(act_methods)
 
-def create_parameter_files(data_dir, output_dir):
+def create_parameter_files(data_dir, output_dir, fileinfo_records=None):
     pred_dir = os.path.join(output_dir, "tolerances/")
     fileinfo_dir = os.path.join(output_dir, "fileinfo/")
     param_files_dir = os.path.join(output_dir, "param_files/")
@@ -140,7 +154,7 @@ def create_parameter_files(data_dir, output_dir):
         os.makedirs(param_files_dir)
         print(f"Created directory: {param_files_dir}")
 
-    ins, actm = process_files_in_directory(pred_dir, param_files_dir, fileinfo_dir)
+    ins, actm = process_files_in_directory(data_dir, pred_dir, param_files_dir, fileinfo_dir, fileinfo_records)
     # print('Possible entries for instrument: ',np.unique(ins[ins!= None]))
     # print('\n')
     # print('Possible entries for activation method: ',np.unique(actm[actm!= None]))
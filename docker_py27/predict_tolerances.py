@@ -1,12 +1,44 @@
 import os
 import subprocess
 import argparse
+import multiprocessing
 
 ### IMPORTANT: Python 2.7 required.
+
+def run_param_medic(job):
+    """Runs param-medic for one mzML file. The output is written to a temporary file first and
+    only renamed to the params file if param-medic succeeded, so failed runs leave no params file."""
+    data_dir, pred_dir, mzml_file = job
+    file_name = mzml_file.split('.mz')[0]
+    params_path = os.path.join(pred_dir, "{}_params.txt".format(file_name))
+    tmp_path = "{}.{}.tmp".format(params_path, os.getpid())
+
+    # Perform param search for file to receive mass tolerances for more adequate
+    # peptide identification results
+    cmd = [
+        "param-medic",
+        os.path.join(data_dir, mzml_file)
+    ]
+
+    print("Running: {}".format(' '.join(cmd)))
+
+    try:
+        with open(tmp_path, "w") as outfile:
+            subprocess.check_call(cmd, stdout=outfile)
+        os.rename(tmp_path, params_path)
+        return True
+    except (subprocess.CalledProcessError, OSError):
+        print("Error processing {}. Skipping to the next file.".format(mzml_file))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
 def main():
     parser = argparse.ArgumentParser(description="Predict mass tolerances for proteomics data using param-medic.")
     parser.add_argument('--mzml_dir', type=str, required=True, help="Folder path containing mzML files.")
     parser.add_argument('--output_dir', type=str, required=True, help="Directory where the param-medic output .csv files will be stored.")
+    parser.add_argument('--files', type=str, nargs='*', help="Optional: Names of the mzML files to process (default: all mzML files in --mzml_dir).")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Number of param-medic runs at once (default: number of CPUs).")
     args = parser.parse_args()
 
     # Set direction with mzML files
@@ -19,32 +51,32 @@ def main():
         print("Created default tolerances directory in {}: tolerances".format(''.join(args.output_dir)))
 
     # Read mzML files ending with '.mzML'
-    mzml_files = [f for f in os.listdir(data_dir) if f.endswith('.mzML')]
+    if args.files is not None:
+        mzml_files = args.files
+    else:
+        mzml_files = [f for f in os.listdir(data_dir) if f.endswith('.mzML')]
 
-    # Process each mzML file
+    # Run param-medic only if file wasn't already created
+    jobs = []
     for mzml_file in mzml_files:
-        file_name = mzml_file.split('.mz')[0]
-        params_file = "{}_params.txt".format(file_name)
-        
-        # Run param-medic only if file wasn't already created
-        if not os.path.exists(os.path.join(pred_dir, params_file)):
-
-            # Perform param search for file to receive mass tolerances for more adequate 
-            # peptide identification results
-            cmd = [
-                "param-medic",
-                os.path.join(data_dir, mzml_file)
-            ]
-            
-            print("Running: {}".format(' '.join(cmd)))
-            
-            try:
-                with open(os.path.join(pred_dir, params_file), "w") as outfile:
-                    subprocess.check_call(cmd, stdout=outfile)
-            except subprocess.CalledProcessError:
-                print("Error processing {}. Skipping to the next file.".format(mzml_file))
-        else:
+        params_file = "{}_params.txt".format(mzml_file.split('.mz')[0])
+        if os.path.exists(os.path.join(pred_dir, params_file)):
             print("Tolerances file for {} already exists. Skipping to the next file.".format(mzml_file))
+        else:
+            jobs.append((data_dir, pred_dir, mzml_file))
+    if not jobs:
+        return
+
+    # param-medic runs single-threaded, so one run per CPU keeps all cores busy
+    workers = max(1, min(args.workers, len(jobs)))
+    print("Running param-medic for {} files with {} workers".format(len(jobs), workers))
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(run_param_medic, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    print("param-medic finished for {} of {} files".format(sum(results), len(jobs)))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
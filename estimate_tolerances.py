@@ -0,0 +1,225 @@
+import os
+import argparse
+import numpy as np
+import pyopenms as oms
+from concurrent.futures import ProcessPoolExecutor
+
+# Native mass tolerance estimation in the spirit of param-medic: MS2 spectra of the same peptide are
+# paired by precursor m/z, charge, scan distance and shared fragment peaks. The precursor and fragment
+# mass differences of the pairs are fitted with a Gaussian for real pairs plus a uniform background
+# for random pairs, and the predicted tolerances are the fitted sigmas times param-medic's multipliers.
+# Writes the same tolerance files as param-medic, so create_parameter_files reads them unchanged.
+
+MIN_PEAKS = 10
+TOP_PEAKS = 20
+MIN_SHARED_PEAKS = 10
+# Fragment peaks are compared in bins of Comet's default fragment bin width
+BIN_WIDTH = 1.0005079
+MAX_PRECURSOR_PPM = 50
+MAX_FRAGMENT_TH = 0.5
+MAX_SCAN_SEPARATION = 1000
+MAX_CANDIDATES = 20
+MIN_PAIRS = 200
+PRECURSOR_SIGMA_MULTIPLIER = 11.130
+FRAGMENT_SIGMA_MULTIPLIER = 4.763
+MAX_SPECTRA = 100000
+# Candidate pairs whose shared fragment bins are counted at once
+PAIR_CHUNK = 20000
+
+COLUMNS = ["precursor_prediction_ppm", "precursor_sigma_ppm", "fragment_prediction_th", "fragment_sigma_th"]
+
+class ToleranceConsumer:
+    """Consumer for MzMLFile().transform that keeps precursor m/z, charge and the most intense peaks of
+    the MS2 spectra. With max_spectra, only a contiguous block of spectra from the middle of the run is
+    kept, so spectra of the same peptide stay together."""
+
+    def __init__(self, max_spectra=MAX_SPECTRA):
+        self.max_spectra = max_spectra
+        self.start, self.stop = 0, None
+        self.index = 0
+        self.scans, self.precursor_mz, self.charges, self.peaks = [], [], [], []
+
+    def setExpectedSize(self, num_spectra, num_chromatograms):
+        if self.max_spectra and num_spectra > self.max_spectra:
+            self.start = (num_spectra - self.max_spectra) // 2
+            self.stop = self.start + self.max_spectra
+
+    def setExperimentalSettings(self, settings):
+        pass
+
+    def consumeChromatogram(self, chromatogram):
+        pass
+
+    def consumeSpectrum(self, spectrum):
+        in_block = self.index >= self.start and (self.stop is None or self.index < self.stop)
+        if in_block and spectrum.getMSLevel() == 2:
+            precursors = spectrum.getPrecursors()
+            if precursors and precursors[0].getCharge() > 0:
+                mz, intensity = spectrum.get_peaks()
+                if mz.size >= MIN_PEAKS:
+                    self.scans.append(self.index)
+                    self.precursor_mz.append(precursors[0].getMZ())
+                    self.charges.append(precursors[0].getCharge())
+                    self.peaks.append(np.sort(mz[np.argsort(intensity)[-TOP_PEAKS:]]))
+        self.index += 1
+
+def shared_bins(bins, first, second):
+    """Number of fragment bins shared by the spectra first[k] and second[k]. The rows of bins are padded with -1."""
+    counts = np.empty(len(first), dtype=np.int64)
+    for start in range(0, len(first), PAIR_CHUNK):
+        a, b = bins[first[start:start + PAIR_CHUNK]], bins[second[start:start + PAIR_CHUNK]]
+        counts[start:start + PAIR_CHUNK] = ((a[:, :, None] == b[:, None, :]) & (a[:, :, None] >= 0)).sum(axis=(1, 2))
+    return counts
+
+def pair_spectra(scans, precursor_mz, charges, peaks):
+    """Pairs spectra with the same charge, close precursor m/z and scans, and at least MIN_SHARED_PEAKS
+    shared fragment bins. Every spectrum is used in one pair at most. Pairs are ordered by scan.
+    The spectra are sorted by charge and precursor m/z, so the candidates of a spectrum are the next
+    MAX_CANDIDATES positions within its charge and precursor window, which are checked for all spectra at once."""
+    n = len(peaks)
+    # Fragment bins of the sorted peaks, one row per spectrum, with repeated bins and padding set to -1
+    lengths = np.array([p.size for p in peaks], dtype=np.int64)
+    rows = np.repeat(np.arange(n), lengths)
+    columns = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    flat = np.round(np.concatenate(peaks) / BIN_WIDTH).astype(np.int64) if n else np.array([], dtype=np.int64)
+    flat[1:][(flat[1:] == flat[:-1]) & (rows[1:] == rows[:-1])] = -1
+    bins = np.full((n, TOP_PEAKS), -1, dtype=np.int64)
+    bins[rows, columns] = flat
+    order = np.lexsort((precursor_mz, charges))
+    mz, charge, scan = precursor_mz[order], charges[order], scans[order]
+    window_end = np.minimum(np.searchsorted(charge, charge, side="right"), np.arange(n) + 1 + MAX_CANDIDATES)
+
+    # Candidate pairs (position, offset) in the sorted order that pass all checks
+    positions, offsets = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+    for offset in range(1, MAX_CANDIDATES + 1):
+        pos = np.flatnonzero(np.arange(n) + offset < window_end)
+        other = pos + offset
+        pos = pos[((mz[other] - mz[pos]) / mz[pos] * 1e6 <= MAX_PRECURSOR_PPM) & (np.abs(scan[other] - scan[pos]) <= MAX_SCAN_SEPARATION)]
+        pos = pos[shared_bins(bins, order[pos], order[pos + offset]) >= MIN_SHARED_PEAKS]
+        positions.append(pos)
+        offsets.append(np.full(pos.size, offset))
+    positions, offsets = np.concatenate(positions), np.concatenate(offsets)
+    candidate_order = np.lexsort((offsets, positions))
+    positions, offsets = positions[candidate_order], offsets[candidate_order]
+
+    # Greedy matching in the sorted order, only over the spectra with candidates
+    used = [False] * n
+    pairs = []
+    spectra, partners = order[positions].tolist(), order[positions + offsets].tolist()
+    starts = np.flatnonzero(np.r_[True, positions[1:] != positions[:-1]]).tolist() if positions.size else []
+    scans = scans.tolist()
+    for start, end in zip(starts, starts[1:] + [positions.size]):
+        i = spectra[start]
+        if used[i]:
+            continue
+        candidates = [j for j in partners[start:end] if not used[j]]
+        if candidates:
+            # The closest scan is taken instead of the closest precursor m/z, which would bias the errors
+            j = min(candidates, key=lambda j: abs(scans[j] - scans[i]))
+            used[i] = used[j] = True
+            pairs.append((i, j) if scans[i] < scans[j] else (j, i))
+    return pairs
+
+def pair_errors(pairs, precursor_mz, peaks):
+    """Precursor m/z differences (ppm) and fragment m/z differences (Th) of the nearest peaks of all pairs."""
+    precursor_errors = np.array([(precursor_mz[j] - precursor_mz[i]) / precursor_mz[i] * 1e6 for i, j in pairs])
+    fragment_errors = []
+    for i, j in pairs:
+        nearest = np.clip(np.searchsorted(peaks[j], peaks[i]), 1, len(peaks[j]) - 1)
+        left, right = peaks[j][nearest - 1], peaks[j][nearest]
+        differences = np.where(peaks[i] - left < right - peaks[i], left, right) - peaks[i]
+        fragment_errors.append(differences[np.abs(differences) <= MAX_FRAGMENT_TH])
+    fragment_errors = np.concatenate(fragment_errors) if fragment_errors else np.array([])
+    return precursor_errors, fragment_errors
+
+def fit_error_distribution(errors, max_error, iterations=200):
+    """Fits a Gaussian plus a uniform background on [-max_error, max_error] to the errors with EM.
+    Returns the mean and sigma of the Gaussian."""
+    errors = errors[np.abs(errors) <= max_error]
+    mu, sigma, weight = np.median(errors), max(np.std(errors) / 2, max_error * 1e-3), 0.5
+    background = 1 / (2 * max_error)
+    for _ in range(iterations):
+        gaussian = weight * np.exp(-0.5 * ((errors - mu) / sigma) ** 2) / (sigma * np.sqrt(2 * np.pi))
+        responsibility = gaussian / (gaussian + (1 - weight) * background)
+        total = responsibility.sum()
+        if total <= 0:
+            break
+        new_mu = (responsibility * errors).sum() / total
+        new_sigma = max(np.sqrt((responsibility * (errors - new_mu) ** 2).sum() / total), max_error * 1e-4)
+        weight = total / len(errors)
+        converged = abs(new_sigma - sigma) < 1e-6 * sigma and abs(new_mu - mu) < 1e-6 * sigma
+        mu, sigma = new_mu, new_sigma
+        if converged:
+            break
+    return mu, sigma
+
+def estimate_tolerances(mzml_path, max_spectra=MAX_SPECTRA):
+    """Estimates precursor (ppm) and fragment (Th) tolerances of an mzML file. Values that cannot be
+    estimated from at least MIN_PAIRS spectrum pairs are 'ERROR', as in param-medic."""
+    consumer = ToleranceConsumer(max_spectra)
+    oms.MzMLFile().transform(mzml_path.encode(), consumer)
+    pairs = pair_spectra(np.array(consumer.scans), np.array(consumer.precursor_mz), np.array(consumer.charges), consumer.peaks)
+    precursor_errors, fragment_errors = pair_errors(pairs, consumer.precursor_mz, consumer.peaks)
+
+    result = dict.fromkeys(COLUMNS, "ERROR")
+    if len(pairs) >= MIN_PAIRS:
+        _, sigma = fit_error_distribution(precursor_errors, MAX_PRECURSOR_PPM)
+        result["precursor_prediction_ppm"], result["precursor_sigma_ppm"] = sigma * PRECURSOR_SIGMA_MULTIPLIER, sigma
+    if len(fragment_errors) >= MIN_PAIRS:
+        _, sigma = fit_error_distribution(fragment_errors, MAX_FRAGMENT_TH)
+        result["fragment_prediction_th"], result["fragment_sigma_th"] = sigma * FRAGMENT_SIGMA_MULTIPLIER, sigma
+    print(f"Estimated tolerances of {os.path.basename(mzml_path)} from {len(pairs)} spectrum pairs: "
+          f"{format_value(result['precursor_prediction_ppm'])} ppm, {format_value(result['fragment_prediction_th'])} Th")
+    return result
+
+def format_value(value):
+    return value if value == "ERROR" else f"{value:.4f}"
+
+def tolerance_file_path(pred_dir, mzml_file):
+    return os.path.join(pred_dir, f"{mzml_file.split('.mzML')[0]}_params.txt")
+
+def write_tolerance_file(path, mzml_file, result):
+    """Writes the tolerances in param-medic's output format, atomically."""
+    values = [format_value(result[col]) for col in COLUMNS]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\t".join(["file"] + COLUMNS) + "\n")
+        f.write("\t".join([mzml_file] + values) + "\n")
+    os.replace(tmp_path, path)
+
+def estimate_file_tolerances(mzml_file, data_dir, pred_dir, max_spectra=MAX_SPECTRA):
+    """Estimates the tolerances of one mzML file and writes its tolerance file."""
+    os.makedirs(pred_dir, exist_ok=True)
+    result = estimate_tolerances(os.path.join(data_dir, mzml_file), max_spectra)
+    write_tolerance_file(tolerance_file_path(pred_dir, mzml_file), mzml_file, result)
+    return result
+
+def estimate_all_tolerances(data_dir, output_dir, max_workers=4, mzml_files=None, max_spectra=MAX_SPECTRA):
+    """Estimates the tolerances of all mzML files (or the given ones) without a tolerance file in parallel."""
+    pred_dir = os.path.join(output_dir, "tolerances")
+    if mzml_files is None:
+        mzml_files = [f for f in os.listdir(data_dir) if f.endswith(".mzML")]
+    missing = [f for f in mzml_files if not os.path.exists(tolerance_file_path(pred_dir, f))]
+    print(f"Tolerance estimation: {len(missing)} files to estimate, {len(mzml_files) - len(missing)} already estimated.")
+    if not missing:
+        return
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {f: executor.submit(estimate_file_tolerances, f, data_dir, pred_dir, max_spectra) for f in missing}
+        for f, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error estimating the tolerances of {f}: {e}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate precursor and fragment mass tolerances of mzML files without param-medic.")
+    parser.add_argument('--mzml_dir', type=str, required=True, help="Folder path containing mzML files.")
+    parser.add_argument('--output_dir', type=str, required=True, help="Directory where the tolerances folder will be stored.")
+    parser.add_argument('--files', type=str, nargs='*', help="Optional: Names of the mzML files to process (default: all mzML files in --mzml_dir).")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of files estimated at once (default: number of CPUs).")
+    parser.add_argument('--max_spectra', type=int, default=MAX_SPECTRA, help="Only use a block of this many spectra from the middle of every run.")
+    args = parser.parse_args()
+    estimate_all_tolerances(args.mzml_dir, args.output_dir, args.workers, args.files, args.max_spectra)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import pandas as pd
+
+# pyarrow is optional and only needed for the columnar feature store
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Columnar feature store: one Arrow IPC (or Parquet) part per mzML file in a directory, so adding
+# a file only writes its own part. Parts keep their dtypes, the organism columns missing in a part
+# are filled with nulls when the parts are loaded, and Arrow IPC parts are memory-mapped.
+# Every part stores a signature of its non-null features, so unchanged files are not written again.
+
+FORMATS = {"arrow": ".arrow", "parquet": ".parquet"}
+
+def record_signature(record):
+    """Hash of the non-null features of a file, columns that are null are the same as missing ones."""
+    values = {name: value for name, value in record.items() if not pd.isna(value)}
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+def record_table(record):
+    """Arrow table of a single record. Null columns get the null type, which is promoted to the type of
+    the column in the other parts, e.g. a missing software of one file would otherwise be a double."""
+    table = pa.Table.from_pandas(pd.DataFrame([record]), preserve_index=False)
+    for i, name in enumerate(table.column_names):
+        if table.column(i).null_count == len(table):
+            table = table.set_column(i, name, pa.nulls(len(table)))
+    return table.replace_schema_metadata({"signature": record_signature(record)})
+
+class FeatureStore:
+    """Directory of per-file feature parts in Arrow IPC or Parquet format."""
+
+    def __init__(self, store_dir, store_format="arrow"):
+        if pa is None:
+            raise ImportError("The feature store requires pyarrow. Install it with 'pip install pyarrow'.")
+        self.store_dir = store_dir
+        self.store_format = store_format
+        self.extension = FORMATS[store_format]
+        os.makedirs(store_dir, exist_ok=True)
+
+    def part_path(self, filename):
+        return os.path.join(self.store_dir, f"{filename}{self.extension}")
+
+    def filenames(self):
+        return sorted(f[:-len(self.extension)] for f in os.listdir(self.store_dir) if f.endswith(self.extension))
+
+    def append(self, record):
+        """Adds or replaces the features of a single file, given as a dict with its Filename."""
+        table = record_table(record)
+        path = self.part_path(record["Filename"])
+        tmp_path = f"{path}.tmp"
+        if self.store_format == "arrow":
+            # Uncompressed, so the part can be memory-mapped without copying
+            with pa.OSFile(tmp_path, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        else:
+            pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def remove(self, filename):
+        if os.path.exists(self.part_path(filename)):
+            os.remove(self.part_path(filename))
+
+    def signature(self, filename):
+        """Signature stored in the part of a file, None if there is no part or it has no signature."""
+        path = self.part_path(filename)
+        try:
+            if self.store_format == "arrow":
+                metadata = pa.ipc.open_file(pa.memory_map(path, "r")).schema.metadata
+            else:
+                metadata = pq.read_schema(path).metadata
+        except (OSError, pa.ArrowInvalid):
+            return None
+        return (metadata or {}).get(b"signature", b"").decode() or None
+
+    def update(self, df):
+        """Stores every row of a feature DataFrame as its own part and removes parts of files not in df.
+        Parts whose features did not change are kept."""
+        written = 0
+        for record in df.to_dict("records"):
+            if self.signature(record["Filename"]) != record_signature(record):
+                self.append(record)
+                written += 1
+        print(f"Feature store: {written} of {len(df)} parts written, the others are unchanged.")
+        for filename in set(self.filenames()) - set(df["Filename"]):
+            self.remove(filename)
+        # Parts of the other format are left over from runs with a different --feature_store
+        for f in os.listdir(self.store_dir):
+            if f.endswith(tuple(FORMATS.values())) and not f.endswith(self.extension):
+                os.remove(os.path.join(self.store_dir, f))
+
+    def read_part(self, filename):
+        if self.store_format == "arrow":
+            return pa.ipc.open_file(pa.memory_map(self.part_path(filename), "r")).read_all()
+        return pq.read_table(self.part_path(filename))
+
+    def table(self):
+        """Returns all parts as one Arrow table, columns missing in a part are null."""
+        tables = [self.read_part(filename) for filename in self.filenames()]
+        if not tables:
+            return pa.table({"Filename": pa.array([], pa.string())})
+        return pa.concat_tables(tables, promote_options="permissive").replace_schema_metadata(None)
+
+    def load(self):
+        return self.table().to_pandas()
+
+    def export_csv(self, csv_path):
+        self.load().to_csv(csv_path, index=False)
+        print(f"Feature store {self.store_dir} exported to {csv_path}")
+
+def read_features(feature_file):
+    """Reads the features from a feature store directory or a CSV file."""
+    if os.path.isdir(feature_file):
+        extension = next((ext for ext in FORMATS.values() if any(f.endswith(ext) for f in os.listdir(feature_file))), ".arrow")
+        store_format = next(name for name, ext in FORMATS.items() if ext == extension)
+        return FeatureStore(feature_file, store_format).load()
+    return pd.read_csv(feature_file)
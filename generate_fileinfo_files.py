@@ -1,7 +1,17 @@
 import os
 import subprocess
+import tempfile
+import numpy as np
+import pyopenms as oms
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from result_cache import open_cache
+from scan_mzml import software_name
+from create_feature_file import extract_fileinfo_record as extract_fileinfo_txt_record
 
-def generate_fileinfo(mzml_dir, output_dir):
+def generate_fileinfo(mzml_dir, output_dir, max_workers=4, timeout=None):
+    """Runs OpenMS FileInfo for all mzML files, with up to max_workers FileInfo processes at once.
+    A FileInfo run taking longer than timeout seconds is killed and the file is skipped."""
     # Set direction with mzML files
     data_dir = mzml_dir
 
@@ -14,25 +24,200 @@ def generate_fileinfo(mzml_dir, output_dir):
     # Read mzML files ending with '.mzML'
     mzml_files = [f for f in os.listdir(data_dir) if f.endswith('.mzML')]
 
-    # Process each mzML file
-    for mzml_file in mzml_files:
-        file_name = mzml_file.split('.mzML')[0]
-        fileinfo_file = f"{file_name}.txt"
-        
-        # Run Comet only if no corresponding fileinfo file exists
-        if not os.path.exists(os.path.join(fileinfo_dir, fileinfo_file)):
-
-            # Perform param search for file to receive adequate Comet results
-            cmd = ["FileInfo",
-                   "-in", os.path.join(data_dir, mzml_file), "-m", "-p", "-s", "-c",
-                   "-out", os.path.join(fileinfo_dir, fileinfo_file)
-            ]
-            
-            print(f"Running: {' '.join(cmd)}")
-            
-            try:
-                result = subprocess.run(cmd, check=True)
-            except subprocess.CalledProcessError:
-                print(f"Error processing {mzml_file}. Skipping to the next file.")
-        else:
-            print(f"Fileinfo file for {mzml_file} already exists. Skipping to the next file.")
+    # Process the mzML files in parallel, FileInfo runs as a subprocess so threads are sufficient
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda mzml_file: run_fileinfo(mzml_file, data_dir, fileinfo_dir, timeout), mzml_files))
+
+def run_fileinfo(mzml_file, data_dir, fileinfo_dir, timeout=None):
+    """Runs OpenMS FileInfo for a single mzML file unless its FileInfo file already exists.
+    The output is written to fileinfo_dir/tmp first and only moved to fileinfo_dir once FileInfo
+    succeeded, so a killed run never leaves a truncated FileInfo file that counts as done."""
+    file_name = mzml_file.split('.mzML')[0]
+    fileinfo_file = f"{file_name}.txt"
+    fileinfo_path = os.path.join(fileinfo_dir, fileinfo_file)
+
+    # Run FileInfo only if no corresponding fileinfo file exists
+    if not os.path.exists(fileinfo_path):
+
+        # FileInfo only accepts .txt output files, so the temporary file keeps its name in a subdirectory
+        tmp_dir = os.path.join(fileinfo_dir, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, fileinfo_file)
+
+        # Perform param search for file to receive adequate Comet results
+        cmd = ["FileInfo",
+               "-in", os.path.join(data_dir, mzml_file), "-m", "-p", "-s", "-c",
+               "-out", tmp_path
+        ]
+
+        print(f"Running: {' '.join(cmd)}")
+
+        try:
+            result = subprocess.run(cmd, check=True, timeout=timeout)
+            os.replace(tmp_path, fileinfo_path)
+        except subprocess.CalledProcessError:
+            print(f"Error processing {mzml_file}. Skipping to the next file.")
+        except subprocess.TimeoutExpired:
+            print(f"FileInfo for {mzml_file} took longer than {timeout} seconds and was stopped. Skipping to the next file.")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    else:
+        print(f"Fileinfo file for {mzml_file} already exists. Skipping to the next file.")
+
+def fileinfo_tool_record(mzml_file, data_dir, output_dir, timeout=None):
+    """Runs OpenMS FileInfo for a single mzML file and returns its features without keeping the FileInfo file,
+    None if FileInfo failed. The FileInfo file is written to a temporary directory in output_dir."""
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        run_fileinfo(mzml_file, data_dir, tmp_dir, timeout)
+        txt_path = os.path.join(tmp_dir, f"{mzml_file.split('.mzML')[0]}.txt")
+        return extract_fileinfo_txt_record(txt_path) if os.path.exists(txt_path) else None
+
+def fileinfo_tool_records(mzml_dir, output_dir, max_workers=4, timeout=None, use_hash=False):
+    """Runs OpenMS FileInfo for all new or changed mzML files and returns the feature records of all mzML files,
+    without keeping FileInfo files. Results are cached per mzML file."""
+    mzml_files = [f for f in os.listdir(mzml_dir) if f.endswith('.mzML')]
+    cache = open_cache(output_dir, "fileinfo_tool", use_hash)
+    records = {f: cache.get(os.path.join(mzml_dir, f)) for f in mzml_files}
+    missing = [f for f in mzml_files if records[f] is None]
+
+    if missing:
+        # FileInfo runs as a subprocess so threads are sufficient
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda f: fileinfo_tool_record(f, mzml_dir, output_dir, timeout), missing))
+        # Failed files (None) are not cached and retried on the next run
+        for f, record in zip(missing, results):
+            if record is not None:
+                cache.put(os.path.join(mzml_dir, f), record)
+                records[f] = record
+        cache.save()
+    print(f"FileInfo features: {len(missing)} new or changed files processed, {len(mzml_files) - len(missing)} taken from cache.")
+
+    return [records[f] for f in mzml_files if records[f] is not None]
+
+# === IN-PROCESS FILEINFO WITH PYOPENMS ===
+
+activation_short_names = oms.Precursor().getAllShortNamesOfActivationMethods()
+activation_names = oms.Precursor().getAllNamesOfActivationMethods()
+
+class FileInfoConsumer:
+    """Consumer for MzMLFile().transform that collects the FileInfo statistics while the spectra
+    are streamed, so the experiment is never loaded as a whole."""
+
+    def __init__(self):
+        self.meta = None
+        self.num_spectra = 0
+        self.total_peaks = 0
+        self.rt = [np.inf, -np.inf]
+        self.mz = [np.inf, -np.inf]
+        self.intensity = [np.inf, -np.inf]
+        self.charges = Counter()
+        self.activations = Counter()
+        self.software_names = []
+
+    def setExpectedSize(self, num_spectra, num_chromatograms):
+        pass
+
+    def setExperimentalSettings(self, settings):
+        self.meta = settings
+
+    def consumeChromatogram(self, chromatogram):
+        pass
+
+    def consumeSpectrum(self, spectrum):
+        self.num_spectra += 1
+        rt = spectrum.getRT()
+        self.rt = [min(self.rt[0], rt), max(self.rt[1], rt)]
+
+        mz, intensity = spectrum.get_peaks()
+        if mz.size:
+            self.total_peaks += mz.size
+            self.mz = [min(self.mz[0], mz.min()), max(self.mz[1], mz.max())]
+            self.intensity = [min(self.intensity[0], intensity.min()), max(self.intensity[1], intensity.max())]
+
+        precursors = spectrum.getPrecursors()
+        if precursors:
+            methods = set()
+            for precursor in precursors:
+                self.charges[precursor.getCharge()] += 1
+                # Older pyopenms versions return the enum values as plain ints
+                methods.update(getattr(m, "value", m) for m in precursor.getActivationMethods())
+            self.activations[(spectrum.getMSLevel(), tuple(sorted(methods)))] += 1
+
+        if not any(self.software_names):
+            self.software_names = [dp.getSoftware().getName() for dp in spectrum.getDataProcessing()]
+
+def extract_fileinfo_features(mzml_path):
+    """Computes the features create_feature_file.extract_features_from_txt reads from the FileInfo
+    output directly with pyopenms and returns them as a dict."""
+    features = {
+        "instrument_model": "Not available",
+        "organism": "Not available",
+        "tissue": "Not available",
+        "disease": "Not available",
+        "software": "Not available",
+        "activation_method": "Not available",
+        "experiment_type": "Not available",
+        "fraction_identifier": "Not available",
+        "quantification_method": "Not available",
+        "cleavage_agent": "Not available",
+    }
+
+    consumer = FileInfoConsumer()
+    oms.MzMLFile().transform(mzml_path.encode(), consumer)
+
+    if consumer.meta is not None:
+        instrument = consumer.meta.getInstrument()
+        if instrument.getName():
+            features["instrument_model"] = instrument.getName()
+        features["software"] = software_name(consumer.software_names, instrument.getSoftware().getName())
+
+    # Activation method: first entry of the FileInfo activation method listing
+    if consumer.activations:
+        ms_level, methods = min(consumer.activations)
+        if methods:
+            features["activation_method"] = ", ".join(f"{activation_short_names[m]} ({activation_names[m]})" for m in methods)
+
+    if consumer.num_spectra:
+        features["rt_min"], features["rt_max"] = float(consumer.rt[0]), float(consumer.rt[1])
+    if consumer.total_peaks:
+        features["mz_min"], features["mz_max"] = float(consumer.mz[0]), float(consumer.mz[1])
+        features["intensity_min"], features["intensity_max"] = float(consumer.intensity[0]), float(consumer.intensity[1])
+    for charge in sorted(consumer.charges):
+        features[f"precursor_charge_{charge}"] = consumer.charges[charge]
+    features["total_peaks"] = consumer.total_peaks
+    features["num_spectra"] = consumer.num_spectra
+
+    return features
+
+def extract_fileinfo_record(mzml_file, data_dir):
+    """Returns the pyopenms FileInfo features of a single mzML file including its file name, None on errors."""
+    print(f"Extracting FileInfo features of {mzml_file}")
+    try:
+        features = extract_fileinfo_features(os.path.join(data_dir, mzml_file))
+    except Exception as e:
+        print(f"Error processing {mzml_file}: {e}")
+        return None
+    features["Filename"] = mzml_file
+    return features
+
+def extract_fileinfo_records(mzml_dir, output_dir, max_workers=4, use_hash=False):
+    """Extracts the FileInfo features of all new or changed mzML files in parallel with pyopenms
+    and returns the feature records of all mzML files. Results are cached per mzML file."""
+    mzml_files = [f for f in os.listdir(mzml_dir) if f.endswith('.mzML')]
+    cache = open_cache(output_dir, "pyopenms_fileinfo", use_hash)
+    records = {f: cache.get(os.path.join(mzml_dir, f)) for f in mzml_files}
+    missing = [f for f in mzml_files if records[f] is None]
+
+    if missing:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(extract_fileinfo_record, missing, [mzml_dir]*len(missing)))
+        # Failed files (None) are not cached and retried on the next run
+        for f, record in zip(missing, results):
+            if record is not None:
+                cache.put(os.path.join(mzml_dir, f), record)
+                records[f] = record
+        cache.save()
+    print(f"FileInfo features: {len(missing)} new or changed files processed, {len(mzml_files) - len(missing)} taken from cache.")
+
+    return [records[f] for f in mzml_files if records[f] is not None]
@@ -1,25 +1,73 @@
 ### Infer Missing Metadata from Proteomics Data Using Machine Learning and Database Search
 
 import os
+import json
 import argparse
+import time
 import subprocess
-from generate_fileinfo_files import generate_fileinfo
-from parse_keywords import parse_keywords
-from create_parameter_files import create_parameter_files
-from run_comet_adapter import run_comet_adapter  
-from create_feature_file import create_feature_file
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from generate_fileinfo_files import generate_fileinfo, run_fileinfo, extract_fileinfo_record, extract_fileinfo_records, fileinfo_tool_record, fileinfo_tool_records
+from parse_keywords import parse_keywords, open_keyword_cache, parse_file_keywords, keywords
+from scan_mzml import scan_mzml_file, scan_mzml_files, write_keyword_results, cached_scan, scan_cache_name
+from create_parameter_files import create_parameter_files, create_parameter_file
+from run_comet_adapter import run_comet_adapter, run_comet_search, comet_threads, CoreBudget
+from tiered_database import TieredDatabase
+from comet_index import CometIndex
+from peptide_mass_index import PeptideMassIndex, prescreen_file, prescreen_all_files, prescreen_path
+from estimate_tolerances import estimate_file_tolerances, estimate_all_tolerances, tolerance_file_path
+from create_feature_file import create_feature_file, extract_file_features, open_feature_caches
+from result_cache import open_cache
 from ml_prediction import ml_prediction
 from metadata_file_creation import metadata_file_creation
+from prediction_server import remote_prediction
+from feature_store import read_features
+from work_claims import WorkClaims
 
 # Set up the argument parser for input and output directories
-def parse_arguments():
+def build_parser():
     parser = argparse.ArgumentParser(description="Infer missing metadata from proteomics data using ML and database search.")
     parser.add_argument('--mzml_dir', type=str, required=True, help="Folder path containing mzML files.")
     parser.add_argument('--output_dir', type=str, required=True, help="Directory where the metadata CSV will be stored.")
     parser.add_argument('--idxml_dir', type=str, help="Optional: Folder path for protein/peptide identification files (idXML).")
     parser.add_argument('--database', type=str, help="Path to the protein database (e.g., SwissProt) for peptide identification.")
     parser.add_argument('--comet_exe', type=str, help="Path to the Comet executable (comet.exe) for peptide identification.")
-    return parser.parse_args()
+    parser.add_argument('--fileinfo_backend', choices=["fileinfo", "scan", "pyopenms"], default="fileinfo", help="How FileInfo features are extracted: with the OpenMS FileInfo tool, together with the keywords in a single pass over each mzML file (scan), or in-process with pyopenms.")
+    parser.add_argument('--keyword_header_only', action='store_true', help="Search keywords only in the mzML metadata and skip the base64 encoded peak data.")
+    parser.add_argument('--fileinfo_timeout', type=float, help="Optional: Maximum number of seconds a single FileInfo run may take.")
+    parser.add_argument('--cache_hash', action='store_true', help="Compare content hashes of files whose modification time changed before processing them again.")
+    parser.add_argument('--sequential', action='store_true', help="Run every step for all files before starting the next step instead of running per-file chains concurrently.")
+    parser.add_argument('--light_workers', type=int, default=4, help="Maximum number of light steps (FileInfo, keyword parsing, parameter files, feature extraction) running at once.")
+    parser.add_argument('--heavy_workers', type=int, default=2, help="Maximum number of CPU-heavy steps (CometAdapter) running at once.")
+    parser.add_argument('--comet_cores', type=int, help="Optional: Number of cores shared by all concurrent CometAdapter jobs (default: all cores).")
+    parser.add_argument('--comet_max_threads', type=int, default=16, help="Maximum number of threads of a single CometAdapter job.")
+    parser.add_argument('--comet_sample_fraction', type=float, help="Optional: Search only this fraction of the MS2 spectra (stratified by TIC, precursor charge and RT) with CometAdapter.")
+    parser.add_argument('--comet_min_sample_spectra', type=int, default=500, help="Minimum number of MS2 spectra searched with --comet_sample_fraction.")
+    parser.add_argument('--comet_adaptive_batch', type=int, help="Optional: Search the MS2 spectra in random batches, starting with this many spectra and doubling the batch size, until the share of the leading organism is stable.")
+    parser.add_argument('--comet_adaptive_tolerance', type=float, default=0.05, help="Half width of the 95%% Wilson interval of the leading organism's share at which --comet_adaptive_batch stops searching.")
+    parser.add_argument('--feature_store', choices=["arrow", "parquet"], help="Optional: Store the extracted features in a columnar feature store (requires pyarrow) instead of extracted_features.csv.")
+    parser.add_argument('--export_csv', action='store_true', help="Also write extracted_features.csv when --feature_store is used.")
+    parser.add_argument('--prediction_server', type=str, help="Optional: URL of a running prediction server (e.g. http://127.0.0.1:8765) to use instead of loading the models.")
+    parser.add_argument('--tiered_search', action='store_true', help="Search a reduced database of organism-specific proteins first and the full proteomes of the leading organisms only if the result is ambiguous.")
+    parser.add_argument('--tiered_top_organisms', type=int, default=10, help="Number of organisms whose full proteomes are part of the first stage of --tiered_search.")
+    parser.add_argument('--tiered_min_share', type=float, default=0.8, help="Share of hits the leading organism needs in the first stage of --tiered_search to skip the second stage.")
+    parser.add_argument('--comet_index', action='store_true', help="Search against a Comet peptide index that is built once per database and digestion settings instead of the FASTA file (requires Comet with peptide index support).")
+    parser.add_argument('--comet_index_dir', type=str, help="Optional: Directory caching the Comet peptide indices, e.g. shared by several output directories (default: <output_dir>/comet_index).")
+    parser.add_argument('--prescreen', action='store_true', help="Estimate the organism hits of every file from its precursor masses and a cached peptide mass index of --database first. Files with a conclusive pre-screen are only searched against the full proteome of the leading organism, or not at all with --prescreen_hit_scale.")
+    parser.add_argument('--prescreen_tolerance_ppm', type=float, default=10, help="Precursor mass tolerance of the --prescreen matches in ppm.")
+    parser.add_argument('--prescreen_min_share', type=float, default=0.8, help="Share of the pre-screen hits the leading organism needs for a conclusive --prescreen.")
+    parser.add_argument('--prescreen_hit_scale', type=float, default=None, help="Skip the search of files with a conclusive --prescreen and fill their _counthits features with the pre-screen hits multiplied by this factor.")
+    parser.add_argument('--tolerance_backend', choices=["param-medic", "native"], default="param-medic", help="How precursor and fragment mass tolerances are estimated: with param-medic in Docker, or in-process per file (native).")
+    parser.add_argument('--run_param_medic', action='store_true', help="Run param-medic in Docker for the mzML files without tolerances file. Otherwise, the param-medic tolerance backend only uses the tolerances files of earlier runs and the default tolerances.")
+    parser.add_argument('--distributed', action='store_true', help="Share the per-file work with other workers running on the same --output_dir (e.g. on other nodes of a cluster with a shared filesystem).")
+    parser.add_argument('--lease_seconds', type=float, default=600, help="A file claimed with --distributed is claimed again by another worker if its lease was not renewed for this many seconds.")
+    # The command line always writes the intermediate CSV files, the Pipeline API can switch them off
+    parser.set_defaults(write_intermediate=True)
+    return parser
+
+def parse_arguments(argv=None):
+    return build_parser().parse_args(argv)
 
 # Check if mzML files exist in the specified directory
 def check_mzml_files(mzml_dir):
@@ -54,64 +102,504 @@ def create_directories(output_dir, idxml_dir=None):
             os.makedirs(idxml_dir)
             print(f"Created default idXML directory in {output_dir}: {idxml_dir}")
 
-def run_param_medic(mzml_dir, output_dir):
-    """ Runs Docker-Container script for param-medic """
+PARAM_MEDIC_IMAGE = "predict_tolerances_container"
+
+@lru_cache(maxsize=None)
+def param_medic_batch_options(image=PARAM_MEDIC_IMAGE):
+    """True if the param-medic image accepts --workers and --files. Images built before these options
+    (e.g. the published elisamaske/predict_tolerances_container) reject them."""
+    result = subprocess.run(["docker", "run", "--rm", image, "--help"], capture_output=True, text=True)
+    return "--workers" in result.stdout
+
+def run_param_medic(mzml_dir, output_dir, workers=None, files=None):
+    """ Runs Docker-Container script for param-medic for the mzML files (or the given files) without
+    a tolerances file, with up to workers (default: all CPUs) param-medic runs at once """
+    if files is None:
+        files = [f for f in sorted(os.listdir(mzml_dir)) if f.endswith('.mzML')]
+    mzml_files = [f for f in files if not os.path.exists(os.path.join(output_dir, "tolerances", f"{f.split('.mz')[0]}_params.txt"))]
+    if not mzml_files:
+        print("Tolerances of all mzML files already exist. Skipping param-medic.")
+        return
+
     docker_cmd = [
         "docker", "run", "--rm",
         "-v", f"{os.path.abspath(mzml_dir)}:/app/mzml",
         "-v", f"{os.path.abspath(output_dir)}:/app/output",
-        "predict_tolerances_container",  # name of Docker image
+        PARAM_MEDIC_IMAGE,  # name of Docker image
         "--mzml_dir", "/app/mzml",
-        "--output_dir", "/app/output"
+        "--output_dir", "/app/output",
     ]
-    
+    if param_medic_batch_options():
+        docker_cmd += ["--workers", str(workers or os.cpu_count() or 1), "--files", *mzml_files]
+    else:
+        print(f"Warning: The {PARAM_MEDIC_IMAGE} image does not support --workers and --files, so param-medic runs "
+              f"for all mzML files without tolerances file one at a time. Build the image from docker_py27/, see README.md.")
+
     print("Running param-medic in Docker:")
     print(" ".join(docker_cmd))
     
     subprocess.run(docker_cmd, check=True)
 
-def main():
-    args = parse_arguments()
-    
+class ParamMedicBatches:
+    """Runs param-medic for the files of concurrent chains. A chain reaching its param-medic step while no
+    container runs starts one container for all files waiting at that moment, so every container uses its
+    pool of param-medic runs instead of starting one container per file."""
+
+    def __init__(self, mzml_dir, output_dir, workers=None):
+        self.mzml_dir = mzml_dir
+        self.output_dir = output_dir
+        self.workers = workers
+        self.pending = []
+        self.finished = set()
+        self.running = False
+        self.condition = threading.Condition()
+
+    def run(self, mzml_file):
+        with self.condition:
+            self.pending.append(mzml_file)
+            self.condition.wait_for(lambda: mzml_file in self.finished or not self.running)
+            if mzml_file in self.finished:
+                self.finished.discard(mzml_file)
+                return
+            batch, self.pending, self.running = self.pending, [], True
+        try:
+            run_param_medic(self.mzml_dir, self.output_dir, self.workers, batch)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Without Docker or param-medic, the parameter files fall back to the default tolerances
+            print(f"Warning: param-medic failed for {', '.join(batch)} ({e}). Using the default tolerances.")
+        finally:
+            with self.condition:
+                self.finished.update(file for file in batch if file != mzml_file)
+                self.running = False
+                self.condition.notify_all()
+
+def run_file_chains(mzml_files, steps, light_workers, heavy_workers, claims=None):
+    """Runs a chain of steps for every mzML file, with the chains of different files running concurrently.
+    Each step is a (name, resource, function) tuple, where resource is either "light" or "heavy" and
+    limits how many steps of that kind run at once. Returns the result of the last step per file.
+    With WorkClaims, a chain only runs if its file can be claimed and stores its result as done
+    (or the file as failed, if a step failed), and at most light_workers + heavy_workers files are claimed at once."""
+    limits = {"light": threading.Semaphore(light_workers), "heavy": threading.Semaphore(heavy_workers)}
+
+    def run_steps(mzml_file):
+        result = None
+        for name, resource, func in steps:
+            with limits[resource]:
+                try:
+                    result = func(mzml_file)
+                except Exception as e:
+                    print(f"Error in step '{name}' for {mzml_file}: {e}. Skipping the remaining steps for this file.")
+                    return None
+        return result
+
+    def run_chain(mzml_file):
+        if claims is None:
+            return run_steps(mzml_file)
+        if not claims.claim(mzml_file):
+            return None
+        try:
+            result = run_steps(mzml_file)
+        except BaseException:
+            claims.release(mzml_file)
+            raise
+        # A failed file is not stored as done, so it is retried once its failure expired
+        if result is None:
+            claims.fail(mzml_file)
+        else:
+            claims.complete(mzml_file, result)
+        return result
+
+    # Chains spend most of their time waiting for a free slot, so one thread per file is cheap.
+    # Claimed files are taken one at a time per thread, so the other workers get their share.
+    max_workers = light_workers + heavy_workers if claims is not None else len(mzml_files)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = list(executor.map(run_chain, mzml_files))
+    return dict(zip(mzml_files, results))
+
+def open_tiered_database(args):
+    """Returns the cached reduced databases of the two-stage search if --tiered_search is set, building the stage one database."""
+    if not args.tiered_search:
+        return None
+    databases = TieredDatabase(args.database, os.path.join(args.output_dir, "databases"),
+                               args.tiered_top_organisms, args.tiered_min_share)
+    databases.stage_one()
+    return databases
+
+def open_prescreen_databases(args):
+    """Returns the reduced databases the search of files with a conclusive --prescreen is narrowed to. Without
+    --tiered_search, their stage one database is never built."""
+    if not args.prescreen or args.tiered_search:
+        return None
+    return TieredDatabase(args.database, os.path.join(args.output_dir, "databases"))
+
+def open_comet_index(args):
+    """Returns the cache of Comet peptide indices if --comet_index or --comet_adaptive_batch is set. Every adaptive
+    batch is a search of its own, so without an index every batch would digest the whole database again."""
+    if not (args.comet_index or args.comet_adaptive_batch):
+        return None
+    if not args.comet_index:
+        print("The batches of --comet_adaptive_batch are searched against a Comet peptide index of the database, "
+              "unless it cannot be built.")
+    return CometIndex(args.comet_exe, args.comet_index_dir or os.path.join(args.output_dir, "comet_index"),
+                      required=args.comet_index)
+
+def open_prescreen_index(args):
+    """Returns the directory of the cached peptide mass index if --prescreen is set, building the index."""
+    if not args.prescreen:
+        return None
+    if not (args.database and os.path.exists(args.database)):
+        print("Warning: Database not provided or not found. Skipping the pre-screen.")
+        return None
+    return PeptideMassIndex(args.database, os.path.join(args.output_dir, "databases")).path()
+
+def build_file_steps(args, idxml_dir, extract_pool=None):
+    """Builds the per-file chain generate_fileinfo -> create_parameter_files -> run_comet_adapter -> feature extraction.
+    With the scan or pyopenms FileInfo backend, the FileInfo features are extracted in-process in the extract_pool.
+    Without write_intermediate, the FileInfo files of the fileinfo backend are removed once their features are extracted.
+    Also returns the keyword records of the scan backend and the per-file result caches used by the steps,
+    which have to be saved after the run."""
+    fileinfo_dir = os.path.join(args.output_dir, "fileinfo")
+    pred_dir = os.path.join(args.output_dir, "tolerances")
+    param_dir = os.path.join(args.output_dir, "param_files")
+    prot_id_dir = os.path.join(args.output_dir, "idxml")
+    for directory in [fileinfo_dir, param_dir, prot_id_dir]:
+        os.makedirs(directory, exist_ok=True)
+
+    extracted = {}
+    keyword_records = {}
+    extract_cache_names = {"scan": scan_cache_name, "pyopenms": "pyopenms_fileinfo", "fileinfo": "fileinfo_tool"}
+    extract_cache = open_cache(args.output_dir, extract_cache_names[args.fileinfo_backend], args.cache_hash)
+    fileinfo_cache, idxml_cache = open_feature_caches(args.output_dir, args.cache_hash)
+    comet_budget = CoreBudget(args.comet_cores or os.cpu_count() or 1)
+
+    def extract_step(mzml_file):
+        mzml_path = os.path.join(args.mzml_dir, mzml_file)
+        if args.fileinfo_backend == "scan":
+            result = cached_scan(extract_cache, args.mzml_dir, mzml_file, keywords)
+        else:
+            result = extract_cache.get(mzml_path)
+        if result is None:
+            # Extraction is CPU-bound, so it runs in a process pool instead of the chain's thread
+            if args.fileinfo_backend == "scan":
+                result = extract_pool.submit(scan_mzml_file, mzml_file, args.mzml_dir, keywords).result()
+            else:
+                result = extract_pool.submit(extract_fileinfo_record, mzml_file, args.mzml_dir).result()
+            if result is None:
+                raise RuntimeError("FileInfo feature extraction failed")
+            extract_cache.put(mzml_path, result)
+        if args.fileinfo_backend == "scan":
+            extracted[mzml_file], keyword_records[mzml_file] = result
+        else:
+            extracted[mzml_file] = result
+
+    def fileinfo_step(mzml_file):
+        mzml_path = os.path.join(args.mzml_dir, mzml_file)
+        result = extract_cache.get(mzml_path)
+        if result is None:
+            result = fileinfo_tool_record(mzml_file, args.mzml_dir, fileinfo_dir, args.fileinfo_timeout)
+            if result is None:
+                return
+            extract_cache.put(mzml_path, result)
+        extracted[mzml_file] = result
+
+    def tolerance_step(mzml_file):
+        if os.path.exists(tolerance_file_path(pred_dir, mzml_file)):
+            return
+        # Estimation is CPU-bound, so it runs in the process pool if there is one
+        if extract_pool is not None:
+            extract_pool.submit(estimate_file_tolerances, mzml_file, args.mzml_dir, pred_dir).result()
+        else:
+            estimate_file_tolerances(mzml_file, args.mzml_dir, pred_dir)
+
+    def prescreen_step(mzml_file):
+        # The pre-screen results are stored with the idXML files the features are extracted from
+        idxml_path = os.path.join(idxml_dir, f"{mzml_file.split('.mzML')[0]}_CometAdapter.idXML")
+        if os.path.exists(idxml_path) or os.path.exists(prescreen_path(idxml_path)):
+            return
+        # The pre-screen reads the whole file, so it runs in the process pool if there is one
+        if extract_pool is not None:
+            extract_pool.submit(prescreen_file, mzml_file, args.mzml_dir, idxml_dir, prescreen_index,
+                                args.prescreen_tolerance_ppm).result()
+        else:
+            prescreen_file(mzml_file, args.mzml_dir, idxml_dir, prescreen_index, args.prescreen_tolerance_ppm)
+
+    def parameter_file_step(mzml_file):
+        fileinfo_features = extracted.get(mzml_file)
+        create_parameter_file(tolerance_file_path(pred_dir, mzml_file), param_dir, fileinfo_dir, fileinfo_features)
+
+    def comet_step(mzml_file):
+        num_spectra = extracted.get(mzml_file, {}).get("num_spectra")
+        threads = comet_threads(os.path.join(args.mzml_dir, mzml_file), num_spectra, args.comet_max_threads)
+        run_comet_search(mzml_file, args.mzml_dir, param_dir, prot_id_dir, args.database, args.comet_exe,
+                         threads, comet_budget, os.path.join(args.output_dir, "comet_jobs.tsv"),
+                         args.comet_sample_fraction, args.comet_min_sample_spectra, databases, comet_index,
+                         args.comet_adaptive_batch, args.comet_adaptive_tolerance,
+                         args.prescreen_min_share if prescreen_index else None, args.prescreen_hit_scale, prescreen_databases,
+                         idxml_dir)
+
+    def feature_step(mzml_file):
+        fileinfo_record, idxml_record = extract_file_features(mzml_file, fileinfo_dir, idxml_dir, fileinfo_cache, idxml_cache, args.prescreen_hit_scale)
+        if mzml_file in extracted:
+            fileinfo_record = extracted[mzml_file]
+        return fileinfo_record, idxml_record
+
+    if extract_pool is not None:
+        steps = [("in-process FileInfo", "light", extract_step)]
+    elif args.write_intermediate:
+        steps = [("fileinfo", "light", lambda f: run_fileinfo(f, args.mzml_dir, fileinfo_dir, args.fileinfo_timeout))]
+    else:
+        steps = [("fileinfo", "light", fileinfo_step)]
+    if args.tolerance_backend == "native":
+        steps.append(("tolerance estimation", "light", tolerance_step))
+    elif args.run_param_medic:
+        # The files of concurrent chains share param-medic containers
+        steps.append(("param-medic", "light", ParamMedicBatches(args.mzml_dir, args.output_dir, args.light_workers).run))
+    prescreen_index = open_prescreen_index(args)
+    if prescreen_index:
+        steps.append(("pre-screen", "light", prescreen_step))
+    steps.append(("parameter file", "light", parameter_file_step))
+    if args.database and os.path.exists(args.database) and args.comet_exe and os.path.exists(args.comet_exe):
+        databases = open_tiered_database(args)
+        prescreen_databases = open_prescreen_databases(args)
+        comet_index = open_comet_index(args)
+        steps.append(("CometAdapter", "heavy", comet_step))
+    else:
+        print("Warning: Database or Comet executable not provided or not found. Skipping peptide identification.")
+    steps.append(("feature extraction", "light", feature_step))
+    return steps, keyword_records, [extract_cache, fileinfo_cache, idxml_cache]
+
+def run_feature_generation(args, finish=None):
+    """Runs steps 1-6 for all mzML files and returns the extracted features as a DataFrame.
+    finish is called with the features before returning, with --distributed while this worker still
+    holds the feature file claim, so the run only counts as complete once finish succeeded."""
     # Check for mzML files in the mzML folder
     mzml_files = check_mzml_files(args.mzml_dir)
     
     # Create necessary directories for output and idXML files
     create_directories(args.output_dir, args.idxml_dir)
 
+    if args.idxml_dir:
+        idxml_dir = args.idxml_dir
+    else: 
+        idxml_dir = os.path.join(args.output_dir, "idxml")
+
+    if args.distributed:
+        return run_steps_distributed(args, mzml_files, idxml_dir, finish)
+    if args.sequential:
+        features = run_steps_sequentially(args, idxml_dir)
+    else:
+        features = run_steps_per_file(args, mzml_files, idxml_dir)
+    if finish is not None:
+        finish(features)
+    return features
+
+def run_prediction(args):
+    # === ML PREDICTIONS === 
+
+    # Predict metadata based on extracted features using Random Forest Classifier
+    # Uses pretrained ML models for prediction (stored as pkl files). 
+    # Stores predictions incl. estimated accuracy as .csv files
+    print(f"[7/7] Predicting metadata...")
+    feature_file = os.path.join(args.output_dir, "feature_store" if args.feature_store else "extracted_features.csv")
+    if args.prediction_server:
+        remote_prediction(args.prediction_server, args.output_dir, read_features(feature_file))
+    else:
+        ml_prediction(args.output_dir, feature_file)
+        metadata_file_creation(args.output_dir)
+    print(f"Metadata inference completed. Results stored as predicted_metadata.csv in {args.output_dir}")
+
+def main():
+    args = parse_arguments()
+    if run_feature_generation(args, lambda features: run_prediction(args)) is None:
+        print("The feature file is created by another worker, which also predicts the metadata.")
+
+def run_steps_per_file(args, mzml_files, idxml_dir):
+    """Runs feature generation as one chain of steps per mzML file, with the chains running concurrently.
+    Returns the features of all files as a DataFrame."""
+
+    # === FEATURE GENERATION (PER-FILE CHAINS) ===
+
+    # 3. The native tolerance estimation and, with --run_param_medic, param-medic run per file in the chains.
+
+    # 1., 4., 5. and 6. run as one chain per mzML file, so a slow file does not hold up the others.
+    # Keyword parsing (2.) does not depend on any other step and runs alongside the chains, unless
+    # the single-pass scanner covers FileInfo and keywords together.
+    print(f"[1-6/7] Running FileInfo, parameter files, CometAdapter and feature extraction per file "
+          f"({args.light_workers} light / {args.heavy_workers} heavy workers)...")
+    if args.fileinfo_backend == "scan":
+        with ProcessPoolExecutor(max_workers=args.light_workers) as extract_pool:
+            steps, keyword_records, caches = build_file_steps(args, idxml_dir, extract_pool)
+            chain_results = run_file_chains(mzml_files, steps, args.light_workers, args.heavy_workers)
+        if args.write_intermediate:
+            write_keyword_results([keyword_records[f] for f in mzml_files if f in keyword_records], args.output_dir)
+    else:
+        extract_pool = ProcessPoolExecutor(max_workers=args.light_workers) if args.fileinfo_backend == "pyopenms" else None
+        steps, _, caches = build_file_steps(args, idxml_dir, extract_pool)
+        with ThreadPoolExecutor(max_workers=1) as keyword_executor:
+            keyword_future = keyword_executor.submit(parse_keywords, args.mzml_dir, args.output_dir,
+                                                     args.light_workers, args.keyword_header_only, args.cache_hash,
+                                                     args.write_intermediate)
+            chain_results = run_file_chains(mzml_files, steps, args.light_workers, args.heavy_workers)
+            keyword_future.result()
+        if extract_pool is not None:
+            extract_pool.shutdown()
+    for cache in caches:
+        cache.save()
+
+    fileinfo_records, idxml_records = [], []
+    for mzml_file in mzml_files:
+        if chain_results[mzml_file] is None:
+            continue
+        fileinfo_record, idxml_record = chain_results[mzml_file]
+        if fileinfo_record is not None:
+            fileinfo_records.append(fileinfo_record)
+        if idxml_record is not None:
+            idxml_records.append(idxml_record)
+    return create_feature_file(idxml_dir, args.output_dir, fileinfo_records, idxml_records,
+                               feature_store=args.feature_store, export_csv=args.export_csv,
+                               write_files=args.write_intermediate)
+
+def run_steps_distributed(args, mzml_files, idxml_dir, finish=None):
+    """Runs the per-file chains only for the files this worker claims in output_dir/claims, so several
+    workers on different hosts can share one output directory. Files of workers that stopped renewing
+    their leases are claimed again. The first worker to find all files done creates the feature file
+    from the stored results, calls finish with it and returns the features. The other workers of the
+    same run return None."""
+    claims = WorkClaims(os.path.join(args.output_dir, "claims"), args.mzml_dir, args.lease_seconds)
+    # Compared with the modification time of the inputs file, so it is taken from the shared filesystem
+    start_time = claims.filesystem_time()
+    print(f"[1-6/7] Running the per-file steps for the files claimed by worker {claims.owner} "
+          f"({args.light_workers} light / {args.heavy_workers} heavy workers)...")
+    extract_pool = ProcessPoolExecutor(max_workers=args.light_workers) if args.fileinfo_backend != "fileinfo" else None
+    steps, keyword_records, caches = build_file_steps(args, idxml_dir, extract_pool)
+    # Keywords are parsed per claimed file as well, with the cache of parse_keywords, and stored with its features
+    if args.fileinfo_backend != "scan":
+        keyword_cache = open_keyword_cache(args.output_dir, args.keyword_header_only, args.cache_hash)
+        caches.append(keyword_cache)
+
+        def keyword_step(mzml_file):
+            keyword_records[mzml_file] = parse_file_keywords(mzml_file, args.mzml_dir, keyword_cache, args.keyword_header_only)
+        steps.insert(0, ("keyword parsing", "light", keyword_step))
+    name, resource, feature_step = steps[-1]
+    steps[-1] = (name, resource, lambda f: {"features": feature_step(f), "keywords": keyword_records.get(f)})
+
+    try:
+        pending = mzml_files
+        while True:
+            run_file_chains(pending, steps, args.light_workers, args.heavy_workers, claims)
+            for cache in caches:
+                cache.save()
+            # Files that failed recently are left out, as in the other modes
+            pending = [f for f in mzml_files if not claims.is_done(f) and not claims.has_failed(f)]
+            if not pending:
+                break
+            print(f"Waiting for {len(pending)} files processed by other workers...")
+            time.sleep(min(60, args.lease_seconds / 3))
+
+        # Only one worker creates the feature file, unless another worker of this run completed it
+        # for the same inputs already. The inputs are recorded only after finish, so a worker that
+        # died or failed before the metadata was written leaves the feature file to the next worker.
+        if not claims.claim("feature_file"):
+            return None
+        inputs = [[f, claims.signature(f)] for f in sorted(mzml_files)]
+        inputs_file = os.path.join(args.output_dir, "claims", "feature_file_inputs.json")
+        if os.path.exists(inputs_file) and os.path.getmtime(inputs_file) >= start_time:
+            with open(inputs_file, "r") as f:
+                if json.load(f) == inputs:
+                    return None
+        records = [claims.record(f) for f in mzml_files]
+        fileinfo_records = [r["features"][0] for r in records if r and r["features"] and r["features"][0] is not None]
+        idxml_records = [r["features"][1] for r in records if r and r["features"] and r["features"][1] is not None]
+        # Done files of older runs may still hold the byte counts of the keyword parser
+        if args.write_intermediate:
+            write_keyword_results([{key: value for key, value in r["keywords"].items() if not key.startswith("bytes_")}
+                                   for r in records if r and r["keywords"]], args.output_dir)
+        features = create_feature_file(idxml_dir, args.output_dir, fileinfo_records, idxml_records,
+                                       feature_store=args.feature_store, export_csv=args.export_csv,
+                                       write_files=args.write_intermediate)
+        if finish is not None:
+            finish(features)
+        with open(f"{inputs_file}.tmp", "w") as f:
+            json.dump(inputs, f)
+        os.replace(f"{inputs_file}.tmp", inputs_file)
+        return features
+    finally:
+        claims.close()
+        if extract_pool is not None:
+            extract_pool.shutdown()
+
+def run_steps_sequentially(args, idxml_dir):
+    """Runs feature generation step by step, every step processing all files before the next one starts.
+    Returns the features of all files as a DataFrame."""
+
     # === FEATURE GENERATION ===
 
     # 1. OpenMS FileInfo
     # Creates OpenMS Fileinfo files and stores them in output_dir/fileinfo. Again, if a FileInfo file for a mzML file already exists,
     # the cration of this file is being skipped.
     # FileInfo files contain metadata that could be extracted directly from the mzML file as Instrument, Activation method and Software.
-    print("[1/7] Generating OpenMS FileInfo files...")
-    generate_fileinfo(args.mzml_dir, args.output_dir)
+    # With the scan backend, FileInfo features and keywords are extracted together in a single read of each mzML file.
+    # With the pyopenms backend, the FileInfo features are computed in-process without FileInfo text files.
+    # Without write_intermediate, the FileInfo text files are removed once their features are extracted.
+    fileinfo_records = None
+    if args.fileinfo_backend == "scan":
+        print("[1-2/7] Scanning mzML files for FileInfo features and keywords...")
+        fileinfo_records = scan_mzml_files(args.mzml_dir, args.output_dir, keywords, args.light_workers, args.cache_hash)
+    else:
+        if args.fileinfo_backend == "pyopenms":
+            print("[1/7] Extracting FileInfo features with pyopenms...")
+            fileinfo_records = extract_fileinfo_records(args.mzml_dir, args.output_dir, args.light_workers, args.cache_hash)
+        elif args.write_intermediate:
+            print("[1/7] Generating OpenMS FileInfo files...")
+            generate_fileinfo(args.mzml_dir, args.output_dir, args.light_workers, args.fileinfo_timeout)
+        else:
+            print("[1/7] Extracting FileInfo features with OpenMS FileInfo...")
+            fileinfo_records = fileinfo_tool_records(args.mzml_dir, args.output_dir, args.light_workers,
+                                                     args.fileinfo_timeout, args.cache_hash)
 
-    # 2. Parses keywords from the mzML text
-    # Including keywords related to Modification (PTMs), Quantification, Organism, Organism Part and Disease
-    print("[2/7] Parsing keywords from mzML files...")
-    parse_keywords(args.mzml_dir, args.output_dir)
+        # 2. Parses keywords from the mzML text
+        # Including keywords related to Modification (PTMs), Quantification, Organism, Organism Part and Disease
+        print("[2/7] Parsing keywords from mzML files...")
+        parse_keywords(args.mzml_dir, args.output_dir, header_only=args.keyword_header_only, use_hash=args.cache_hash,
+                       write_file=args.write_intermediate)
 
     # 3. Param-medic tolerance calculations
     # Calculates mass tolerance estimations (precursor mass tolerance and fragment mass tolerance)
     # using param-medic and stores tolerance files in output_dir/tolerances (one file per mzML)
     # If a file already exists, the creation for this file is being skipped.
-    print("[3/7] Starting param-medic tolerance calculations...")
-    #run_param_medic(args.mzml_dir, args.output_dir)
+    if args.tolerance_backend == "native":
+        print("[3/7] Estimating mass tolerances...")
+        estimate_all_tolerances(args.mzml_dir, args.output_dir, args.light_workers)
+    else:
+        print("[3/7] Starting param-medic tolerance calculations...")
+        if args.run_param_medic:
+            try:
+                run_param_medic(args.mzml_dir, args.output_dir)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"Warning: param-medic failed ({e}). Using the default tolerances.")
 
     # 4. Parameter file creation
     # Create parameter file based on extracted param-medic parameters and instrument information from
     # OpenMS FileInfo. These files will be used for peptide identification via OpenMS CometAdapter.
     print("[4/7] Creating parameter files for peptide identification...")
-    create_parameter_files(args.mzml_dir, args.output_dir)
+    create_parameter_files(args.mzml_dir, args.output_dir, fileinfo_records)
 
     # 5. Peptide identification via OpenMS CometAdapter
     # Searches peptides for alle mzML files in curated Swissprot db or another specified database.
     # Throws warning of no database is specified or existent.
+    prescreen_index = open_prescreen_index(args)
+    if prescreen_index:
+        print("[5/7] Pre-screening organisms by precursor mass...")
+        prescreen_all_files(args.mzml_dir, idxml_dir, prescreen_index,
+                            args.prescreen_tolerance_ppm, args.light_workers)
     print("[5/7] Running peptide identification using CometAdapter...")
     if args.database and os.path.exists(args.database) and args.comet_exe and os.path.exists(args.comet_exe):
-        run_comet_adapter(args.mzml_dir, args.output_dir, args.database, args.comet_exe)
+        run_comet_adapter(args.mzml_dir, args.output_dir, args.database, args.comet_exe,
+                          args.comet_cores, args.comet_max_threads, fileinfo_records,
+                          args.comet_sample_fraction, args.comet_min_sample_spectra, open_tiered_database(args),
+                          open_comet_index(args), args.comet_adaptive_batch, args.comet_adaptive_tolerance,
+                          args.prescreen_min_share if prescreen_index else None, args.prescreen_hit_scale,
+                          open_prescreen_databases(args), idxml_dir)
     else:
         print("Warning: Database or Comet executable not provided or not found. Skipping peptide identification.")
     
@@ -119,21 +607,9 @@ def main():
     # Create feature files based on all extracted information incl. information of peptide id results.
     # These files will be used for ML predictions.
     print("[6/7] Creating feature files for machine learning...")
-    if args.idxml_dir:
-        idxml_dir = args.idxml_dir
-    else: 
-        idxml_dir = os.path.join(args.output_dir, "idxml")
-    create_feature_file(idxml_dir, args.output_dir)
-
-    # === ML PREDICTIONS === 
-
-    # Predict metadata based on extracted features using Random Forest Classifier
-    # Uses pretrained ML models for prediction (stored as pkl files). 
-    # Stores predictions incl. estimated accuracy as .csv files
-    print(f"[7/7] Predicting metadata...")
-    ml_prediction(args.output_dir, os.path.join(args.output_dir,"extracted_features.csv"))
-    metadata_file_creation(args.output_dir)
-    print(f"Metadata inference completed. Results stored as predicted_metadata.csv in {args.output_dir}")
+    return create_feature_file(idxml_dir, args.output_dir, fileinfo_records, use_hash=args.cache_hash, max_workers=args.light_workers,
+                               feature_store=args.feature_store, export_csv=args.export_csv,
+                               write_files=args.write_intermediate, prescreen_hit_scale=args.prescreen_hit_scale)
 
 if __name__ == '__main__':
     main()
@@ -1,68 +1,182 @@
 import os
+import json
 import pandas as pd
 import numpy as np
 from pathlib import Path
+from functools import lru_cache, cached_property
 import joblib
+from feature_store import read_features
 
-def ml_prediction(output_dir, feature_file):
+MODEL_DIR = "models"
+MODELS = ["mlp_200_nokey", "mlp_400_nokey"]
+
+label_columns = ["Domain","Organism", "Organism part", "Diseases", "Modification",
+                 "Experiment Type", "Instrument", "Quantification", "Software"]
+
+def is_imputed(col):
+    return "avgevalhits" in col or "counthits" in col or "precursor" in col
+
+def build_feature_table(feature_pattern):
+    """Column order, dtypes and impute values (training means of the peptide hit and precursor charge
+    columns) of the training features of a model."""
+    return {
+        "columns": list(feature_pattern.columns),
+        "dtypes": {col: str(dtype) for col, dtype in feature_pattern.dtypes.items()},
+        "impute_values": {col: float(np.mean(feature_pattern[col])) for col in feature_pattern.columns if is_imputed(col)},
+    }
+
+def preprocessor_feature_table(preprocessor):
+    """Column order, dtypes and impute values of the training features, taken from the column transformer
+    of a model: its numeric columns are floats imputed with the training means, the others are strings."""
+    table = {"columns": [], "dtypes": {}, "impute_values": {}}
+    for name, transformer, columns in preprocessor.transformers_:
+        if name == "remainder":
+            continue
+        numeric = name == "num"
+        table["columns"] += list(columns)
+        table["dtypes"].update({col: "float64" if numeric else "object" for col in columns})
+        if numeric:
+            means = transformer.named_steps["imputer"].statistics_
+            table["impute_values"].update({col: float(mean) for col, mean in zip(columns, means) if is_imputed(col)})
+    return table
+
+def write_feature_table(model, model_dir=MODEL_DIR):
+    """Builds the feature table of a model from its training features, or from its preprocessor if they are
+    missing, and stores it next to the model."""
+    artifacts = ModelArtifacts(model, model_dir)
+    if os.path.exists(artifacts.path("train_features.csv")):
+        table = build_feature_table(artifacts.feature_pattern)
+    else:
+        table = preprocessor_feature_table(artifacts.preprocessor)
+    path = artifacts.path("feature_table.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(table, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+    print(f"Feature table of {model} with {len(table['columns'])} columns saved to {path}")
+
+class ModelArtifacts:
+    """Model, preprocessor, label-encoders, metrics and feature table of a trained model.
+    Every artifact is loaded from the model directory on first access only, the training
+    features are only read if the feature table is missing."""
+
+    def __init__(self, model, model_dir=MODEL_DIR):
+        self.model = model
+        self.model_dir = model_dir
+
+    def path(self, suffix):
+        return os.path.join(self.model_dir, f"{self.model}_{suffix}")
+
+    @cached_property
+    def clf(self):
+        return joblib.load(self.path("model.pkl"))
+
+    @cached_property
+    def preprocessor(self):
+        return joblib.load(self.path("preprocessor.pkl"))
+
+    @cached_property
+    def label_encoders(self):
+        return joblib.load(self.path("label_encoders.pkl"))
+
+    @cached_property
+    def metrics(self):
+        return pd.read_csv(self.path("metrics.csv"))
+
+    @cached_property
+    def feature_pattern(self):
+        return pd.read_csv(self.path("train_features.csv"))
 
-    models = ["mlp_200_nokey", "mlp_400_nokey"]
+    @cached_property
+    def feature_table(self):
+        """Precomputed column order, dtypes and impute values, computed from the training features if missing."""
+        path = self.path("feature_table.json")
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                return json.load(f)
+        print(f"Warning: No feature table for {self.model}, computing it from {self.path('train_features.csv')}. "
+              f"Create it with 'python build_feature_tables.py'.")
+        return build_feature_table(self.feature_pattern)
+
+    @cached_property
+    def feature_columns(self):
+        return self.feature_table["columns"]
+
+    @cached_property
+    def impute_values(self):
+        """Training means of the peptide hit and precursor charge columns, used for columns missing in the features."""
+        return pd.Series(self.feature_table["impute_values"], index=list(self.feature_table["impute_values"]), dtype=float)
+
+    @cached_property
+    def feature_dtypes(self):
+        """Dtypes of the training features. Integer and boolean columns are floats, as missing values are NaN."""
+        return {col: "float64" if np.dtype(dtype).kind in "iub" else dtype for col, dtype in self.feature_table["dtypes"].items()}
+
+    @cached_property
+    def schema_key(self):
+        """Models with the same training features, dtypes and impute values share their aligned features."""
+        return tuple(self.feature_columns), tuple(self.feature_dtypes.items()), self.impute_values.to_numpy().tobytes()
+
+@lru_cache(maxsize=None)
+def get_model(model, model_dir=MODEL_DIR):
+    """Returns the artifacts of a model, every model is set up once per process."""
+    return ModelArtifacts(model, model_dir)
+
+def align_features(feature_df, artifacts):
+    """Brings the features into the column order and dtypes of the training features. Peptide hit and precursor
+    charge columns missing in the features are filled with their training mean, other features are dropped."""
+    aligned = feature_df.reindex(columns=artifacts.feature_columns)
+    missing = artifacts.impute_values.index.difference(feature_df.columns)
+    return aligned.fillna(artifacts.impute_values[missing]).astype(artifacts.feature_dtypes)
+
+def predict_labels(X, artifacts):
+    """Predicts and decodes the metadata labels of aligned features with a model."""
+    # Apply preprocessing to X
+    X_preprocessed = artifacts.preprocessor.transform(X)
+    y_pred = artifacts.clf.predict(X_preprocessed)
+
+    # Decode predictions
+    y_pred_decoded = pd.DataFrame(y_pred, columns=label_columns)
+
+
+    for i, col in enumerate(label_columns):
+        y_pred_decoded[col] = artifacts.label_encoders[col].inverse_transform(y_pred[:, i])
+    return y_pred_decoded
+
+def predict_metadata_batch(feature_dfs, models=MODELS):
+    """Predicts the metadata of several feature DataFrames with one model call per model.
+    Every DataFrame is aligned on its own, so a batch gives the same predictions as separate calls.
+    Returns one {model: predictions} dict per feature DataFrame."""
+    results = [{} for _ in feature_dfs]
+    aligned = {}
 
     for model in models:
-        feature_df = pd.read_csv(feature_file)
-        filename_col = feature_df['Filename'].copy()
-        software_col  = feature_df['software'].copy()
-        activation_method = feature_df['activation_method'].copy()
-        feature_pattern = pd.read_csv(f"models/{model}_train_features.csv")
-        # Load model, preprocessor and label-encoders
-        clf = joblib.load(f"models/{model}_model.pkl")
-        preprocessor = joblib.load(f"models/{model}_preprocessor.pkl")
-        label_encoders = joblib.load(f"models/{model}_label_encoders.pkl")
-        ml_metrics = pd.read_csv(f"models/{model}_metrics.csv")
-
-        # preprocess feature df
-        new_fea_cols = feature_df.columns
-        for col in feature_pattern.columns:
-            if col not in new_fea_cols:
-                if "avgevalhits" in col:
-                    feature_df[col] = np.mean(feature_pattern[col])
-                elif "counthits" in col:
-                    feature_df[col] = np.mean(feature_pattern[col])
-                elif "precursor" in col:
-                    feature_df[col] = np.mean(feature_pattern[col])
-            if col in new_fea_cols:
-                if "avgevalhits" in col:
-                    feature_df[col].fillna(np.mean(feature_pattern[col]))
-                elif "counthits" in col:
-                    feature_df[col].fillna(np.mean(feature_pattern[col]))
-                elif "precursor" in col:
-                    feature_df[col].fillna(np.mean(feature_pattern[col]))
-
-        for fea_df_col in feature_df.columns:
-            if fea_df_col not in feature_pattern.columns:
-                feature_df = feature_df.drop(columns = [fea_df_col]).copy()
-        
-        # Sort feature_df as feature_pattern from training process
-        feature_df = feature_df[feature_pattern.columns]
-
-        X = feature_df.copy() 
-        
-        label_columns = ["Domain","Organism", "Organism part", "Diseases", "Modification", 
-                 "Experiment Type", "Instrument", "Quantification", "Software"]
-        
-        # Apply preprocessing to X
-        X_preprocessed = preprocessor.transform(X)
-        y_pred = clf.predict(X_preprocessed)
+        artifacts = get_model(model)
+        # Align the features once per training feature schema
+        if artifacts.schema_key not in aligned:
+            aligned[artifacts.schema_key] = [align_features(feature_df, artifacts) for feature_df in feature_dfs]
+        X = pd.concat(aligned[artifacts.schema_key], ignore_index=True)
+        y_pred_decoded = predict_labels(X, artifacts)
 
-        # Decode predictions
-        y_pred_decoded = pd.DataFrame(y_pred, columns=label_columns)
+        start = 0
+        for result, feature_df in zip(results, feature_dfs):
+            predictions = y_pred_decoded.iloc[start:start + len(feature_df)].reset_index(drop=True)
+            start += len(feature_df)
 
+            ### Todo: only story one metadata.csv (w model for best accuracy per column)
+            predictions.insert(0, 'Filename', feature_df['Filename'].to_numpy())
+            predictions["Parsed Software"] = feature_df['software'].to_numpy()
+            predictions["Activation Method"] = feature_df['activation_method'].to_numpy()
+            result[model] = predictions
+    return results
+
+def predict_metadata(feature_df, models=MODELS):
+    """Predicts the metadata of a feature DataFrame, returns a {model: predictions} dict."""
+    return predict_metadata_batch([feature_df], models)[0]
+
+def ml_prediction(output_dir, feature_file):
 
-        for i, col in enumerate(label_columns):
-            y_pred_decoded[col] = label_encoders[col].inverse_transform(y_pred[:, i])
+    # Read the features once and align them once per training feature schema
+    feature_df = read_features(feature_file)
 
-        ### Todo: only story one metadata.csv (w model for best accuracy per column)
-        y_pred_decoded.insert(0, 'Filename', filename_col) 
-        y_pred_decoded["Parsed Software"] = software_col
-        y_pred_decoded["Activation Method"] = activation_method
+    for model, y_pred_decoded in predict_metadata(feature_df).items():
         y_pred_decoded.to_csv(os.path.join(output_dir, f"{model}_predicted_metadata.csv"), index = False)
@@ -1,6 +1,8 @@
 import os
+import re
 import pandas as pd
 from concurrent.futures import ProcessPoolExecutor
+from result_cache import open_cache
 
 # List of relevant keywords
 keywords = [
@@ -20,26 +22,165 @@ keywords = [
 # "Ubiquitination": "glygly" in content or "+114.04" in content,
 # "Carbamidomethylation": "carbamidomethyl" in content or "+57.02" in content,
 
-def process_mzml(file, mzml_folder, keywords):
-    """Reads an mzML file line by line and searches for keywords."""
+# Size of the blocks read from the mzML files, memory per file stays bounded by this
+CHUNK_SIZE = 4 << 20
+
+class KeywordMatcher:
+    """Matches all keywords case-insensitively in a stream of byte chunks. Keeps the last bytes
+    of every chunk so matches crossing chunk borders are found, and stops checking a keyword
+    once it has been found."""
+
+    def __init__(self, keywords):
+        self.pending = {kw: kw.lower().encode() for kw in keywords}
+        self.presence = {kw: 0 for kw in keywords}
+        self.overlap = max([len(p) for p in self.pending.values()], default=1) - 1
+        self.tail = b""
+
+    def feed(self, chunk):
+        if not self.pending:
+            return
+        window = self.tail + chunk.lower()
+        for kw, pattern in list(self.pending.items()):
+            if pattern in window:
+                self.presence[kw] = 1
+                del self.pending[kw]
+        self.tail = window[-self.overlap:] if self.overlap else b""
+
+    def done(self):
+        return not self.pending
+
+BINARY_START = b"<binary>"
+BINARY_END = b"</binary>"
+ENCODED_LENGTH = re.compile(rb'encodedLength="(\d+)"')
+
+def scan_metadata(f, matcher, chunk_size=CHUNK_SIZE):
+    """Feeds an mzML file to the matcher without the base64 payloads of its <binary> elements.
+    Payloads are skipped with a seek using the encodedLength of their binaryDataArray, or by
+    searching for </binary> if the length is missing or wrong. Returns (bytes_scanned, bytes_skipped)."""
+    scanned, skipped = 0, 0
+    buffer = b""
+    in_binary = False
+    encoded_length = None
+
+    while not matcher.done():
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        buffer += chunk
+
+        while not matcher.done():
+            if in_binary:
+                end = buffer.find(BINARY_END)
+                if end == -1:
+                    # Keep the end of the buffer in case it holds the start of </binary>
+                    keep = min(len(buffer), len(BINARY_END) - 1)
+                    skipped += len(buffer) - keep
+                    buffer = buffer[len(buffer) - keep:]
+                    break
+                skipped += end
+                buffer = buffer[end:]
+                in_binary = False
+                continue
+
+            start = buffer.find(BINARY_START)
+            if start == -1:
+                # Keep the end of the buffer in case it holds the start of <binary>
+                keep = min(len(buffer), len(BINARY_START) - 1)
+                header = buffer[:len(buffer) - keep]
+                lengths = ENCODED_LENGTH.findall(header)
+                if lengths:
+                    encoded_length = int(lengths[-1])
+                matcher.feed(header)
+                scanned += len(header)
+                buffer = buffer[len(buffer) - keep:]
+                break
+
+            header = buffer[:start + len(BINARY_START)]
+            lengths = ENCODED_LENGTH.findall(header)
+            if lengths:
+                encoded_length = int(lengths[-1])
+            matcher.feed(header)
+            scanned += len(header)
+            buffer = buffer[start + len(BINARY_START):]
+            in_binary = True
+
+            # Jump over the payload if its length is known and it ends outside the buffer
+            if encoded_length is not None and encoded_length > len(buffer):
+                payload_start = f.tell() - len(buffer)
+                f.seek(payload_start + encoded_length)
+                buffer = f.read(chunk_size)
+                if buffer.startswith(BINARY_END):
+                    skipped += encoded_length
+                    in_binary = False
+                else:
+                    # encodedLength does not match the payload, search for </binary> instead
+                    f.seek(payload_start)
+                    buffer = f.read(chunk_size)
+            encoded_length = None
+
+    # Whatever was kept back at the end of the file
+    if not matcher.done():
+        if in_binary:
+            skipped += len(buffer)
+        else:
+            matcher.feed(buffer)
+            scanned += len(buffer)
+
+    return scanned, skipped
+
+def process_mzml(file, mzml_folder, keywords, chunk_size=CHUNK_SIZE, header_only=False):
+    """Reads an mzML file chunk by chunk and searches for keywords. With header_only, the base64
+    encoded peak arrays are skipped and only the metadata of the file is searched. The returned
+    record contains the number of bytes scanned and skipped next to the keyword flags."""
     file_path = os.path.join(mzml_folder, file)
     print(f"Processing {file}")
     
     try:
-        with open(file_path, 'r') as f:
-            content = f.read().lower()
+        matcher = KeywordMatcher(keywords)
+        with open(file_path, 'rb') as f:
+            if header_only:
+                bytes_scanned, bytes_skipped = scan_metadata(f, matcher, chunk_size)
+            else:
+                bytes_scanned, bytes_skipped = 0, 0
+                # Stop reading as soon as every keyword has been found
+                while not matcher.done():
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    matcher.feed(chunk)
+                    bytes_scanned += len(chunk)
         
-        # Check if keywords are present
-        keyword_presence = {kw: int(kw.lower() in content) for kw in keywords}
-        
-        return {"Filename": file, **keyword_presence}
+        return {"Filename": file, **matcher.presence, "bytes_scanned": bytes_scanned, "bytes_skipped": bytes_skipped}
     
     except Exception as e:
         print(f"Error processing {file}: {e}")
         return None
 
-def parse_keywords(mzml_folder, keywords_dir):
-    """Function to parse mzML files for specific keywords and save the results to a CSV file."""
+def open_keyword_cache(keywords_dir, header_only=False, use_hash=False):
+    return open_cache(keywords_dir, "keyword_parsing_header_only" if header_only else "keyword_parsing", use_hash)
+
+def cached_keywords(cache, mzml_folder, file):
+    """Returns the cached keyword record of a file, None if it is new or changed or the keyword list changed since."""
+    record = cache.get(os.path.join(mzml_folder, file))
+    if record is not None and set(record) != {"Filename", *keywords}:
+        return None
+    return record
+
+def parse_file_keywords(file, mzml_folder, cache, header_only=False):
+    """Returns the keyword record of a single mzML file, parsing and caching it only if there is no valid cached record."""
+    record = cached_keywords(cache, mzml_folder, file)
+    if record is None:
+        record = process_mzml(file, mzml_folder, keywords, header_only=header_only)
+        if record is not None:
+            del record["bytes_scanned"], record["bytes_skipped"]
+            cache.put(os.path.join(mzml_folder, file), record)
+    return record
+
+def parse_keywords(mzml_folder, keywords_dir, max_workers=4, header_only=False, use_hash=False, write_file=True):
+    """Function to parse mzML files for specific keywords and save the results to a CSV file.
+    With header_only, only the metadata of the mzML files is searched and the binary peak data is skipped.
+    Results are cached per mzML file, so only new or changed files are parsed again.
+    Without write_file, the results are only cached and no CSV file is written."""
     
     # Ensure that the keyword directory exists
     if not os.path.exists(keywords_dir):
@@ -48,21 +189,42 @@ def parse_keywords(mzml_folder, keywords_dir):
     
     # Define output file
     output_file = os.path.join(keywords_dir, "keyword_parsing_results.csv")
-    
-    if not os.path.exists(output_file):
-        # Process all mzML files in parallel
-        mzml_files = [f for f in os.listdir(mzml_folder) if f.endswith(".mzML")]
-    
-        with ProcessPoolExecutor(max_workers=4) as executor:
-            results = list(executor.map(process_mzml, mzml_files, [mzml_folder]*len(mzml_files), [keywords]*len(mzml_files)))
-    
-        # Remove None values (failed files)
-        results = [r for r in results if r is not None]
-    
-        # Create DataFrame and save to CSV
-        df = pd.DataFrame(results)
-        df.to_csv(output_file, index=False)
-    
-        print(f"Keyword parsing completed. Results saved to {output_file}")
-    else:
-        print(f"Keyword parsing results already created and stored in {output_file}. Proceeding with next step.")
+    cache = open_keyword_cache(keywords_dir, header_only, use_hash)
+
+    # Take results of unchanged files from the cache
+    mzml_files = [f for f in os.listdir(mzml_folder) if f.endswith(".mzML")]
+    records = {f: cached_keywords(cache, mzml_folder, f) for f in mzml_files}
+    missing = [f for f in mzml_files if records[f] is None]
+
+    if missing:
+        # Process new or changed mzML files in parallel
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(process_mzml, missing, [mzml_folder]*len(missing), [keywords]*len(missing),
+                                        [CHUNK_SIZE]*len(missing), [header_only]*len(missing)))
+
+        # Report how much of the files was actually read
+        bytes_scanned = sum(r.pop("bytes_scanned") for r in results if r is not None)
+        bytes_skipped = sum(r.pop("bytes_skipped") for r in results if r is not None)
+        if header_only:
+            total = max(bytes_scanned + bytes_skipped, 1)
+            print(f"Header-only keyword parsing: scanned {bytes_scanned / 1e6:.1f} MB, skipped {bytes_skipped / 1e6:.1f} MB "
+                  f"of binary data ({100 * bytes_skipped / total:.1f}%).")
+
+        # Failed files (None) are not cached and retried on the next run
+        for f, r in zip(missing, results):
+            if r is not None:
+                cache.put(os.path.join(mzml_folder, f), r)
+                records[f] = r
+        cache.save()
+
+    print(f"Keyword parsing: {len(missing)} new or changed files parsed, {len(mzml_files) - len(missing)} taken from cache.")
+
+    if not write_file:
+        return
+
+    # Rebuild the CSV from the cached and new results
+    results = [records[f] for f in mzml_files if records[f] is not None]
+    df = pd.DataFrame(results)
+    df.to_csv(output_file, index=False)
+
+    print(f"Keyword parsing completed. Results saved to {output_file}")
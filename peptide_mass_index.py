@@ -0,0 +1,239 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+import numpy as np
+import pyopenms as oms
+from concurrent.futures import ProcessPoolExecutor
+from tiered_database import read_fasta, accession, organism_suffix, TRYPSIN, MIN_PEPTIDE_LENGTH, MAX_PEPTIDE_LENGTH
+
+# Database search free organism pre-screen: the neutral masses of the tryptic peptides of every organism
+# in the database are stored once as one sorted, memory-mapped array with the organism of every mass.
+# The precursor masses of the MS2 spectra of a file are looked up in it with a vectorized binary search.
+# Matches at precursor masses shifted by multiples of the average residue mass defect estimate the
+# number of chance matches, so only the excess over chance counts as hits of an organism.
+
+PROTON = 1.007276
+WATER = 18.010565
+# Monoisotopic residue masses, cysteine carbamidomethylated as in the CometAdapter searches
+RESIDUE_MASSES = {
+    "G": 57.021464, "A": 71.037114, "S": 87.032028, "P": 97.052764, "V": 99.068414, "T": 101.047679,
+    "C": 160.030649, "L": 113.084064, "I": 113.084064, "N": 114.042927, "D": 115.026943, "Q": 128.058578,
+    "K": 128.094963, "E": 129.042593, "M": 131.040485, "H": 137.058912, "F": 147.068414, "R": 156.101111,
+    "Y": 163.06332, "W": 186.079313, "U": 150.953636, "O": 237.147727,
+}
+# Shifts of the decoy lookups, multiples of 1.000495 Da stay within the mass defect band of peptides
+DECOY_SHIFTS = 1.000495 * np.array([-11, -5, 5, 11])
+MIN_HITS = 20
+# Number of spectra looked up at once, bounds the memory of the candidate arrays
+QUERY_CHUNK = 5000
+
+MASS_TABLE = np.full(256, np.nan)
+for residue, mass in RESIDUE_MASSES.items():
+    MASS_TABLE[ord(residue)] = mass
+
+def peptide_masses(peptides):
+    """Neutral monoisotopic masses of peptides, NaN for peptides with unknown residues."""
+    if not peptides:
+        return np.array([])
+    residues = MASS_TABLE[np.frombuffer("".join(peptides).encode(), dtype=np.uint8)]
+    starts = np.concatenate([[0], np.cumsum([len(p) for p in peptides])[:-1]])
+    return np.add.reduceat(residues, starts) + WATER
+
+class PeptideMassIndex:
+    """Sorted tryptic peptide masses (float32) and their organisms of a FASTA database, cached in cache_dir."""
+
+    def __init__(self, db, cache_dir, decoy_string="DECOY_"):
+        self.db = db
+        self.decoy_string = decoy_string
+        self.lock = threading.Lock()
+        stat = os.stat(db)
+        key = json.dumps([os.path.abspath(db), stat.st_size, stat.st_mtime_ns, MIN_PEPTIDE_LENGTH, MAX_PEPTIDE_LENGTH,
+                          RESIDUE_MASSES, decoy_string])
+        name = os.path.splitext(os.path.basename(db))[0]
+        self.index_dir = os.path.join(cache_dir, f"{name}_{hashlib.sha1(key.encode()).hexdigest()[:12]}_masses")
+
+    def build(self):
+        print(f"Building peptide mass index of {self.db}...")
+        organisms, organism_ids, masses, owners = [], {}, [], []
+        for header, sequence in read_fasta(self.db):
+            if self.decoy_string and accession(header).startswith(self.decoy_string):
+                continue
+            organism = organism_suffix(header)
+            if organism not in organism_ids:
+                organism_ids[organism] = len(organisms)
+                organisms.append(organism)
+            peptides = sorted({p for p in TRYPSIN.split(sequence) if MIN_PEPTIDE_LENGTH <= len(p) <= MAX_PEPTIDE_LENGTH})
+            masses.append(peptide_masses(peptides))
+            owners.append(np.full(len(peptides), organism_ids[organism], dtype=np.int32))
+        masses = np.concatenate(masses) if masses else np.array([])
+        owners = np.concatenate(owners) if owners else np.array([], dtype=np.int32)
+        known = ~np.isnan(masses)
+        masses, owners = masses[known].astype(np.float32), owners[known]
+
+        # Every mass counts once per organism, even if several of its proteins contain the peptide
+        order = np.lexsort((masses, owners))
+        masses, owners = masses[order], owners[order]
+        unique = np.ones(len(masses), dtype=bool)
+        unique[1:] = (masses[1:] != masses[:-1]) | (owners[1:] != owners[:-1])
+        masses, owners = masses[unique], owners[unique]
+        order = np.argsort(masses, kind="stable")
+
+        # organisms.json is written last, its existence marks a complete index
+        np.save(os.path.join(self.index_dir, "masses.npy"), masses[order])
+        np.save(os.path.join(self.index_dir, "organisms.npy"), owners[order].astype(np.uint16 if len(organisms) < 1 << 16 else np.int32))
+        with open(os.path.join(self.index_dir, "organisms.json.tmp"), "w") as f:
+            json.dump(organisms, f)
+        os.replace(os.path.join(self.index_dir, "organisms.json.tmp"), os.path.join(self.index_dir, "organisms.json"))
+        print(f"Peptide mass index: {len(masses)} masses of {len(organisms)} organisms saved to {self.index_dir}")
+
+    def path(self):
+        """Returns the index directory, building the index if it is not cached yet."""
+        info_path = os.path.join(self.index_dir, "organisms.json")
+        # As in CometIndex, the thread lock serializes the threads of this process, the file lock other processes
+        with self.lock:
+            if not os.path.exists(info_path):
+                os.makedirs(self.index_dir, exist_ok=True)
+                with open(os.path.join(self.index_dir, ".lock"), "w") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    if not os.path.exists(info_path):
+                        self.build()
+        return self.index_dir
+
+def load_index(index_dir):
+    """Memory-maps the masses and organisms of an index directory."""
+    with open(os.path.join(index_dir, "organisms.json"), "r") as f:
+        organisms = json.load(f)
+    return (np.load(os.path.join(index_dir, "masses.npy"), mmap_mode="r"),
+            np.load(os.path.join(index_dir, "organisms.npy"), mmap_mode="r"), organisms)
+
+class PrecursorConsumer:
+    """Consumer for MzMLFile().transform that collects the neutral precursor masses of the MS2 spectra.
+    Spectra without a precursor charge are looked up as charge 2 and 3."""
+
+    def __init__(self):
+        self.ms2_spectra = 0
+        self.spectra, self.masses = [], []
+
+    def setExpectedSize(self, num_spectra, num_chromatograms):
+        pass
+
+    def setExperimentalSettings(self, settings):
+        pass
+
+    def consumeChromatogram(self, chromatogram):
+        pass
+
+    def consumeSpectrum(self, spectrum):
+        if spectrum.getMSLevel() != 2:
+            return
+        precursors = spectrum.getPrecursors()
+        if precursors:
+            mz, charge = precursors[0].getMZ(), precursors[0].getCharge()
+            for z in [charge] if charge > 0 else [2, 3]:
+                self.spectra.append(self.ms2_spectra)
+                self.masses.append((mz - PROTON) * z)
+        self.ms2_spectra += 1
+
+def count_matches(query_masses, query_spectra, masses, owners, num_organisms, tolerance_ppm):
+    """Number of spectra with at least one peptide mass of an organism within tolerance_ppm, per organism."""
+    counts = np.zeros(num_organisms)
+    start = 0
+    while start < len(query_masses):
+        # Both charges of a spectrum without charge stay in one chunk, so the spectrum counts once
+        stop = start + QUERY_CHUNK
+        while stop < len(query_masses) and query_spectra[stop] == query_spectra[stop - 1]:
+            stop += 1
+        chunk, chunk_spectra, start = query_masses[start:stop], query_spectra[start:stop], stop
+        # The windows are float32 like the index, mixed types would copy the whole index in every search
+        left = np.searchsorted(masses, (chunk * (1 - tolerance_ppm * 1e-6)).astype(masses.dtype), side="left")
+        right = np.searchsorted(masses, (chunk * (1 + tolerance_ppm * 1e-6)).astype(masses.dtype), side="right")
+        sizes = right - left
+        if not sizes.sum():
+            continue
+        # Positions of all candidates of all queries, without a Python loop over the queries
+        offsets = np.repeat(left - np.concatenate([[0], np.cumsum(sizes)[:-1]]), sizes)
+        candidates = owners[np.arange(sizes.sum()) + offsets].astype(np.int64)
+        spectra = np.repeat(chunk_spectra, sizes)
+        counts += np.bincount(np.unique(spectra * num_organisms + candidates) % num_organisms, minlength=num_organisms)
+    return counts
+
+def prescreen_mzml(mzml_path, index_dir, tolerance_ppm=10):
+    """Estimates the per-organism hits of an mzML file from precursor mass matches.
+    Returns the number of MS2 spectra and the hits over chance per organism."""
+    masses, owners, organisms = load_index(index_dir)
+    consumer = PrecursorConsumer()
+    oms.MzMLFile().transform(mzml_path.encode(), consumer)
+    query_masses, query_spectra = np.array(consumer.masses), np.array(consumer.spectra, dtype=np.int64)
+
+    observed = count_matches(query_masses, query_spectra, masses, owners, len(organisms), tolerance_ppm)
+    expected = np.mean([count_matches(query_masses + shift, query_spectra, masses, owners, len(organisms), tolerance_ppm)
+                        for shift in DECOY_SHIFTS], axis=0)
+    excess = observed - expected
+    hits = {organisms[i]: round(float(excess[i]), 2) for i in np.argsort(-excess) if excess[i] > 0}
+    return {"ms2_spectra": consumer.ms2_spectra, "hits": hits}
+
+def leading_organism(prescreen, min_share=0.8, min_hits=MIN_HITS):
+    """The organism of a pre-screen result if it has at least min_share of the hits over chance, None otherwise."""
+    hits = prescreen["hits"] if prescreen else {}
+    total = sum(hits.values())
+    if not total:
+        return None
+    leader = max(hits, key=hits.get)
+    return leader if hits[leader] >= min_hits and hits[leader] / total >= min_share else None
+
+def prescreen_path(idxml_path):
+    """Path of the file storing the pre-screen result next to an idXML file."""
+    return idxml_path.split("_CometAdapter.idXML")[0] + "_prescreen.json"
+
+def read_prescreen(idxml_path):
+    path = prescreen_path(idxml_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def prescreen_file(mzml_file, data_dir, prot_id_dir, index_dir, tolerance_ppm=10):
+    """Pre-screens an mzML file and stores the result next to its idXML file."""
+    idxml_path = os.path.join(prot_id_dir, f"{mzml_file.split('.mzML')[0]}_CometAdapter.idXML")
+    prescreen = prescreen_mzml(os.path.join(data_dir, mzml_file), index_dir, tolerance_ppm)
+    with open(f"{prescreen_path(idxml_path)}.tmp", "w") as f:
+        json.dump(prescreen, f)
+    os.replace(f"{prescreen_path(idxml_path)}.tmp", prescreen_path(idxml_path))
+    top = ", ".join(f"{organism} {hits:.0f}" for organism, hits in list(prescreen["hits"].items())[:3])
+    print(f"Pre-screen of {mzml_file}: {top or 'no hits over chance'}")
+    return prescreen
+
+def prescreen_record(prescreen, mzML_filename, hit_scale=None):
+    """Peptide hit features of a file without idXML from its pre-screen result. The pre-screen hits are
+    not on the scale of the Comet hits the models were trained on, so they are stored as prescreenhits
+    columns. Only with a hit_scale, the counthits columns are filled with the scaled pre-screen hits.
+    There are no e-values, so the avgevalhits columns are left empty."""
+    file_data = {"Filename": mzML_filename}
+    for organism, hits in prescreen["hits"].items():
+        file_data[f"{organism}_prescreenhits"] = hits
+    if hit_scale is not None:
+        print(f"Warning: {mzML_filename} was not searched, its peptide hit features are the pre-screen hits scaled by {hit_scale}.")
+        for organism, hits in prescreen["hits"].items():
+            file_data[f"{organism}_counthits"] = hits * hit_scale
+            file_data[f"{organism}_avgevalhits"] = np.nan
+    return file_data
+
+def prescreen_all_files(data_dir, prot_id_dir, index_dir, tolerance_ppm=10, max_workers=4, mzml_files=None):
+    """Pre-screens all mzML files (or the given ones) without idXML or pre-screen result in parallel."""
+    if mzml_files is None:
+        mzml_files = [f for f in os.listdir(data_dir) if f.endswith(".mzML")]
+    os.makedirs(prot_id_dir, exist_ok=True)
+    idxml_paths = {f: os.path.join(prot_id_dir, f"{f.split('.mzML')[0]}_CometAdapter.idXML") for f in mzml_files}
+    missing = [f for f, path in idxml_paths.items() if not os.path.exists(path) and not os.path.exists(prescreen_path(path))]
+    print(f"Pre-screen: {len(missing)} files to pre-screen, {len(mzml_files) - len(missing)} already searched or pre-screened.")
+    if not missing:
+        return
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {f: executor.submit(prescreen_file, f, data_dir, prot_id_dir, index_dir, tolerance_ppm) for f in missing}
+        for f, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error pre-screening {f}: {e}")
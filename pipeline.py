@@ -0,0 +1,54 @@
+import os
+from infer_metadata import build_parser, run_feature_generation
+from ml_prediction import predict_metadata
+from metadata_file_creation import create_metadata, model1, model2
+from prediction_server import request_predictions
+
+# In-memory Python API of infer_metadata.py: the features, predictions and metadata are passed between
+# the stages as DataFrames instead of being written to CSV files and read back by the next stage.
+# The idXML files and the result caches are still kept in output_dir.
+
+class Pipeline:
+    """Metadata inference for the mzML files in mzml_dir. Options are the command line arguments of
+    infer_metadata.py (e.g. database="swissprot.fasta", comet_exe="comet.exe", sequential=True).
+    With write_intermediate, the same CSV and FileInfo files as on the command line are written as well."""
+
+    def __init__(self, mzml_dir, output_dir, write_intermediate=False, **options):
+        self.args = build_parser().parse_args(["--mzml_dir", mzml_dir, "--output_dir", output_dir])
+        for name, value in options.items():
+            if not hasattr(self.args, name):
+                raise TypeError(f"Unknown pipeline option: {name}")
+            setattr(self.args, name, value)
+        self.args.write_intermediate = write_intermediate
+
+    def extract_features(self, finish=None):
+        """Runs steps 1-6 and returns the features of all mzML files. finish is called with the features
+        before returning, see run_feature_generation."""
+        return run_feature_generation(self.args, finish)
+
+    def predict(self, feature_df):
+        """Returns the {model: predictions} of the features, from the prediction server if one is set."""
+        if self.args.prediction_server:
+            predictions, _ = request_predictions(self.args.prediction_server, feature_df)
+            return predictions
+        return predict_metadata(feature_df)
+
+    def create_metadata(self, predictions):
+        """Combines the predictions of both models into the metadata of every file."""
+        return create_metadata(predictions[model1], predictions[model2])
+
+    def run(self):
+        """Runs all steps and returns the metadata as a DataFrame. With distributed=True, only the worker
+        creating the feature file predicts the metadata, the other workers return None."""
+        result = {}
+
+        def finish(feature_df):
+            predictions = self.predict(feature_df)
+            result["metadata"] = self.create_metadata(predictions)
+            if self.args.write_intermediate:
+                for model, y_pred_decoded in predictions.items():
+                    y_pred_decoded.to_csv(os.path.join(self.args.output_dir, f"{model}_predicted_metadata.csv"), index = False)
+                result["metadata"].to_csv(os.path.join(self.args.output_dir, "metadata_result.csv"), index = False)
+
+        self.extract_features(finish)
+        return result.get("metadata")
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import urllib.request
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ml_prediction import MODELS, get_model, predict_metadata_batch
+from metadata_file_creation import create_metadata, model1, model2
+
+# Local prediction server: keeps the models of ml_prediction loaded and answers prediction requests
+# of concurrent pipeline runs over localhost HTTP. Requests arriving within a few milliseconds are
+# predicted together in one micro-batch.
+
+def to_json(df):
+    return df.to_dict("split", index=False)
+
+def from_json(data):
+    return pd.DataFrame(data["data"], columns=data["columns"])
+
+class MicroBatcher:
+    """Collects the feature DataFrames of concurrent requests and predicts them in batches of up to
+    max_batch rows, waiting at most max_wait seconds for further requests."""
+
+    def __init__(self, max_batch=256, max_wait=0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.jobs = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, feature_df):
+        """Queues a feature DataFrame and returns its (predictions, metadata) once its batch is done."""
+        job = {"features": feature_df, "done": threading.Event()}
+        self.jobs.put(job)
+        job["done"].wait()
+        if "error" in job:
+            raise job["error"]
+        return job["result"]
+
+    def collect(self):
+        jobs = [self.jobs.get()]
+        rows = len(jobs[0]["features"])
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self.jobs.get(timeout=timeout)
+            except queue.Empty:
+                break
+            jobs.append(job)
+            rows += len(job["features"])
+        return jobs, rows
+
+    def predict(self, jobs):
+        predictions = predict_metadata_batch([job["features"] for job in jobs])
+        for job, prediction in zip(jobs, predictions):
+            job["result"] = prediction, create_metadata(prediction[model1], prediction[model2])
+
+    def run(self):
+        while True:
+            jobs, rows = self.collect()
+            start = time.monotonic()
+            try:
+                self.predict(jobs)
+            except Exception:
+                # Predict the requests one by one, so only the request causing the error fails
+                for job in jobs:
+                    try:
+                        self.predict([job])
+                    except Exception as e:
+                        job["error"] = e
+            for job in jobs:
+                job["done"].set()
+            print(f"Predicted {rows} rows of {len(jobs)} requests in {1000 * (time.monotonic() - start):.1f} ms")
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """POST /predict with the features as {"columns": [...], "data": [[...], ...]} returns the
+    predictions per model and the metadata in the same format. GET /health lists the loaded models."""
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, default=lambda o: o.item()).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"models": MODELS})
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            predictions, metadata = self.server.batcher.submit(from_json(request))
+        except Exception as e:
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send_json(200, {"predictions": {model: to_json(df) for model, df in predictions.items()},
+                             "metadata": to_json(metadata)})
+
+    def log_message(self, format, *args):
+        pass
+
+def request_predictions(server_url, feature_df, timeout=60):
+    """Sends features to a running prediction server and returns ({model: predictions}, metadata)."""
+    request = urllib.request.Request(f"{server_url.rstrip('/')}/predict",
+                                     data=json.dumps(to_json(feature_df), default=lambda o: o.item()).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        result = json.loads(response.read())
+    predictions = {model: from_json(data) for model, data in result["predictions"].items()}
+    return predictions, from_json(result["metadata"])
+
+def remote_prediction(server_url, output_dir, feature_df):
+    """Predicts the metadata with a prediction server and stores the same files as ml_prediction and metadata_file_creation."""
+    predictions, metadata = request_predictions(server_url, feature_df)
+    for model, y_pred_decoded in predictions.items():
+        y_pred_decoded.to_csv(os.path.join(output_dir, f"{model}_predicted_metadata.csv"), index = False)
+    metadata.to_csv(os.path.join(output_dir, f"metadata_result.csv"), index = False)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local prediction server keeping the metadata prediction models loaded.")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="Address to listen on (default: localhost only).")
+    parser.add_argument('--port', type=int, default=8765, help="Port to listen on.")
+    parser.add_argument('--max_batch', type=int, default=256, help="Maximum number of feature rows predicted in one batch.")
+    parser.add_argument('--max_wait_ms', type=float, default=5, help="Maximum time a request waits for further requests to batch with.")
+    args = parser.parse_args()
+
+    # Load all artifacts up front, so the first request does not pay for them
+    for model in MODELS:
+        artifacts = get_model(model)
+        artifacts.clf, artifacts.preprocessor, artifacts.label_encoders, artifacts.impute_values
+
+    server = ThreadingHTTPServer((args.host, args.port), PredictionHandler)
+    server.batcher = MicroBatcher(args.max_batch, args.max_wait_ms / 1000)
+    print(f"Prediction server listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import os
+import json
+import socket
+import hashlib
+import threading
+from work_claims import file_lock
+
+# Per-file result cache, so reruns only process new or changed files and the aggregate
+# CSV files can be rebuilt from the cached rows.
+
+class ResultCache:
+    """Caches one result record per input file in a JSON file. An entry stays valid as long as
+    size and modification time of the input file are unchanged. With use_hash, an entry whose
+    modification time changed is still valid if the SHA-256 of the content is unchanged, so copied
+    or touched files are not processed again."""
+
+    def __init__(self, cache_file, use_hash=False):
+        self.cache_file = cache_file
+        self.use_hash = use_hash
+        self.lock = threading.Lock()
+        self.entries = self.read()
+        self.updated = set()
+
+    def read(self):
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read cache {self.cache_file} ({e}). Recomputing all results.")
+            return {}
+
+    def signature(self, path):
+        stat = os.stat(path)
+        signature = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        if self.use_hash:
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+            signature["hash"] = sha.hexdigest()
+        return signature
+
+    def is_valid(self, entry, path):
+        stat = os.stat(path)
+        if entry["size"] != stat.st_size:
+            return False
+        if entry["mtime"] == stat.st_mtime_ns:
+            return True
+        if self.use_hash and "hash" in entry and entry["hash"] == self.signature(path)["hash"]:
+            # Remember the new modification time so the file is not hashed again next time
+            with self.lock:
+                entry["mtime"] = stat.st_mtime_ns
+                self.updated.add(os.path.abspath(path))
+            return True
+        return False
+
+    def get(self, path):
+        """Returns the cached record of a file or None if there is no valid entry."""
+        key = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or not os.path.exists(path) or not self.is_valid(entry, path):
+            return None
+        return entry["record"]
+
+    def put(self, path, record):
+        entry = self.signature(path)
+        entry["record"] = record
+        with self.lock:
+            self.entries[os.path.abspath(path)] = entry
+            self.updated.add(os.path.abspath(path))
+
+    def save(self):
+        """Writes the cache atomically, so an interrupted run does not leave a broken cache. Entries
+        written by other processes sharing the cache (e.g. workers with --distributed) are kept."""
+        os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+        tmp_file = f"{self.cache_file}.{socket.gethostname()}_{os.getpid()}.tmp"
+        # An O_EXCL lock file instead of flock, which many shared filesystems do not support
+        with file_lock(f"{self.cache_file}.merge.lock"):
+            with self.lock:
+                entries = self.read()
+                entries.update({key: self.entries[key] for key in self.updated})
+                self.entries = entries
+                with open(tmp_file, "w") as f:
+                    # NumPy scalars in the records are stored as plain numbers
+                    json.dump(self.entries, f, default=lambda o: o.item())
+            os.replace(tmp_file, self.cache_file)
+
+def open_cache(output_dir, name, use_hash=False):
+    """Opens the result cache output_dir/cache/{name}.json."""
+    return ResultCache(os.path.join(output_dir, "cache", f"{name}.json"), use_hash)
@@ -1,7 +1,82 @@
 import os
 import subprocess
+import threading
+import shutil
 import time
+import math
 import re
+from types import SimpleNamespace
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from create_feature_file import get_pephit_stats
+from subsample_spectra import subsample_mzml, write_sample_info, sample_info_path, plan_spectrum_batches, write_spectra, leader_converged
+from peptide_mass_index import read_prescreen, leading_organism
+
+# Work a single Comet thread is given: files with few spectra (or few bytes if the spectrum count
+# is unknown) get fewer threads, as they cannot keep many threads busy
+SPECTRA_PER_THREAD = 2000
+BYTES_PER_THREAD = 100 << 20
+MAX_THREADS = 16
+
+class CoreBudget:
+    """Global budget of CPU cores shared by all concurrently running CometAdapter jobs.
+    A job waits until enough cores are free for its threads."""
+
+    def __init__(self, cores):
+        self.cores = max(1, cores)
+        self.free = self.cores
+        self.condition = threading.Condition()
+
+    def acquire(self, threads):
+        threads = min(threads, self.cores)
+        with self.condition:
+            self.condition.wait_for(lambda: self.free >= threads)
+            self.free -= threads
+        return threads
+
+    def release(self, threads):
+        with self.condition:
+            self.free += threads
+            self.condition.notify_all()
+
+def comet_threads(mzml_path, num_spectra=None, max_threads=MAX_THREADS):
+    """Number of Comet threads for a file, based on its spectrum count or, if unknown, its file size."""
+    if num_spectra:
+        threads = math.ceil(num_spectra / SPECTRA_PER_THREAD)
+    else:
+        threads = math.ceil(os.path.getsize(mzml_path) / BYTES_PER_THREAD)
+    return max(1, min(threads, max_threads))
+
+# Digestion and modification settings of the searches (the CometAdapter defaults). They are passed to
+# CometAdapter explicitly, as a search against a Comet peptide index takes them from the index, which is
+# built for the same settings.
+DIGESTION_SETTINGS = {
+    "enzyme": "Trypsin",
+    "num_enzyme_termini": "fully",
+    "missed_cleavages": 1,
+    "fixed_modifications": ["Carbamidomethyl (C)"],
+    "variable_modifications": ["Oxidation (M)"],
+    "digest_mass_range": "600:5000",
+}
+
+job_log_lock = threading.Lock()
+
+def log_comet_job(job_log, mzml_file, threads, wall_time, usage, returncode):
+    """Appends wall time and CPU use of a CometAdapter job to the job log, so the thread split can be tuned."""
+    cpu_time = usage.ru_utime + usage.ru_stime if usage is not None else float("nan")
+    utilization = cpu_time / (wall_time * threads) if wall_time > 0 else float("nan")
+    print(f"CometAdapter {mzml_file}: {threads} threads, {wall_time:.2f} s wall time, {cpu_time:.2f} s CPU time "
+          f"({100 * utilization:.0f}% of the allocated cores)")
+    if job_log is None:
+        return
+    with job_log_lock:
+        new_log = not os.path.exists(job_log)
+        with open(job_log, "a") as f:
+            if new_log:
+                f.write("file\tthreads\twall_time_s\tuser_time_s\tsystem_time_s\tcore_utilization\treturncode\n")
+            user_time = usage.ru_utime if usage is not None else float("nan")
+            system_time = usage.ru_stime if usage is not None else float("nan")
+            f.write(f"{mzml_file}\t{threads}\t{wall_time:.2f}\t{user_time:.2f}\t{system_time:.2f}\t{utilization:.3f}\t{returncode}\n")
 
 # Function to read parameters from file
 def read_comet_params(file_path,
@@ -33,7 +108,23 @@ def read_comet_params(file_path,
     return precursor_mass_tolerance_val, fragment_mass_tolerance_val, activation_method_val, instrument_val
             
 
-def run_comet_adapter(data_dir, output_dir, db, cometexe):
+def search_database(db, comet_index=None, digestion=DIGESTION_SETTINGS):
+    """Database passed to CometAdapter: the cached peptide index of db for the digestion settings with a CometIndex,
+    db otherwise."""
+    return comet_index.index(db, digestion) if comet_index is not None else db
+
+def run_comet_adapter(data_dir, output_dir, db, cometexe, total_cores=None, max_threads=MAX_THREADS, fileinfo_records=None,
+                      sample_fraction=None, min_sample_spectra=500, databases=None, comet_index=None,
+                      adaptive_batch=None, adaptive_tolerance=0.05, prescreen_min_share=None, prescreen_hit_scale=None,
+                      prescreen_databases=None, prescreen_dir=None):
+    """Runs CometAdapter for all mzML files, with several jobs at once sharing a budget of total_cores
+    (default: all cores). Every job gets threads according to the spectrum count of its file
+    (from fileinfo_records if given) or its file size. The largest files are started first.
+    With a sample_fraction, only a stratified sample of the MS2 spectra of every file is searched.
+    With a TieredDatabase, every file is searched with the two-stage taxonomy-aware search.
+    With a CometIndex, the files are searched against the cached peptide index of the database.
+    With an adaptive_batch size, the spectra are searched in batches until the organism estimate is stable.
+    With a prescreen_min_share, files with a conclusive pre-screen are not searched or searched narrowed, see run_comet_search."""
     param_dir = os.path.join(output_dir, "param_files")
     prot_id_dir = os.path.join(output_dir, "idxml/")
     if not os.path.exists(prot_id_dir):
@@ -43,50 +134,219 @@ def run_comet_adapter(data_dir, output_dir, db, cometexe):
     # Read mzML files ending with '.mzML'
     mzml_files = [f for f in os.listdir(data_dir) if f.endswith('.mzML')]
 
-    # Process each mzML file
-    for mzml_file in mzml_files:
-        pride_id = mzml_file.split('_')[0]  # Extract part before the first '_'
-        filename = mzml_file.split('.mzML')[0]
-        idxml_file = f"{filename}_CometAdapter.idXML"
- 
-        # Run Comet only if no corresponding idXML file exists
-        if not os.path.exists(os.path.join(prot_id_dir, idxml_file)):
-
-            # Perform param search for file to receive adequate Comet results
-            param_filename = filename + '_params_comet_params.txt'
-            param_filepath = os.path.join(param_dir, param_filename)
-        
-            # Read and update parameters from the file
-            precursor_mass_tolerance_val, fragment_mass_tolerance_val, activation_method_val, instrument_val = read_comet_params(param_filepath)
-            print(fragment_mass_tolerance_val)
-
-            cmd = [
-                "CometAdapter",
-                "-in", os.path.join(data_dir, mzml_file),
-                "-out", os.path.join(prot_id_dir, idxml_file),
-                #"-default_params_file", param_filepath,
-                #"-database", "../data/proteomes/uniprot_sprot.fasta",
-                "-database", db,
-                #"-comet_executable", "/mnt/volume/elisa/orphan_test/master_thesis/Comet/comet.exe",
-                "-comet_executable", cometexe,
-                "-spectrum_batch_size", "0",
-                "-precursor_mass_tolerance", str(precursor_mass_tolerance_val),
-                "-fragment_mass_tolerance", str(fragment_mass_tolerance_val),
-                "-instrument", instrument_val,
-                "-activation_method", activation_method_val,
-                #"-decoy_string", "DECOY_",
-                "-threads", str(16),
-                "-force"
-            ]
-        
-            print(f"Running: {' '.join(cmd)}")
-            start_time = time.time()
-            try:
-                subprocess.run(cmd, check=True)
-            except subprocess.CalledProcessError:
-                with open(os.path.join(prot_id_dir, idxml_file), "w") as f:
-                    pass
-                print(f"Error processing {mzml_file}. Skipping to the next file.")
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            print(f"Time taken for {mzml_file}: {elapsed_time:.2f} seconds")
\ No newline at end of file
+    budget = CoreBudget(total_cores or os.cpu_count() or 1)
+    num_spectra = {r["Filename"]: r.get("num_spectra") for r in fileinfo_records or []}
+    threads = {f: comet_threads(os.path.join(data_dir, f), num_spectra.get(f), max_threads) for f in mzml_files}
+    job_log = os.path.join(output_dir, "comet_jobs.tsv")
+
+    # Process the mzML files concurrently, largest first so no large file is left running alone at the end
+    mzml_files.sort(key=lambda f: threads[f], reverse=True)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(mzml_files), budget.cores))) as executor:
+        list(executor.map(lambda f: run_comet_search(f, data_dir, param_dir, prot_id_dir, db, cometexe,
+                                                     threads[f], budget, job_log, sample_fraction, min_sample_spectra,
+                                                     databases, comet_index, adaptive_batch, adaptive_tolerance,
+                                                     prescreen_min_share, prescreen_hit_scale, prescreen_databases,
+                                                     prescreen_dir), mzml_files))
+
+def run_comet_search(mzml_file, data_dir, param_dir, prot_id_dir, db, cometexe, threads=MAX_THREADS, budget=None, job_log=None,
+                     sample_fraction=None, min_sample_spectra=500, databases=None, comet_index=None,
+                     adaptive_batch=None, adaptive_tolerance=0.05, prescreen_min_share=None, prescreen_hit_scale=None,
+                     prescreen_databases=None, prescreen_dir=None):
+    """Runs CometAdapter for a single mzML file unless its idXML file already exists.
+    If a core budget is given, the job waits until its threads are available in the budget.
+    With a sample_fraction, only a stratified sample of the MS2 spectra (at least min_sample_spectra) is searched.
+    With a TieredDatabase, the two-stage search replaces the search against db.
+    With a CometIndex, the cached peptide index of the database is searched instead of the FASTA file.
+    With an adaptive_batch size (and no TieredDatabase), the spectra are searched in batches of growing size
+    until the share of the leading organism is stable within +-adaptive_tolerance.
+    With a prescreen_min_share, a file whose pre-screen has a leading organism with at least this share of the
+    hits (read from prescreen_dir, default: prot_id_dir) is only searched against the full proteome of that organism from prescreen_databases (default: the
+    TieredDatabase). With a prescreen_hit_scale, its features come from the scaled pre-screen hits, so it
+    is not searched at all."""
+    filename = mzml_file.split('.mzML')[0]
+    idxml_file = f"{filename}_CometAdapter.idXML"
+
+    # Run Comet only if no corresponding idXML file exists
+    if not os.path.exists(os.path.join(prot_id_dir, idxml_file)):
+
+        mzml_path = os.path.join(data_dir, mzml_file)
+        idxml_path = os.path.join(prot_id_dir, idxml_file)
+        # The adaptive search is not combined with the tiered search, also if a pre-screen narrows the latter
+        tiered = databases is not None
+        if prescreen_min_share is not None:
+            leader = leading_organism(read_prescreen(os.path.join(prescreen_dir or prot_id_dir, idxml_file)), prescreen_min_share)
+            if leader is not None and prescreen_hit_scale is not None:
+                print(f"Pre-screen of {mzml_file} is conclusive ({leader}). Skipping CometAdapter.")
+                return
+            prescreen_databases = prescreen_databases or databases
+            if leader is not None and prescreen_databases is not None:
+                print(f"Pre-screen of {mzml_file} is conclusive ({leader}). Searching its full proteome only.")
+                db, databases = prescreen_databases.stage_two([leader]), None
+
+        # Perform param search for file to receive adequate Comet results
+        param_filename = filename + '_params_comet_params.txt'
+        param_filepath = os.path.join(param_dir, param_filename)
+
+        # Read and update parameters from the file
+        precursor_mass_tolerance_val, fragment_mass_tolerance_val, activation_method_val, instrument_val = read_comet_params(param_filepath)
+
+        # Search a reduced mzML file with a sample of the spectra, the sample size is stored next to the idXML file
+        sample_info = None
+        adaptive = bool(adaptive_batch) and not tiered
+        if sample_fraction and not adaptive:
+            tmp_dir = os.path.join(prot_id_dir, "tmp")
+            os.makedirs(tmp_dir, exist_ok=True)
+            mzml_path = os.path.join(tmp_dir, mzml_file)
+            sample_info = subsample_mzml(os.path.join(data_dir, mzml_file), mzml_path, sample_fraction, min_sample_spectra)
+            print(f"Searching {sample_info['sample_size']} of {sample_info['ms2_spectra']} MS2 spectra of {mzml_file}")
+            threads = min(threads, comet_threads(mzml_path, sample_info["sample_size"]))
+        elif os.path.exists(sample_info_path(idxml_path)):
+            os.remove(sample_info_path(idxml_path))
+        sampled_path = mzml_path if sample_info is not None else None
+
+        if budget is not None:
+            threads = budget.acquire(threads)
+
+        tolerances = (precursor_mass_tolerance_val, fragment_mass_tolerance_val, activation_method_val, instrument_val)
+        start_time = time.time()
+        try:
+            if adaptive:
+                returncode, usage, sample_info = run_adaptive_search(mzml_file, mzml_path, idxml_path, search_database(db, comet_index),
+                                                                     cometexe, tolerances, threads, adaptive_batch, adaptive_tolerance)
+            elif databases is None:
+                returncode, usage = run_comet_process(comet_command(mzml_path, idxml_path, search_database(db, comet_index),
+                                                                    cometexe, tolerances, threads))
+            else:
+                returncode, usage = run_tiered_search(mzml_file, mzml_path, idxml_path, databases, cometexe, tolerances, threads,
+                                                      comet_index)
+        finally:
+            if budget is not None:
+                budget.release(threads)
+            if sampled_path is not None and os.path.exists(sampled_path):
+                os.remove(sampled_path)
+        if returncode != 0:
+            with open(idxml_path, "w") as f:
+                pass
+            print(f"Error processing {mzml_file}. Skipping to the next file.")
+        elif sample_info is not None:
+            write_sample_info(idxml_path, sample_info)
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        print(f"Time taken for {mzml_file}: {elapsed_time:.2f} seconds")
+        log_comet_job(job_log, mzml_file, threads, elapsed_time, usage, returncode)
+
+def comet_command(mzml_path, idxml_path, db, cometexe, tolerances, threads, digestion=DIGESTION_SETTINGS):
+    precursor_mass_tolerance_val, fragment_mass_tolerance_val, activation_method_val, instrument_val = tolerances
+    return [
+        "CometAdapter",
+        "-in", mzml_path,
+        "-out", idxml_path,
+        #"-default_params_file", param_filepath,
+        #"-database", "../data/proteomes/uniprot_sprot.fasta",
+        "-database", db,
+        #"-comet_executable", "/mnt/volume/elisa/orphan_test/master_thesis/Comet/comet.exe",
+        "-comet_executable", cometexe,
+        "-spectrum_batch_size", "0",
+        "-precursor_mass_tolerance", str(precursor_mass_tolerance_val),
+        "-fragment_mass_tolerance", str(fragment_mass_tolerance_val),
+        "-instrument", instrument_val,
+        "-activation_method", activation_method_val,
+        "-enzyme", digestion["enzyme"],
+        "-num_enzyme_termini", digestion["num_enzyme_termini"],
+        "-missed_cleavages", str(digestion["missed_cleavages"]),
+        "-fixed_modifications", *digestion["fixed_modifications"],
+        "-variable_modifications", *digestion["variable_modifications"],
+        "-digest_mass_range", digestion["digest_mass_range"],
+        #"-decoy_string", "DECOY_",
+        "-threads", str(threads),
+        "-force"
+    ]
+
+def run_comet_process(cmd):
+    """Runs a CometAdapter command and returns its return code and resource usage."""
+    print(f"Running: {' '.join(cmd)}")
+    process = subprocess.Popen(cmd)
+    # wait4 returns the resource usage of CometAdapter and the Comet process it waited for
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        return os.waitstatus_to_exitcode(status), usage
+    return process.wait(), None
+
+def run_tiered_search(mzml_file, mzml_path, idxml_path, databases, cometexe, tolerances, threads, comet_index=None):
+    """Searches the stage one database and, if its result is ambiguous, the full proteomes of the leading
+    organisms. The stage two result replaces the stage one result. Returns the return code and the
+    resource usage of both searches together."""
+    returncode, usage = run_comet_process(comet_command(mzml_path, idxml_path, search_database(databases.stage_one(), comet_index),
+                                                        cometexe, tolerances, threads))
+    if returncode != 0:
+        return returncode, usage
+
+    suffix_counts, _ = get_pephit_stats(idxml_path)
+    organisms = databases.stage_two_organisms(suffix_counts)
+    if not organisms:
+        print(f"Stage one search of {mzml_file} is conclusive, skipping stage two.")
+        return returncode, usage
+
+    print(f"Stage one search of {mzml_file} is ambiguous, searching the full proteomes of {', '.join(organisms)}.")
+    tmp_dir = os.path.join(os.path.dirname(idxml_path), "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, os.path.basename(idxml_path))
+    stage_two_returncode, stage_two_usage = run_comet_process(comet_command(
+        mzml_path, tmp_path, search_database(databases.stage_two(organisms), comet_index), cometexe, tolerances, threads))
+    if stage_two_returncode == 0:
+        os.replace(tmp_path, idxml_path)
+    else:
+        print(f"Stage two search of {mzml_file} failed, keeping the stage one result.")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return returncode, add_usage(usage, stage_two_usage)
+
+def add_usage(usage, other):
+    """Resource usage of two processes together, None if one of them is unknown."""
+    if usage is None or other is None:
+        return None
+    return SimpleNamespace(ru_utime=usage.ru_utime + other.ru_utime, ru_stime=usage.ru_stime + other.ru_stime)
+
+def run_adaptive_search(mzml_file, mzml_path, idxml_path, db, cometexe, tolerances, threads, batch_spectra, tolerance):
+    """Searches the eligible MS2 spectra in random batches of doubling size and updates the organism hit
+    counts after every batch. Stops as soon as the share of the leading organism is stable and merges the
+    batch results with IDMerger. Returns the return code, the resource usage and the sample information
+    with the number of spectra searched."""
+    tmp_dir = os.path.join(os.path.dirname(idxml_path), "tmp", mzml_file.split('.mzML')[0])
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        batches, sample_info = plan_spectrum_batches(mzml_path, batch_spectra)
+        if not batches:
+            returncode, usage = run_comet_process(comet_command(mzml_path, idxml_path, db, cometexe, tolerances, threads))
+            return returncode, usage, None
+
+        suffix_counts = Counter()
+        batch_idxmls = []
+        usage = SimpleNamespace(ru_utime=0.0, ru_stime=0.0)
+        for batch, selected in enumerate(batches):
+            # Every batch is written just before its search, so an early stop skips writing the remaining spectra
+            batch_path = os.path.join(tmp_dir, f"batch_{batch}.mzML")
+            batch_idxml = os.path.join(tmp_dir, f"batch_{batch}.idXML")
+            write_spectra(mzml_path, batch_path, selected)
+            returncode, batch_usage = run_comet_process(comet_command(batch_path, batch_idxml, db, cometexe, tolerances, threads))
+            os.remove(batch_path)
+            usage = add_usage(usage, batch_usage)
+            if returncode != 0:
+                return returncode, usage, None
+            batch_idxmls.append(batch_idxml)
+            suffix_counts.update(get_pephit_stats(batch_idxml)[0])
+            if leader_converged(suffix_counts, tolerance):
+                break
+
+        searched = sum(sample_info["batch_sizes"][:len(batch_idxmls)])
+        print(f"Adaptive search of {mzml_file}: searched {searched} of {sample_info['eligible_spectra']} spectra "
+              f"in {len(batch_idxmls)} batches, leading organism {suffix_counts.most_common(1)[0][0] if suffix_counts else 'none'}")
+        if len(batch_idxmls) == 1:
+            os.replace(batch_idxmls[0], idxml_path)
+        else:
+            returncode, merge_usage = run_comet_process(["IDMerger", "-in", *batch_idxmls, "-out", idxml_path])
+            usage = add_usage(usage, merge_usage)
+        sample_info.update({"sample_size": searched, "batches": len(batch_idxmls)})
+        return returncode, usage, sample_info
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,278 @@
+import os
+import base64
+import zlib
+import numpy as np
+import pandas as pd
+import xml.etree.ElementTree as ET
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from parse_keywords import KeywordMatcher
+from result_cache import open_cache
+
+# Single-pass mzML scanner: reads an mzML file once and extracts the same features that
+# create_feature_file.extract_features_from_txt pulls out of the OpenMS FileInfo output
+# (ranges, precursor charges, instrument, software, activation methods, peak and spectrum counts)
+# together with the keyword presence flags of parse_keywords.
+
+CHUNK_SIZE = 1 << 20
+
+# PSI-MS accessions of the activation methods, named as OpenMS FileInfo prints them
+activation_methods = {
+    "MS:1000133": "CID (Collision-induced dissociation)",
+    "MS:1000135": "PSD (Post-source decay)",
+    "MS:1000134": "PD (Plasma desorption)",
+    "MS:1000136": "SID (Surface-induced dissociation)",
+    "MS:1000242": "BIRD (Blackbody infrared radiative dissociation)",
+    "MS:1000250": "ECD (Electron capture dissociation)",
+    "MS:1000262": "IMD (Infrared multiphoton dissociation)",
+    "MS:1000282": "SORI (Sustained off-resonance irradiation)",
+    "MS:1002481": "HCID (High-energy collision-induced dissociation)",
+    "MS:1000433": "LCID (Low-energy collision-induced dissociation)",
+    "MS:1000435": "PHD (Photodissociation)",
+    "MS:1000598": "ETD (Electron transfer dissociation)",
+    "MS:1002631": "ETciD (Electron transfer and collision-induced dissociation)",
+    "MS:1002632": "EThcD (Electron transfer and higher-energy collision dissociation)",
+    "MS:1000599": "PQD (Pulsed q dissociation)",
+    "MS:1002472": "TRAP (trap-type collision-induced dissociation)",
+    "MS:1000422": "HCD (beam-type collision-induced dissociation)",
+    "MS:1001880": "INSOURCE (in-source collision-induced dissociation)",
+}
+# Order in which FileInfo lists the activation methods
+activation_method_order = list(activation_methods.values())
+
+# Instrument configuration cvParams that do not name the instrument model
+non_model_accessions = {"MS:1000529", "MS:1000032"}  # instrument serial number, customization
+
+# Software without a CV term of its own; OpenMS takes its name from the cvParam value
+custom_software_accession = "MS:1000799"
+
+# Name of the scan result cache, changed whenever the scanned features change
+scan_cache_name = "mzml_scan_v2"
+
+def software_name(processing_names, instrument_software):
+    """Returns the software feature shared by the scan and pyopenms backends: the last named data
+    processing software of the first spectrum that has one, else the instrument software."""
+    names = [name for name in processing_names if name]
+    if names:
+        return names[-1]
+    return instrument_software or "Not available"
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def decode_binary(text, params):
+    """Decodes a base64 binaryDataArray into a NumPy array, None for unsupported encodings."""
+    if not text:
+        return np.array([])
+    if params & {"MS:1002312", "MS:1002313", "MS:1002314"}:  # MS-Numpress
+        return None
+    data = base64.b64decode(text)
+    if "MS:1000574" in params:  # zlib compression
+        data = zlib.decompress(data)
+    dtype = "<f4" if "MS:1000521" in params else "<f8"
+    return np.frombuffer(data, dtype=dtype)
+
+def scan_mzml(mzml_path, keywords=None, chunk_size=CHUNK_SIZE):
+    """Reads an mzML file once and returns its FileInfo features and keyword presence flags."""
+    features = {
+        "instrument_model": "Not available",
+        "organism": "Not available",
+        "tissue": "Not available",
+        "disease": "Not available",
+        "software": "Not available",
+        "activation_method": "Not available",
+        "experiment_type": "Not available",
+        "fraction_identifier": "Not available",
+        "quantification_method": "Not available",
+        "cleavage_agent": "Not available",
+    }
+    matcher = KeywordMatcher(keywords or [])
+
+    param_groups = {}
+    software_names = {}
+    instrument_software = None
+    processing = {}
+    spectrum_processing = []
+    default_processing = None
+    instrument_models = []
+    charges = Counter()
+    activations = Counter()
+    rt_min, rt_max = np.inf, -np.inf
+    mz_min, mz_max = np.inf, -np.inf
+    int_min, int_max = np.inf, -np.inf
+    num_spectra = 0
+    total_peaks = 0
+    numpress_warned = False
+
+    parser = ET.XMLPullParser(events=("start", "end"))
+    stack = []
+    spectrum = None
+
+    with open(mzml_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+
+            matcher.feed(chunk)
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                name = local_name(elem.tag)
+                if event == "start":
+                    stack.append(elem)
+                    if name == "spectrumList":
+                        default_processing = elem.get("defaultDataProcessingRef")
+                    elif name == "spectrum":
+                        ref = elem.get("dataProcessingRef") or default_processing
+                        if ref not in spectrum_processing:
+                            spectrum_processing.append(ref)
+                        num_spectra += 1
+                        total_peaks += int(elem.get("defaultArrayLength", 0))
+                        spectrum = {"ms_level": None, "activation": set(), "has_precursor": False}
+                    continue
+
+                stack.pop()
+                parent = local_name(stack[-1].tag) if stack else None
+
+                if name == "cvParam":
+                    accession = elem.get("accession")
+                    if parent == "referenceableParamGroup":
+                        param_groups.setdefault(stack[-1].get("id"), []).append(elem)
+                    elif parent == "instrumentConfiguration":
+                        instrument_models.append(elem)
+                    elif parent == "software":
+                        name_attribute = "value" if accession == custom_software_accession else "name"
+                        software_names[stack[-1].get("id")] = elem.get(name_attribute)
+                    elif spectrum is not None:
+                        if accession == "MS:1000511":  # ms level
+                            spectrum["ms_level"] = int(elem.get("value"))
+                        elif accession == "MS:1000016":  # scan start time
+                            rt = float(elem.get("value"))
+                            if elem.get("unitAccession") == "UO:0000031" or elem.get("unitName") == "minute":
+                                rt *= 60
+                            rt_min, rt_max = min(rt_min, rt), max(rt_max, rt)
+                        elif accession == "MS:1000041" and parent == "selectedIon":  # charge state
+                            charges[int(elem.get("value"))] += 1
+                            spectrum["charged_ions"] = spectrum.get("charged_ions", 0) + 1
+                        elif parent == "activation" and accession in activation_methods:
+                            spectrum["activation"].add(activation_methods[accession])
+                elif name == "referenceableParamGroupRef" and parent == "instrumentConfiguration":
+                    instrument_models.extend(param_groups.get(elem.get("ref"), []))
+                elif name == "softwareRef" and parent == "instrumentConfiguration":
+                    instrument_software = instrument_software or elem.get("ref")
+                elif name == "processingMethod" and parent == "dataProcessing":
+                    processing.setdefault(stack[-1].get("id"), []).append(elem.get("softwareRef"))
+                elif name == "precursor" and spectrum is not None:
+                    spectrum["has_precursor"] = True
+                    # FileInfo counts precursors without charge state as charge 0
+                    if not spectrum.pop("charged_ions", 0):
+                        charges[0] += 1
+                elif name == "binaryDataArray" and spectrum is not None:
+                    params = {p.get("accession") for p in elem if local_name(p.tag) == "cvParam"}
+                    binary = next((c for c in elem if local_name(c.tag) == "binary"), None)
+                    if params & {"MS:1000514", "MS:1000515"}:  # m/z or intensity array
+                        values = decode_binary(binary.text if binary is not None else None, params)
+                        if values is None:
+                            if not numpress_warned:
+                                print(f"Warning: MS-Numpress compressed arrays in {mzml_path} are not supported, peak ranges are incomplete.")
+                                numpress_warned = True
+                        elif values.size:
+                            if "MS:1000514" in params:
+                                mz_min, mz_max = min(mz_min, values.min()), max(mz_max, values.max())
+                            else:
+                                int_min, int_max = min(int_min, values.min()), max(int_max, values.max())
+                    elem.clear()
+                elif name == "offset":
+                    stack[-1].remove(elem)
+                elif name in ("spectrum", "chromatogram"):
+                    if name == "spectrum":
+                        if spectrum["has_precursor"]:
+                            activations[(spectrum["ms_level"], tuple(sorted(spectrum["activation"], key=activation_method_order.index)))] += 1
+                        spectrum = None
+                    # Drop finished spectra so memory stays flat
+                    elem.clear()
+                    if stack:
+                        stack[-1].remove(elem)
+
+    # Instrument model: first instrument configuration cvParam naming a model
+    for param in instrument_models:
+        if param.get("accession") not in non_model_accessions and not param.get("value"):
+            features["instrument_model"] = param.get("name")
+            break
+
+    # Software: named data processing software of the spectra, else the instrument software
+    names = []
+    for ref in spectrum_processing:
+        names = [software_names.get(software) for software in processing.get(ref, [])]
+        if any(names):
+            break
+    features["software"] = software_name(names, software_names.get(instrument_software))
+
+    # Activation method: first entry of the FileInfo activation method listing
+    if activations:
+        ms_level, methods = min(activations, key=lambda k: (k[0] or 0, [activation_method_order.index(m) for m in k[1]]))
+        if methods:
+            features["activation_method"] = ", ".join(methods)
+
+    if num_spectra:
+        if rt_min <= rt_max:
+            features["rt_min"], features["rt_max"] = float(rt_min), float(rt_max)
+        if mz_min <= mz_max:
+            features["mz_min"], features["mz_max"] = float(mz_min), float(mz_max)
+        if int_min <= int_max:
+            features["intensity_min"], features["intensity_max"] = float(int_min), float(int_max)
+    for charge in sorted(charges):
+        features[f"precursor_charge_{charge}"] = charges[charge]
+    features["total_peaks"] = total_peaks
+    features["num_spectra"] = num_spectra
+
+    return features, matcher.presence
+
+def scan_mzml_file(mzml_file, mzml_dir, keywords):
+    """Scans a single mzML file and returns its FileInfo feature record and keyword record, None on errors."""
+    print(f"Scanning {mzml_file}")
+    try:
+        features, keyword_presence = scan_mzml(os.path.join(mzml_dir, mzml_file), keywords)
+    except Exception as e:
+        print(f"Error processing {mzml_file}: {e}")
+        return None
+    features["Filename"] = mzml_file
+    return features, {"Filename": mzml_file, **keyword_presence}
+
+def cached_scan(cache, mzml_dir, mzml_file, keywords):
+    """Returns the cached scan result of a file, None if it is new or changed or the keyword list changed since."""
+    result = cache.get(os.path.join(mzml_dir, mzml_file))
+    if result is not None and set(result[1]) != {"Filename", *keywords}:
+        return None
+    return result
+
+def write_keyword_results(keyword_records, output_dir):
+    """Stores keyword records in the same CSV file parse_keywords creates."""
+    output_file = os.path.join(output_dir, "keyword_parsing_results.csv")
+    pd.DataFrame(keyword_records).to_csv(output_file, index=False)
+    print(f"Keyword parsing completed. Results saved to {output_file}")
+
+def scan_mzml_files(mzml_dir, output_dir, keywords, max_workers=4, use_hash=False):
+    """Scans all new or changed mzML files of a directory in parallel, stores the keyword parsing
+    results and returns the FileInfo feature records. Results are cached per mzML file."""
+    mzml_files = [f for f in os.listdir(mzml_dir) if f.endswith(".mzML")]
+    cache = open_cache(output_dir, scan_cache_name, use_hash)
+    results = {f: cached_scan(cache, mzml_dir, f, keywords) for f in mzml_files}
+    missing = [f for f in mzml_files if results[f] is None]
+
+    if missing:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            scanned = list(executor.map(scan_mzml_file, missing, [mzml_dir]*len(missing), [keywords]*len(missing)))
+        # Failed files (None) are not cached and retried on the next run
+        for f, result in zip(missing, scanned):
+            if result is not None:
+                cache.put(os.path.join(mzml_dir, f), result)
+                results[f] = result
+        cache.save()
+    print(f"mzML scan: {len(missing)} new or changed files scanned, {len(mzml_files) - len(missing)} taken from cache.")
+
+    # Remove None values (failed files)
+    results = [results[f] for f in mzml_files if results[f] is not None]
+
+    write_keyword_results([keyword_record for _, keyword_record in results], output_dir)
+    return [features for features, _ in results]
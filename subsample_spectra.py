@@ -0,0 +1,182 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyopenms as oms
+
+# Spectrum subsampling for the organism estimate: the idXML output is only used to count organism
+# suffixes among good peptide hits, so CometAdapter can search a stratified sample of the MS2 spectra
+# instead of the whole file.
+
+# MS2 spectra with fewer peaks are not considered for the sample
+MIN_PEAKS = 10
+# Number of TIC and RT quantile bins, precursor charges above MAX_CHARGE_BIN share one bin
+TIC_BINS = 4
+RT_BINS = 5
+MAX_CHARGE_BIN = 4
+
+class SpectrumStatsConsumer:
+    """Consumer for MzMLFile().transform that collects TIC, precursor charge and RT of all MS2 spectra."""
+
+    def __init__(self):
+        self.index = 0
+        self.ms2_spectra = 0
+        self.stats = []  # (spectrum index, TIC, charge, RT) of the eligible MS2 spectra
+
+    def setExpectedSize(self, num_spectra, num_chromatograms):
+        pass
+
+    def setExperimentalSettings(self, settings):
+        pass
+
+    def consumeChromatogram(self, chromatogram):
+        pass
+
+    def consumeSpectrum(self, spectrum):
+        if spectrum.getMSLevel() == 2:
+            self.ms2_spectra += 1
+            precursors = spectrum.getPrecursors()
+            mz, intensity = spectrum.get_peaks()
+            if precursors and mz.size >= MIN_PEAKS:
+                self.stats.append((self.index, float(intensity.sum()), precursors[0].getCharge(), spectrum.getRT()))
+        self.index += 1
+
+class SpectrumSampleWriter:
+    """Consumer for MzMLFile().transform that writes only the selected spectra to a new mzML file."""
+
+    def __init__(self, out_path, selected):
+        self.writer = oms.PlainMSDataWritingConsumer(out_path.encode())
+        self.selected = selected
+        self.index = 0
+
+    def setExpectedSize(self, num_spectra, num_chromatograms):
+        self.writer.setExpectedSize(len(self.selected), 0)
+
+    def setExperimentalSettings(self, settings):
+        self.writer.setExperimentalSettings(settings)
+
+    def consumeChromatogram(self, chromatogram):
+        pass
+
+    def consumeSpectrum(self, spectrum):
+        if self.index in self.selected:
+            self.writer.consumeSpectrum(spectrum)
+        self.index += 1
+
+def quantile_bins(values, num_bins):
+    """Assigns every value to one of num_bins quantile bins."""
+    edges = np.quantile(values, np.linspace(0, 1, num_bins + 1)[1:-1])
+    return np.searchsorted(edges, values, side="right")
+
+def select_spectra(stats, fraction, min_spectra, seed=0):
+    """Draws a stratified sample of spectrum indices from (index, TIC, charge, RT) tuples.
+    Strata are TIC bins x precursor charge x RT bins, and every stratum contributes in proportion to its size."""
+    if not stats:
+        return set()
+    stats = np.array(stats, dtype=float)
+    sample_size = min(len(stats), max(min_spectra, int(np.ceil(fraction * len(stats)))))
+
+    strata = pd.DataFrame({
+        "index": stats[:, 0].astype(int),
+        "tic": quantile_bins(stats[:, 1], TIC_BINS),
+        "charge": np.minimum(stats[:, 2], MAX_CHARGE_BIN).astype(int),
+        "rt": quantile_bins(stats[:, 3], RT_BINS),
+    })
+    groups = list(strata.groupby(["tic", "charge", "rt"])["index"])
+
+    # Proportional allocation, the remaining spectra go to the strata with the largest remainders
+    sizes = np.array([len(indices) for _, indices in groups])
+    quotas = sizes * sample_size / sizes.sum()
+    counts = np.floor(quotas).astype(int)
+    for i in np.argsort(counts - quotas)[:sample_size - counts.sum()]:
+        counts[i] += 1
+
+    rng = np.random.default_rng(seed)
+    selected = set()
+    for (_, indices), count in zip(groups, counts):
+        selected.update(int(i) for i in rng.choice(indices.to_numpy(), size=count, replace=False))
+    return selected
+
+def subsample_mzml(mzml_path, out_path, fraction=0.1, min_spectra=500, seed=0):
+    """Writes a reduced mzML file with a stratified sample of the MS2 spectra of an mzML file.
+    Returns the sample information (number of MS2 spectra, eligible spectra and sample size)."""
+    consumer = SpectrumStatsConsumer()
+    oms.MzMLFile().transform(mzml_path.encode(), consumer)
+    selected = select_spectra(consumer.stats, fraction, min_spectra, seed)
+    oms.MzMLFile().transform(mzml_path.encode(), SpectrumSampleWriter(out_path, selected))
+    return {"ms2_spectra": consumer.ms2_spectra, "eligible_spectra": len(consumer.stats), "sample_size": len(selected)}
+
+def plan_spectrum_batches(mzml_path, batch_spectra=1000, seed=0):
+    """Splits the eligible MS2 spectra of an mzML file in random order into batches. The first batch has
+    batch_spectra spectra and every further batch twice as many as the one before. Returns the spectrum
+    indices of every batch and the sample information with the batch sizes."""
+    consumer = SpectrumStatsConsumer()
+    oms.MzMLFile().transform(mzml_path.encode(), consumer)
+    indices = np.random.default_rng(seed).permutation([index for index, _, _, _ in consumer.stats])
+
+    sizes, size = [], batch_spectra
+    while sum(sizes) < len(indices):
+        sizes.append(min(size, len(indices) - sum(sizes)))
+        size *= 2
+    batches = [set(int(index) for index in chunk) for chunk in np.split(indices, np.cumsum(sizes)[:-1])] if sizes else []
+    return batches, {"ms2_spectra": consumer.ms2_spectra, "eligible_spectra": len(consumer.stats), "batch_sizes": sizes}
+
+def write_spectra(mzml_path, out_path, selected):
+    """Writes the spectra with the selected indices of an mzML file to a new mzML file."""
+    oms.MzMLFile().transform(mzml_path.encode(), SpectrumSampleWriter(out_path, selected))
+
+def wilson_interval(successes, trials, z=1.96):
+    """Wilson score interval of a proportion."""
+    p = successes / trials
+    denominator = 1 + z ** 2 / trials
+    center = (p + z ** 2 / (2 * trials)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+    return center - half_width, center + half_width
+
+def leader_converged(suffix_counts, tolerance=0.05, min_hits=50, z=1.96):
+    """The share of the leading organism is stable once its Wilson interval is at most +-tolerance
+    wide and lies above the interval of the second organism."""
+    total = sum(suffix_counts.values())
+    if total < min_hits:
+        return False
+    ranked = sorted(suffix_counts.values(), reverse=True)
+    low, high = wilson_interval(ranked[0], total, z)
+    if (high - low) / 2 > tolerance:
+        return False
+    return len(ranked) == 1 or low > wilson_interval(ranked[1], total, z)[1]
+
+def sample_info_path(idxml_path):
+    """Path of the file storing the sample information next to an idXML file."""
+    return idxml_path.split("_CometAdapter.idXML")[0] + "_subsample.json"
+
+def write_sample_info(idxml_path, info):
+    with open(sample_info_path(idxml_path), "w") as f:
+        json.dump(info, f)
+
+def read_sample_info(idxml_path):
+    """Returns the sample information of an idXML file searched on a spectrum sample, None otherwise."""
+    path = sample_info_path(idxml_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def write_organism_proportions(idxml_dir, idxml_records, output_dir):
+    """Stores the per-organism hit proportions of every file together with the sample size they are based on."""
+    rows = []
+    for record in idxml_records:
+        info = read_sample_info(os.path.join(idxml_dir, record["Filename"].split(".mzML")[0] + "_CometAdapter.idXML"))
+        counts = {col[:-len("_counthits")]: record[col] for col in record
+                  if col.endswith("_counthits") and not pd.isna(record[col])}
+        total = sum(counts.values())
+        for organism, count in sorted(counts.items(), key=lambda item: -item[1]):
+            rows.append({
+                "Filename": record["Filename"],
+                "organism": organism,
+                "proportion": count / total if total else np.nan,
+                "sample_size": info["sample_size"] if info else np.nan,
+                "ms2_spectra": info["ms2_spectra"] if info else np.nan,
+            })
+    output_file = os.path.join(output_dir, "organism_proportions.csv")
+    pd.DataFrame(rows, columns=["Filename", "organism", "proportion", "sample_size", "ms2_spectra"]).to_csv(output_file, index=False)
+    print(f"Organism hit proportions saved to {output_file}")
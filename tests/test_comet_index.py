@@ -0,0 +1,26 @@
+from comet_index import CometIndex, index_settings
+from run_comet_adapter import DIGESTION_SETTINGS
+
+
+def test_index_settings_follow_digestion():
+    settings = index_settings(DIGESTION_SETTINGS)
+    assert settings["search_enzyme_number"] == "1"
+    assert settings["allowed_missed_cleavage"] == "1"
+    assert settings["add_C_cysteine"] == "57.021464"
+    assert settings["variable_mod01"].startswith("15.9949 M")
+    assert index_settings(dict(DIGESTION_SETTINGS, missed_cleavages=2))["allowed_missed_cleavage"] == "2"
+    assert index_settings(dict(DIGESTION_SETTINGS, fixed_modifications=[]))["add_C_cysteine"] == "0.0"
+
+
+def test_distinct_settings_get_distinct_indices(tmp_path):
+    db = tmp_path / "db.fasta"
+    db.write_text(">P1\nPEPTIDEK\n")
+    comet_index = CometIndex("comet.exe", str(tmp_path / "cache"))
+    default = comet_index.index_dir(str(db), index_settings(DIGESTION_SETTINGS))
+    other = comet_index.index_dir(str(db), index_settings(dict(DIGESTION_SETTINGS, missed_cleavages=2)))
+    assert default != other
+
+
+def test_unknown_settings_search_fasta(tmp_path):
+    comet_index = CometIndex("comet.exe", str(tmp_path / "cache"))
+    assert comet_index.index("db.fasta", dict(DIGESTION_SETTINGS, enzyme="PepsinA")) == "db.fasta"
@@ -0,0 +1,59 @@
+import sys
+import time
+import numpy as np
+from estimate_tolerances import BIN_WIDTH, MAX_CANDIDATES, MAX_PRECURSOR_PPM, MAX_SCAN_SEPARATION, MIN_SHARED_PEAKS, pair_spectra
+
+def pair_spectra_loop(scans, precursor_mz, charges, peaks):
+    """Reference pairing with one intersect1d per candidate pair."""
+    bins = [np.unique(np.round(p / BIN_WIDTH).astype(np.int64)) for p in peaks]
+    order = np.lexsort((precursor_mz, charges))
+    used = np.zeros(len(order), dtype=bool)
+    pairs = []
+    for pos, i in enumerate(order):
+        if used[i]:
+            continue
+        candidates = []
+        for j in order[pos + 1:pos + 1 + MAX_CANDIDATES]:
+            if charges[j] != charges[i] or (precursor_mz[j] - precursor_mz[i]) / precursor_mz[i] * 1e6 > MAX_PRECURSOR_PPM:
+                break
+            if used[j] or abs(scans[j] - scans[i]) > MAX_SCAN_SEPARATION:
+                continue
+            if np.intersect1d(bins[i], bins[j], assume_unique=True).size >= MIN_SHARED_PEAKS:
+                candidates.append(j)
+        if candidates:
+            j = min(candidates, key=lambda j: abs(scans[j] - scans[i]))
+            used[i] = used[j] = True
+            pairs.append((i, j) if scans[i] < scans[j] else (j, i))
+    return pairs
+
+def spectra(n, seed=0):
+    """Spectra of n / 4 peptides in scan order, 80% with the fragments of their peptide, the rest random."""
+    rng = np.random.default_rng(seed)
+    peptides = rng.uniform(400, 1500, max(n // 4, 1))
+    fragments = [rng.uniform(150, 1500, 20) for _ in peptides]
+    peptide = np.sort(rng.integers(0, len(peptides), n))
+    precursor_mz = peptides[peptide] * (1 + rng.normal(0, 3e-6, n))
+    charges = rng.integers(2, 4, n)
+    peaks = [np.sort(fragments[k] + rng.normal(0, 0.01, 20) if rng.random() < 0.8 else rng.uniform(150, 1500, 20)) for k in peptide]
+    return np.arange(n), precursor_mz, charges, peaks
+
+def test_pairs_match_reference():
+    data = spectra(4000)
+    pairs = pair_spectra(*data)
+    assert len(pairs) > 500
+    assert pairs == pair_spectra_loop(*data)
+
+def test_no_spectra():
+    assert pair_spectra(np.array([], dtype=int), np.array([]), np.array([], dtype=int), []) == []
+
+if __name__ == "__main__":
+    # Benchmark: python tests/test_estimate_tolerances.py [spectra ...]
+    for n in map(int, sys.argv[1:] or ["10000", "100000"]):
+        data = spectra(n)
+        start = time.perf_counter()
+        reference = pair_spectra_loop(*data)
+        middle = time.perf_counter()
+        pairs = pair_spectra(*data)
+        end = time.perf_counter()
+        assert pairs == reference
+        print(f"{n} spectra, {len(pairs)} pairs: loop {middle - start:.2f} s, vectorized {end - middle:.2f} s")
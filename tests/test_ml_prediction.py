@@ -0,0 +1,21 @@
+import json
+import pandas as pd
+from ml_prediction import ModelArtifacts, align_features
+
+def test_aligned_features_get_training_dtypes(tmp_path):
+    table = {
+        "columns": ["HUMAN_counthits", "num_spectra", "instrument_model"],
+        "dtypes": {"HUMAN_counthits": "float64", "num_spectra": "int64", "instrument_model": "object"},
+        "impute_values": {"HUMAN_counthits": 2.5},
+    }
+    with open(tmp_path / "m_feature_table.json", "w") as f:
+        json.dump(table, f)
+    artifacts = ModelArtifacts("m", str(tmp_path))
+
+    aligned = align_features(pd.DataFrame([{"num_spectra": "1200", "instrument_model": "Q Exactive", "extra": 1}]), artifacts)
+
+    assert list(aligned.columns) == table["columns"]
+    assert aligned.loc[0, "HUMAN_counthits"] == 2.5
+    # Integer columns are floats, so features missing in a file can stay NaN
+    assert aligned.dtypes.astype(str).to_dict() == {"HUMAN_counthits": "float64", "num_spectra": "float64", "instrument_model": "object"}
+    assert aligned.loc[0, "num_spectra"] == 1200.0
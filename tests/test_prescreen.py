@@ -0,0 +1,43 @@
+import json
+import os
+from types import SimpleNamespace
+import pandas as pd
+from create_feature_file import extract_file_features
+from ml_prediction import align_features
+from run_comet_adapter import run_comet_search
+
+def write_prescreen(idxml_dir, mzml_file, hits):
+    path = os.path.join(idxml_dir, f"{mzml_file.split('.mzML')[0]}_prescreen.json")
+    with open(path, "w") as f:
+        json.dump({"ms2_spectra": 5000, "hits": hits}, f)
+
+def test_skipped_file_gets_prescreen_organism_features(tmp_path):
+    idxml_dir = tmp_path / "idxml"
+    idxml_dir.mkdir()
+    write_prescreen(idxml_dir, "Y_1.mzML", {"YEAST": 1200.0, "HUMAN": 40.0})
+
+    # Neither the parameter file, the database nor Comet exist: a conclusive pre-screen skips the search
+    run_comet_search("Y_1.mzML", str(tmp_path), str(tmp_path / "param_files"), str(idxml_dir), "missing.fasta", "missing.exe",
+                     prescreen_min_share=0.8, prescreen_hit_scale=0.5)
+    assert not (idxml_dir / "Y_1_CometAdapter.idXML").exists()
+
+    _, idxml_record = extract_file_features("Y_1.mzML", str(tmp_path / "fileinfo"), str(idxml_dir), prescreen_hit_scale=0.5)
+    artifacts = SimpleNamespace(feature_columns=["YEAST_counthits", "HUMAN_counthits", "MOUSE_counthits"],
+                                impute_values=pd.Series({"YEAST_counthits": 7.0, "HUMAN_counthits": 300.0, "MOUSE_counthits": 3.0}),
+                                feature_dtypes=dict.fromkeys(["YEAST_counthits", "HUMAN_counthits", "MOUSE_counthits"], "float64"))
+    aligned = align_features(pd.DataFrame([idxml_record]), artifacts)
+
+    assert aligned.loc[0, "YEAST_counthits"] == 600.0
+    assert aligned.loc[0, "HUMAN_counthits"] == 20.0
+    # Organisms without pre-screen hits are still imputed
+    assert aligned.loc[0, "MOUSE_counthits"] == 3.0
+
+def test_prescreen_hits_are_imputed_without_hit_scale(tmp_path):
+    write_prescreen(tmp_path, "Y_1.mzML", {"YEAST": 1200.0})
+
+    _, idxml_record = extract_file_features("Y_1.mzML", str(tmp_path), str(tmp_path))
+    artifacts = SimpleNamespace(feature_columns=["YEAST_counthits"], impute_values=pd.Series({"YEAST_counthits": 7.0}),
+                                feature_dtypes={"YEAST_counthits": "float64"})
+
+    assert idxml_record["YEAST_prescreenhits"] == 1200.0
+    assert align_features(pd.DataFrame([idxml_record]), artifacts).loc[0, "YEAST_counthits"] == 7.0
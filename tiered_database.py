@@ -0,0 +1,167 @@
+import os
+import re
+import json
+import socket
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+
+# Two-stage taxonomy-aware database search: only the organism suffixes of the protein accessions are
+# used from the Comet results, so stage one searches a small database of proteins that discriminate
+# between organisms plus the full proteomes of the organisms with the most proteins in the database.
+# Only if stage one is ambiguous, stage two searches the full proteomes of the leading organisms.
+# The reduced FASTA databases are built from the given database once and cached.
+
+# Number of proteins with the most organism-specific tryptic peptides kept per organism
+PROTEINS_PER_ORGANISM = 20
+MIN_PEPTIDE_LENGTH = 7
+MAX_PEPTIDE_LENGTH = 30
+# Stage two searches at most this many leading organisms with at least MIN_STAGE_TWO_SHARE of the hits
+STAGE_TWO_ORGANISMS = 3
+MIN_STAGE_TWO_SHARE = 0.05
+
+TRYPSIN = re.compile(r"(?<=[KR])(?!P)")
+
+def read_fasta(path):
+    """Yields (header, sequence) of all entries of a FASTA file."""
+    header, sequence = None, []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(sequence)
+                header, sequence = line, []
+            elif line:
+                sequence.append(line)
+    if header is not None:
+        yield header, "".join(sequence)
+
+def write_fasta_entry(f, header, sequence, width=60):
+    f.write(header + "\n")
+    for i in range(0, len(sequence), width):
+        f.write(sequence[i:i + width] + "\n")
+
+def accession(header):
+    return header[1:].split()[0] if len(header) > 1 else ""
+
+def organism_suffix(header):
+    """Organism suffix of a FASTA entry, split out of the accession as in create_feature_file.get_pephit_stats."""
+    return accession(header).split("|")[-1].split("_")[-1]
+
+def tryptic_peptides(sequence):
+    return {p for p in TRYPSIN.split(sequence) if MIN_PEPTIDE_LENGTH <= len(p) <= MAX_PEPTIDE_LENGTH}
+
+class TieredDatabase:
+    """Reduced FASTA databases of the two-stage search, cached in cache_dir."""
+
+    def __init__(self, db, cache_dir, top_organisms=10, min_share=0.8, proteins_per_organism=PROTEINS_PER_ORGANISM,
+                 decoy_string="DECOY_"):
+        self.db = db
+        self.top_organisms = top_organisms
+        self.min_share = min_share
+        self.proteins_per_organism = proteins_per_organism
+        self.decoy_string = decoy_string
+        self.lock = threading.Lock()
+
+        # The cache is specific to the database file and the reduction settings
+        stat = os.stat(db)
+        key = json.dumps([os.path.abspath(db), stat.st_size, stat.st_mtime_ns, top_organisms, proteins_per_organism,
+                          MIN_PEPTIDE_LENGTH, MAX_PEPTIDE_LENGTH, decoy_string])
+        name = os.path.splitext(os.path.basename(db))[0]
+        self.cache_dir = os.path.join(cache_dir, f"{name}_{hashlib.sha1(key.encode()).hexdigest()[:12]}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.info = None
+
+    def target_accession(self, header):
+        """Accession of the target entry of a decoy entry, None for target entries."""
+        acc = accession(header)
+        return acc[len(self.decoy_string):] if self.decoy_string and acc.startswith(self.decoy_string) else None
+
+    def write_fasta(self, path, keep):
+        """Writes all entries of the database whose target accession and organism pass keep(accession, organism)
+        to path. Decoy entries are kept together with their target entries."""
+        # Workers on other hosts may build the same database at the same time (--distributed)
+        tmp_path = f"{path}.{socket.gethostname()}_{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            for header, sequence in read_fasta(self.db):
+                acc = self.target_accession(header) or accession(header)
+                if keep(acc, organism_suffix(header)):
+                    write_fasta_entry(f, header, sequence)
+        os.replace(tmp_path, path)
+
+    def build_stage_one(self, path):
+        """Selects the discriminative proteins of every organism and the organisms with the most proteins."""
+        print(f"Building stage one database from {self.db}...")
+        accessions, organisms, hashes, proteins = [], [], [], []
+        for header, sequence in read_fasta(self.db):
+            if self.target_accession(header) is not None:
+                continue
+            peptides = tryptic_peptides(sequence)
+            hashes.append(np.fromiter((hash(p) for p in peptides), dtype=np.int64, count=len(peptides)))
+            proteins.append(np.full(len(peptides), len(accessions), dtype=np.int32))
+            accessions.append(accession(header))
+            organisms.append(organism_suffix(header))
+
+        protein_df = pd.DataFrame({"accession": accessions, "organism": organisms})
+        organism_ids = protein_df["organism"].astype("category").cat.codes.to_numpy()
+        hashes = np.concatenate(hashes) if hashes else np.array([], dtype=np.int64)
+        proteins = np.concatenate(proteins) if proteins else np.array([], dtype=np.int32)
+
+        # A peptide is organism-specific if all proteins containing it belong to the same organism
+        pairs = np.unique(np.stack([hashes, organism_ids[proteins].astype(np.int64)]), axis=1)
+        unique_hashes, counts = np.unique(pairs[0], return_counts=True)
+        specific = counts[np.searchsorted(unique_hashes, hashes)] == 1
+        protein_df["specific_peptides"] = np.bincount(proteins[specific], minlength=len(protein_df))
+
+        discriminative = (protein_df[protein_df["specific_peptides"] > 0]
+                          .sort_values(["organism", "specific_peptides"], ascending=[True, False])
+                          .groupby("organism").head(self.proteins_per_organism))
+        top_organisms = protein_df["organism"].value_counts().index[:self.top_organisms].tolist()
+
+        selected = set(discriminative["accession"])
+        top = set(top_organisms)
+        self.write_fasta(path, lambda acc, organism: acc in selected or organism in top)
+        info = {"top_organisms": top_organisms, "proteins": len(protein_df),
+                "stage_one_proteins": int(len(selected | set(protein_df.loc[protein_df["organism"].isin(top), "accession"])))}
+        info_path = os.path.join(self.cache_dir, "info.json")
+        with open(f"{info_path}.{socket.gethostname()}_{os.getpid()}.tmp", "w") as f:
+            json.dump(info, f)
+        os.replace(f"{info_path}.{socket.gethostname()}_{os.getpid()}.tmp", info_path)
+        print(f"Stage one database: {info['stage_one_proteins']} of {info['proteins']} proteins "
+              f"(full proteomes of {', '.join(top_organisms)}).")
+
+    def stage_one(self):
+        """Returns the path of the stage one database, building it if it is not cached yet."""
+        path = os.path.join(self.cache_dir, "stage_one.fasta")
+        with self.lock:
+            if not os.path.exists(path) or not os.path.exists(os.path.join(self.cache_dir, "info.json")):
+                self.build_stage_one(path)
+            if self.info is None:
+                with open(os.path.join(self.cache_dir, "info.json"), "r") as f:
+                    self.info = json.load(f)
+        return path
+
+    def stage_two(self, organisms):
+        """Returns the path of the database with the full proteomes of the given organisms."""
+        organisms = sorted(organisms)
+        path = os.path.join(self.cache_dir, f"stage_two_{'_'.join(organisms)}.fasta")
+        with self.lock:
+            if not os.path.exists(path):
+                print(f"Building stage two database for {', '.join(organisms)}...")
+                self.write_fasta(path, lambda acc, organism: organism in organisms)
+        return path
+
+    def stage_two_organisms(self, suffix_counts):
+        """Returns the leading organisms of the stage one hits if stage one is ambiguous, None otherwise.
+        Stage one is ambiguous if the leading organism has less than min_share of the hits or its full
+        proteome was not part of the stage one database."""
+        total = sum(suffix_counts.values())
+        if not total:
+            return None
+        ranked = sorted(suffix_counts.items(), key=lambda item: -item[1])
+        leader, count = ranked[0]
+        if count / total >= self.min_share and leader in self.info["top_organisms"]:
+            return None
+        return [organism for organism, count in ranked[:STAGE_TWO_ORGANISMS] if count / total >= MIN_STAGE_TWO_SHARE]
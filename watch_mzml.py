@@ -0,0 +1,188 @@
+import os
+import time
+import threading
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from infer_metadata import build_parser, build_file_steps, run_file_chains, create_directories
+from create_feature_file import create_feature_file
+from feature_store import FeatureStore
+from ml_prediction import predict_metadata_batch
+from metadata_file_creation import create_metadata, model1, model2
+from prediction_server import request_predictions
+
+# Watch mode: polls --mzml_dir for new mzML files and runs the per-file chains of infer_metadata.py only
+# for files that are complete, i.e. whose size and modification time did not change for --stable_seconds
+# or whose sentinel file (e.g. A.mzML.done) exists. The predictions of every batch are appended to
+# metadata_result.csv and the time from the arrival of a file to its prediction is logged. Files whose
+# chain failed are logged as failed and retried with exponential backoff.
+
+latency_log_lock = threading.Lock()
+
+def parse_arguments():
+    parser = build_parser()
+    parser.description = "Watch a directory and infer the metadata of mzML files as they arrive."
+    parser.add_argument('--poll_interval', type=float, default=10, help="Seconds between two scans of --mzml_dir.")
+    parser.add_argument('--stable_seconds', type=float, default=30, help="A file counts as complete once its size and modification time did not change for this many seconds.")
+    parser.add_argument('--max_retry_seconds', type=float, default=3600, help="Files whose processing failed are retried after --poll_interval seconds, doubling the wait after every failure up to this many seconds.")
+    parser.add_argument('--sentinel_suffix', type=str, help="Optional: A file counts as complete once a file with this suffix exists next to it (e.g. '.done' for A.mzML.done), instead of waiting for a stable size.")
+    return parser.parse_args()
+
+def processed_files(output_dir):
+    """Files that already have a row in metadata_result.csv, so a restarted watcher does not predict them again."""
+    metadata_file = os.path.join(output_dir, "metadata_result.csv")
+    if not os.path.exists(metadata_file):
+        return set()
+    return set(pd.read_csv(metadata_file, usecols=["Filename"])["Filename"])
+
+def append_csv(df, path):
+    df.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+def log_latency(latency_log, mzml_file, arrived, completed, predicted, status="predicted"):
+    """Appends the arrival, completion and prediction (or failure) time of a file to the latency log."""
+    if status == "predicted":
+        print(f"Predicted {mzml_file} {predicted - arrived:.1f} s after its arrival "
+              f"({predicted - completed:.1f} s after it was complete)")
+    with latency_log_lock:
+        new_log = not os.path.exists(latency_log)
+        with open(latency_log, "a") as f:
+            if new_log:
+                f.write("file\tarrived\tcompleted\tpredicted\tlatency_s\tprocessing_s\tstatus\n")
+            f.write(f"{mzml_file}\t{arrived:.3f}\t{completed:.3f}\t{predicted:.3f}\t{predicted - arrived:.2f}\t{predicted - completed:.2f}\t{status}\n")
+
+class DirectoryWatcher:
+    """Keeps track of the mzML files in a directory and reports the files that became complete."""
+
+    def __init__(self, mzml_dir, stable_seconds=30, sentinel_suffix=None, ignore=()):
+        self.mzml_dir = mzml_dir
+        self.stable_seconds = stable_seconds
+        self.sentinel_suffix = sentinel_suffix
+        self.ignore = set(ignore)
+        self.files = {}  # file -> {"arrived", "stat", "changed"}
+        self.retries = {}  # file -> {"arrived", "attempts", "retry_at"} of files whose processing failed
+
+    def is_complete(self, mzml_file, state, now):
+        if self.sentinel_suffix:
+            return os.path.exists(os.path.join(self.mzml_dir, mzml_file + self.sentinel_suffix))
+        return now - state["changed"] >= self.stable_seconds
+
+    def poll(self):
+        """Returns the newly completed files with their arrival and completion times."""
+        now = time.time()
+        completed = []
+        for mzml_file in sorted(os.listdir(self.mzml_dir)):
+            if not mzml_file.endswith(".mzML") or mzml_file in self.ignore:
+                continue
+            retry = self.retries.get(mzml_file)
+            if retry is not None and now < retry["retry_at"]:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.mzml_dir, mzml_file))
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            state = self.files.get(mzml_file)
+            if state is None:
+                # The arrival time is the first time the file was seen, also for retried files
+                arrived = retry["arrived"] if retry is not None else now
+                state = self.files[mzml_file] = {"arrived": arrived, "stat": signature, "changed": now}
+            elif state["stat"] != signature:
+                state["stat"], state["changed"] = signature, now
+            if self.is_complete(mzml_file, state, now):
+                completed.append((mzml_file, state["arrived"], now))
+        for mzml_file, _, _ in completed:
+            self.ignore.add(mzml_file)
+            del self.files[mzml_file]
+        return completed
+
+    def retry(self, mzml_file, arrived, first_wait, max_wait):
+        """Reports a failed file again after first_wait seconds, doubling the wait after every failure."""
+        attempts = self.retries.get(mzml_file, {}).get("attempts", 0) + 1
+        wait = min(first_wait * 2 ** (attempts - 1), max_wait)
+        self.retries[mzml_file] = {"arrived": arrived, "attempts": attempts, "retry_at": time.time() + wait}
+        self.ignore.discard(mzml_file)
+        print(f"Processing {mzml_file} failed ({attempts} attempts), retrying in {wait:.0f} s.")
+
+    def succeeded(self, mzml_file):
+        self.retries.pop(mzml_file, None)
+
+def predict_files(args, feature_dfs):
+    """Predicts the metadata of the per-file features and appends predictions and metadata to the result files.
+    Every file is predicted on its own features, so its prediction does not depend on the files it arrived with."""
+    if args.prediction_server:
+        results = [request_predictions(args.prediction_server, feature_df) for feature_df in feature_dfs]
+        predictions = {model: pd.concat([p[model] for p, _ in results], ignore_index=True) for model in results[0][0]}
+        metadata = pd.concat([m for _, m in results], ignore_index=True)
+    else:
+        results = predict_metadata_batch(feature_dfs)
+        predictions = {model: pd.concat([p[model] for p in results], ignore_index=True) for model in results[0]}
+        metadata = create_metadata(predictions[model1], predictions[model2])
+    for model, y_pred_decoded in predictions.items():
+        append_csv(y_pred_decoded, os.path.join(args.output_dir, f"{model}_predicted_metadata.csv"))
+    append_csv(metadata, os.path.join(args.output_dir, "metadata_result.csv"))
+
+def process_files(args, idxml_dir, files, steps, caches):
+    """Runs the per-file chains for newly completed files and appends their predictions.
+    Returns the files whose chain failed."""
+    mzml_files = [mzml_file for mzml_file, _, _ in files]
+    print(f"Processing {len(mzml_files)} new mzML files: {', '.join(mzml_files)}")
+    chain_results = run_file_chains(mzml_files, steps, args.light_workers, args.heavy_workers)
+    for cache in caches:
+        cache.save()
+
+    results = {f: chain_results[f] for f in mzml_files if chain_results[f] is not None and chain_results[f][0] is not None}
+    failed = [(mzml_file, arrived, completed) for mzml_file, arrived, completed in files if mzml_file not in results]
+    for mzml_file, arrived, completed in failed:
+        log_latency(os.path.join(args.output_dir, "watch_latency.tsv"), mzml_file, arrived, completed, time.time(), "failed")
+    if not results:
+        return failed
+    fileinfo_records = [fileinfo_record for fileinfo_record, _ in results.values()]
+    idxml_records = [idxml_record for _, idxml_record in results.values() if idxml_record is not None]
+    # Only the features of the new files are built, the files written for the whole directory are skipped
+    feature_df = create_feature_file(idxml_dir, args.output_dir, fileinfo_records, idxml_records, write_files=False)
+    # Every file keeps only its own columns, the organism and charge columns of the other files of the batch
+    # would otherwise be empty instead of missing and imputed differently
+    feature_dfs = []
+    for mzml_file, (fileinfo_record, idxml_record) in results.items():
+        columns = set(fileinfo_record) | set(idxml_record or {})
+        feature_dfs.append(feature_df.loc[feature_df["Filename"] == mzml_file, [c for c in feature_df.columns if c in columns]])
+    if args.feature_store:
+        store = FeatureStore(os.path.join(args.output_dir, "feature_store"), args.feature_store)
+        for file_df in feature_dfs:
+            store.append(file_df.to_dict("records")[0])
+
+    predict_files(args, feature_dfs)
+    predicted = time.time()
+    for mzml_file, arrived, completed in files:
+        if mzml_file in results:
+            log_latency(os.path.join(args.output_dir, "watch_latency.tsv"), mzml_file, arrived, completed, predicted)
+    return failed
+
+def main():
+    args = parse_arguments()
+    create_directories(args.output_dir, args.idxml_dir)
+    idxml_dir = args.idxml_dir or os.path.join(args.output_dir, "idxml")
+
+    done = processed_files(args.output_dir)
+    watcher = DirectoryWatcher(args.mzml_dir, args.stable_seconds, args.sentinel_suffix, ignore=done)
+    print(f"Watching {args.mzml_dir} for new mzML files ({len(done)} files already predicted)...")
+
+    extract_pool = ProcessPoolExecutor(max_workers=args.light_workers) if args.fileinfo_backend != "fileinfo" else None
+    steps, _, caches = build_file_steps(args, idxml_dir, extract_pool)
+    try:
+        while True:
+            files = watcher.poll()
+            if files:
+                failed = process_files(args, idxml_dir, files, steps, caches)
+                for mzml_file, arrived, _ in failed:
+                    watcher.retry(mzml_file, arrived, args.poll_interval, args.max_retry_seconds)
+                for mzml_file in {f for f, _, _ in files} - {f for f, _, _ in failed}:
+                    watcher.succeeded(mzml_file)
+            time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        if extract_pool is not None:
+            extract_pool.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+# Work distribution over a shared filesystem: workers on different hosts share an output directory and
+# claim per-file work items by creating lease files with O_EXCL, which succeeds for exactly one worker.
+# Leases are renewed while the work runs by rewriting their content, and a lease whose content did not
+# change for lease_seconds belongs to a dead worker and is claimed again. Finished items get a done file
+# with their result record. Failed items get a failure file, which keeps them from being claimed again
+# for lease_seconds. Only O_EXCL creation and atomic renames are needed from the filesystem, no flock,
+# and the clocks of the hosts are never compared with each other.
+
+def read_file(path):
+    """Content of a small file, None if it does not exist."""
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+class ContentClock:
+    """Measures for how long files kept their content with the local monotonic clock, so the age of a
+    file written by another host does not depend on the clock of that host."""
+
+    def __init__(self):
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def unchanged_for(self, path, content):
+        """Seconds since content was first seen in path without change in between."""
+        now = time.monotonic()
+        with self.lock:
+            seen = self.seen.get(path)
+            if seen is None or seen[0] != content:
+                self.seen[path] = (content, now)
+                return 0.0
+            return now - seen[1]
+
+    def forget(self, path):
+        with self.lock:
+            self.seen.pop(path, None)
+
+def remove_if_unchanged(path, content, owner_id):
+    """Removes the file path if it still has the given content. Of several workers removing it at once,
+    only one can rename it away, and a file that was created again in the meantime is put back.
+    Returns True if the file was removed."""
+    stale_path = f"{path}.{owner_id}.stale"
+    try:
+        os.rename(path, stale_path)
+    except FileNotFoundError:
+        return False
+    unchanged = read_file(stale_path) == content
+    if not unchanged:
+        try:
+            os.link(stale_path, path)
+        except FileExistsError:
+            pass
+    os.remove(stale_path)
+    return unchanged
+
+@contextmanager
+def file_lock(path, timeout=60):
+    """Holds the lock file path, created with O_EXCL, which also works on shared filesystems without
+    flock support. A lock file whose content did not change for timeout seconds was left by a dead
+    process and is removed."""
+    owner_id = f"{socket.gethostname()}_{os.getpid()}_{threading.get_ident()}"
+    clock = ContentClock()
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            content = read_file(path)
+            if content is not None and clock.unchanged_for(path, content) >= timeout and remove_if_unchanged(path, content, owner_id):
+                print(f"Warning: Removed the lock {path}, which was not released for {timeout} seconds.")
+                continue
+            time.sleep(0.05)
+    token = f"{owner_id} {time.time_ns()}"
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    try:
+        yield
+    finally:
+        # The lock may have been removed as stale and taken by another process in the meantime
+        remove_if_unchanged(path, token, owner_id)
+
+class WorkClaims:
+    """Lease and done files of the work items (file names in source_dir) in claims_dir."""
+
+    def __init__(self, claims_dir, source_dir, lease_seconds=600):
+        self.claims_dir = claims_dir
+        self.source_dir = source_dir
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.owner_id = self.owner.replace(':', '_')
+        self.held = {}  # item -> lease path
+        self.renewals = 0
+        self.clock = ContentClock()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.renewer = None
+        os.makedirs(claims_dir, exist_ok=True)
+
+    def path(self, item, suffix):
+        return os.path.join(self.claims_dir, f"{item}{suffix}")
+
+    def signature(self, item):
+        """Size and modification time of the input file, a changed file is processed again."""
+        try:
+            stat = os.stat(os.path.join(self.source_dir, item))
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def read_done(self, item):
+        try:
+            with open(self.path(item, ".done"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_done(self, item):
+        done = self.read_done(item)
+        return done is not None and done["file"] == self.signature(item)
+
+    def record(self, item):
+        """Result record stored when the item was completed, None if it failed or is not done."""
+        done = self.read_done(item)
+        return done["record"] if done is not None and done["file"] == self.signature(item) else None
+
+    def filesystem_time(self):
+        """Current time of the shared filesystem: the modification time it gives a file written now.
+        Unlike the local clock, it is the same for the workers on all hosts."""
+        path = self.path(f".clock_{self.owner_id}", "")
+        with open(path, "w") as f:
+            f.write(self.owner)
+        return os.stat(path).st_mtime
+
+    def has_failed(self, item):
+        """True if the item failed less than lease_seconds ago and the input file did not change since.
+        The age of the failure file is measured with the clock of the filesystem that stamped it."""
+        path = self.path(item, ".failed")
+        try:
+            with open(path, "r") as f:
+                failed = json.load(f)
+            age = self.filesystem_time() - os.stat(path).st_mtime
+        except (OSError, ValueError):
+            return False
+        return failed["file"] == self.signature(item) and age < self.lease_seconds
+
+    def claim(self, item):
+        """Claims an item for this worker. Returns False if it is done, failed recently or claimed by a live worker."""
+        if self.is_done(item) or self.has_failed(item):
+            return False
+        path = self.path(item, ".lease")
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.reclaim_stale(item, path):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(self.lease_content())
+            # The item may have been completed between the check above and the claim
+            if self.is_done(item):
+                self.remove_lease(path)
+                return False
+            with self.lock:
+                self.held[item] = path
+                if self.renewer is None:
+                    self.renewer = threading.Thread(target=self.renew, daemon=True)
+                    self.renewer.start()
+            return True
+        return False
+
+    def lease_content(self):
+        """Owner and renewal count written to a lease, the content changes with every renewal."""
+        with self.lock:
+            self.renewals += 1
+            return f"{self.owner} {self.renewals}"
+
+    def reclaim_stale(self, item, path):
+        """Removes the lease of an item if this worker saw its content unchanged for lease_seconds, so
+        the clocks of the other hosts do not matter. A worker started after the owner died therefore waits
+        lease_seconds before it reclaims the lease. Of several workers reclaiming the same lease at once,
+        only one can rename it away."""
+        content = read_file(path)
+        if content is None:
+            return True
+        if self.clock.unchanged_for(path, content) < self.lease_seconds:
+            return False
+        # Another worker may have reclaimed the lease and created a new one after the check above
+        if not remove_if_unchanged(path, content, self.owner_id):
+            return False
+        self.clock.forget(path)
+        print(f"Reclaimed {item} from worker {content.split()[0]}, whose lease expired.")
+        return True
+
+    def renew(self):
+        """Rewrites the content of the held leases every third of the lease time."""
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                held = list(self.held.items())
+            for item, path in held:
+                try:
+                    # Written in place, so a lease that was reclaimed in the meantime is not created again
+                    with open(path, "r+") as f:
+                        owned = f.read().split(" ")[0] == self.owner
+                        if owned:
+                            f.seek(0)
+                            f.write(self.lease_content())
+                            f.truncate()
+                except FileNotFoundError:
+                    owned = False
+                if not owned and item in self.held:
+                    print(f"Warning: The lease of {item} was lost, another worker may process it as well.")
+
+    def remove_lease(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def release(self, item):
+        """Gives up a claimed item without completing it, so other workers can claim it."""
+        with self.lock:
+            path = self.held.pop(item, None)
+        if path is not None:
+            self.remove_lease(path)
+
+    def complete(self, item, record=None):
+        """Stores the result record of a claimed item and releases its lease."""
+        done_path = self.path(item, ".done")
+        tmp_path = f"{done_path}.{self.owner_id}.tmp"
+        with open(tmp_path, "w") as f:
+            # NumPy scalars in the records are stored as plain numbers
+            json.dump({"owner": self.owner, "file": self.signature(item), "record": record}, f, default=lambda o: o.item())
+        os.replace(tmp_path, done_path)
+        self.remove_lease(self.path(item, ".failed"))
+        self.release(item)
+
+    def fail(self, item):
+        """Marks a claimed item as failed and releases its lease. It can be claimed again after lease_seconds."""
+        failed_path = self.path(item, ".failed")
+        tmp_path = f"{failed_path}.{self.owner_id}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"owner": self.owner, "file": self.signature(item)}, f)
+        os.replace(tmp_path, failed_path)
+        self.release(item)
+
+    def close(self):
+        self.stopped.set()
+        for item in list(self.held):
+            self.release(item)
+        self.remove_lease(self.path(f".clock_{self.owner_id}", ""))